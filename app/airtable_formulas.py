@@ -0,0 +1,27 @@
+from datetime import datetime
+
+AIRTABLE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def parse_created_time(row):
+    """ Returns when an airtable row was created
+    :param row: A row from any airtable table
+    :return: A (naive, UTC) datetime
+    """
+    return datetime.strptime(row["createdTime"], AIRTABLE_TIME_FORMAT)
+
+
+def format_airtable_time(time):
+    """ Formats a (naive, UTC) datetime the way airtable does, e.g. for storing it in the Config table
+    :param time: The datetime
+    :return: The formatted time
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (time.microsecond // 1000)
+
+
+def CREATED_AFTER(time):
+    """ Creates a formula matching rows created after a given time
+    :param time: A (naive, UTC) datetime
+    :return: The formula
+    """
+    return "IS_AFTER(CREATED_TIME(), DATETIME_PARSE('%s'))" % format_airtable_time(time)
@@ -0,0 +1,234 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from requests import Session
+
+from metrics import metrics
+
+
+class AirtableGovernor:
+    # Priority classes, most urgent first.  Each thread has a priority (see set_thread_priority), and when requests
+    # are waiting for the rate limit, the most urgent goes first.
+    PRIORITY_SCORING = 0
+    PRIORITY_DEFAULT = 1
+    PRIORITY_HOUSEKEEPING = 2
+    PRIORITY_NAMES = {PRIORITY_SCORING: "scoring", PRIORITY_DEFAULT: "default", PRIORITY_HOUSEKEEPING: "housekeeping"}
+
+    # How long airtable blocks a base for after it's gone over the rate limit, if the response doesn't say
+    PENALTY_SECONDS = 30
+    # The window the request rate gauge is averaged over
+    RATE_WINDOW_SECONDS = 10
+
+    def __init__(self, requests_per_second=5, burst=1, max_retries=3, shared_bucket=None):
+        """ Constructor for a governor that every request to an airtable base goes through (see GovernedSession), so
+            that all of this process's threads together stay within airtable's rate limit of 5 requests per second
+            per base.  Requests are let through by a token bucket, and a 429 response holds every request back
+            until the penalty is over, then retries it.  With a shared bucket, every process using the base takes
+            its requests from the same budget; without one, each process needs to be given its own share of the rate.
+        :param requests_per_second: (optional) How many requests to let through per second
+        :param burst: (optional) How many requests can go at once after a quiet spell
+        :param max_retries: (optional) How many times to retry a request that was rate limited
+        :param shared_bucket: (optional) A SharedTokenBucket that every process using the base also takes a token from
+        """
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.shared_bucket = shared_bucket
+        self.__shared_bucket_failing = False
+        self.__tokens = burst
+        self.__refilled_at = time.monotonic()
+        self.__blocked_until = 0
+        # Heap of (priority, sequence number) of the requests waiting for a token
+        self.__waiting = []
+        self.__sequence = itertools.count()
+        self.__condition = threading.Condition()
+        self.__recent_requests = deque()
+        self.__local = threading.local()
+
+    def set_thread_priority(self, priority):
+        """ Sets the priority of the current thread's airtable requests
+        :param priority: One of the PRIORITY_* classes
+        """
+        self.__local.priority = priority
+
+    def get_thread_priority(self):
+        """ Returns the priority of the current thread's airtable requests
+        :return: One of the PRIORITY_* classes
+        """
+        return getattr(self.__local, "priority", self.PRIORITY_DEFAULT)
+
+    def acquire(self, priority=None):
+        """ Waits until a request can be made
+        :param priority: (optional) The priority of the request, the current thread's if None
+        """
+        if priority is None:
+            priority = self.get_thread_priority()
+
+        start = time.monotonic()
+        with self.__condition:
+            entry = (priority, next(self.__sequence))
+            heapq.heappush(self.__waiting, entry)
+            metrics.gauge("airtable.governor.waiting", len(self.__waiting))
+            while True:
+                now = time.monotonic()
+                self.__refill(now)
+                if now < self.__blocked_until:
+                    timeout = self.__blocked_until - now
+                elif self.__waiting[0] != entry:
+                    # Someone more urgent is first, we'll be woken up when they've gone
+                    timeout = None
+                elif self.__tokens < 1:
+                    timeout = (1 - self.__tokens) / self.requests_per_second
+                else:
+                    # Note - we stay first in line while we wait for the other processes' requests
+                    timeout = self.__acquire_shared()
+                    if timeout <= 0:
+                        break
+                self.__condition.wait(timeout)
+
+            heapq.heappop(self.__waiting)
+            self.__tokens -= 1
+            self.__condition.notify_all()
+
+            self.__recent_requests.append(now)
+            while self.__recent_requests[0] < now - self.RATE_WINDOW_SECONDS:
+                self.__recent_requests.popleft()
+            requests_per_second = len(self.__recent_requests) / self.RATE_WINDOW_SECONDS
+
+        wait_ms = (time.monotonic() - start) * 1000
+        metrics.timing("airtable.governor.wait", wait_ms)
+        metrics.timing("airtable.governor.wait.%s" % self.PRIORITY_NAMES.get(priority, priority), wait_ms)
+        metrics.gauge("airtable.governor.requests_per_second", requests_per_second)
+
+    def penalize(self, seconds):
+        """ Holds every request back, after airtable has told us we went over the rate limit
+        :param seconds: How long to hold requests back for
+        """
+        with self.__condition:
+            self.__blocked_until = max(self.__blocked_until, time.monotonic() + seconds)
+            self.__tokens = 0
+            self.__condition.notify_all()
+        if self.shared_bucket is not None:
+            try:
+                self.shared_bucket.penalize(seconds)
+            except Exception as e:
+                print("Failed to share airtable rate limit penalty: %s" % e)
+        metrics.incr("airtable.governor.throttled", 1)
+        print("Airtable rate limit exceeded, holding requests back for %ds" % seconds)
+
+    def send(self, send_request):
+        """ Makes a request once the rate limit allows, retrying it if airtable rate limits it anyway
+        :param send_request: A function that makes the request and returns the response
+        :return: The response
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            response = send_request()
+            if response.status_code != 429 or attempt >= self.max_retries:
+                return response
+
+            attempt += 1
+            retry_after = response.headers.get("Retry-After", None)
+            self.penalize(int(retry_after) if retry_after is not None and retry_after.isdigit()
+                          else self.PENALTY_SECONDS)
+
+    def __refill(self, now):
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__refilled_at) * self.requests_per_second)
+        self.__refilled_at = now
+
+    def __acquire_shared(self):
+        """ Takes a token from the shared bucket, returning how long to wait first if there isn't one.  If the shared
+            bucket can't be reached we go by our own bucket alone (and airtable's 429s), rather than stop. """
+        if self.shared_bucket is None:
+            return 0
+        try:
+            wait = self.shared_bucket.acquire()
+        except Exception as e:
+            metrics.incr("error.airtable.governor.shared", 1)
+            if not self.__shared_bucket_failing:
+                print("Failed to reach the shared airtable rate limit, going by this process's alone: %s" % e)
+            self.__shared_bucket_failing = True
+            return 0
+        self.__shared_bucket_failing = False
+        return wait
+
+
+class SharedTokenBucket:
+    # Refills the bucket and takes a token if there is one, returning how many seconds to wait for one otherwise.
+    # Timestamps come from redis, so every process agrees on them.
+    ACQUIRE_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local clock = redis.call("TIME")
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local state = redis.call("HMGET", KEYS[1], "tokens", "refilled_at", "blocked_until")
+        local tokens = tonumber(state[1]) or burst
+        local refilled_at = tonumber(state[2]) or now
+        local blocked_until = tonumber(state[3]) or 0
+        if now < blocked_until then
+            return tostring(blocked_until - now)
+        end
+        tokens = math.min(burst, tokens + math.max(0, now - refilled_at) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "refilled_at", tostring(now))
+        redis.call("EXPIRE", KEYS[1], 3600)
+        return tostring(wait)
+    """
+    # Empties the bucket and holds every process back for ARGV[1] seconds
+    PENALIZE_SCRIPT = """
+        local clock = redis.call("TIME")
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local blocked_until = math.max(tonumber(redis.call("HGET", KEYS[1], "blocked_until")) or 0,
+                                       now + tonumber(ARGV[1]))
+        redis.call("HSET", KEYS[1], "tokens", "0", "refilled_at", tostring(now),
+                   "blocked_until", tostring(blocked_until))
+        redis.call("EXPIRE", KEYS[1], 3600)
+        return 1
+    """
+
+    def __init__(self, redis_client, key, requests_per_second=5, burst=1):
+        """ Constructor for a token bucket kept in redis, so that every process (the worker and each web worker) takes
+            its airtable requests from one rate limit
+        :param redis_client: The redis client
+        :param key: The redis key of the bucket, one per airtable base
+        :param requests_per_second: (optional) How many requests to let through per second, across every process
+        :param burst: (optional) How many requests can go at once after a quiet spell
+        """
+        self.key = key
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.__acquire = redis_client.register_script(self.ACQUIRE_SCRIPT)
+        self.__penalize = redis_client.register_script(self.PENALIZE_SCRIPT)
+
+    def acquire(self):
+        """ Takes a token if there is one
+        :return: 0 if we got a token, otherwise how many seconds to wait before trying again
+        """
+        return float(self.__acquire(keys=[self.key], args=[self.requests_per_second, self.burst]))
+
+    def penalize(self, seconds):
+        """ Holds every process's requests back, after airtable has told us we went over the rate limit
+        :param seconds: How long to hold requests back for
+        """
+        self.__penalize(keys=[self.key], args=[seconds])
+
+
+class GovernedSession(Session):
+    def __init__(self, governor):
+        """ A requests Session whose requests all go through an AirtableGovernor
+        :param governor: The AirtableGovernor for the base the session talks to
+        """
+        super().__init__()
+        self.governor = governor
+
+    def request(self, method, url, *args, **kwargs):
+        return self.governor.send(lambda: super(GovernedSession, self).request(method, url, *args, **kwargs))
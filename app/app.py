@@ -1,44 +1,58 @@
+""" The bot's entry point.  The web process (gunicorn 'app:create_app()') serves /publishPuzzle and /leaderboard, and the worker
+    process (PROC_TYPE=worker python app/app.py) runs the polling in worker.py.  Clients are built the first time
+    they're used (see services.py), so neither process imports or builds what only the other one needs.
+"""
 import os
+import hashlib
 import json
-import random
-import sys
-import asyncio
-import traceback
+import threading
 import time
+import traceback
 
-import requests
-import polling
-from flask import Flask, request, Response, g
-from dotenv import load_dotenv
+from flask import Blueprint, Flask, request, Response, g
 from flask_auth import login_required
-import threading
-import lzstring
-from persistence import Persistence
-from twitter import TwitterClient
+import lz_string
+import services
+from cache import TTLCache
 from metrics import metrics
 
-app = Flask(__name__)
-app.secret_key = os.urandom(50)
-
-load_dotenv()
-
-AUTHORIZE_MANUALLY = False
-TESTING = False
-
-scoring_service_uri = os.environ["SINERIDER_SCORING_SERVICE"]
-leaderboard_uri = os.environ["LEADERBOARD_URI"]
-persistence = Persistence(os.environ["AIRTABLE_API_KEY"], os.environ["AIRTABLE_BASE_ID"])
-twitter_client = TwitterClient(persistence, json.loads(os.environ["TWITTER_CREDENTIALS_JSON"]),
-                               os.environ["REDIRECT_URI"], TESTING)
+# The fields every puzzle's publishing info must have
+PUBLISH_INFO_FIELDS = ["id", "puzzleTitle", "puzzleDescription", "puzzleURL"]
+# How often the publishing thread looks for jobs queued by other processes
+PUBLISH_JOB_POLL_SECONDS = float(os.environ.get("PUBLISH_JOB_POLL_SECONDS", "5"))
+# How many entries /leaderboard returns by default, and at most
+LEADERBOARD_DEFAULT_LIMIT = 100
+LEADERBOARD_MAX_LIMIT = 1000
+# How often the web process picks up new leaderboard entries, and how long clients may cache /leaderboard for
+LEADERBOARD_REFRESH_SECONDS = float(os.environ.get("LEADERBOARD_REFRESH_SECONDS", "60"))
+LEADERBOARD_MAX_AGE_SECONDS = int(os.environ.get("LEADERBOARD_MAX_AGE_SECONDS", "30"))
+
+web = Blueprint("web", __name__)
+publishing_thread = None
+publishing_thread_lock = threading.Lock()
+# (level, limit) -> (leaderboard version, response body)
+leaderboard_responses = TTLCache("leaderboard_responses", 256)
+
+
+def create_app():
+    """ Creates the web app
+    :return: A Flask app
+    """
+    app = Flask(__name__)
+    app.secret_key = os.urandom(50)
+    app.register_blueprint(web)
+    # Publishes any jobs left queued when a previous process stopped, as well as new ones
+    ensure_publishing()
+    return app
 
 
-@app.before_request
+@web.before_app_request
 def get_metrics():
     g.start = time.time()
     g.method = request.method
     g.url = request.url
 
-@app.after_request
+@web.after_app_request
 def log_metrics(response: Response):
     diff = time.time() - g.start
     stat = (g.method + '/' + g.url.split('/')[3]).lower().replace("/", "_")
@@ -50,275 +64,245 @@ def log_metrics(response: Response):
 
     return response
 
-@app.route("/publishPuzzle", methods=["POST"])
+@web.route("/publishPuzzle", methods=["POST"])
 @login_required
 def on_publish_puzzle():
-    """ Endpoint that is called when we want to auto-publish a new puzzle on Twitter.
-    :return: Response(200), or Response(500) + json error msg
+    """ Endpoint that is called when we want to auto-publish new puzzles on Twitter.  Takes one or more
+        "publishingInfo" query parameters, queues a publish job for each puzzle and returns straight away; the tweets
+        are posted in the background (see start_publishing).  Publishing a puzzle that already has a job returns that
+        job rather than publishing it again, so requests can safely be retried.
+    :return: Response(202) + json {"jobs": [job status, ...]}, Response(400) + json error msg, or Response(503) +
+        json error msg if the job queue can't be reached
     """
-    publish_info = request.args.get("publishingInfo")
-    lztranscoder = lzstring.LZString()
-    json_str = lztranscoder.decompressFromBase64(publish_info)
-    exploded_publish_info = json.loads(json_str)
-    puzzle_id = exploded_publish_info["id"]
-    puzzle_title = exploded_publish_info["puzzleTitle"]
-    puzzle_description = exploded_publish_info["puzzleDescription"]
-    puzzle_url = exploded_publish_info["puzzleURL"]
-
-    puzzle_post_text = "%s - %s %s" % (puzzle_title, puzzle_description, puzzle_url)
-    print("Publishing puzzle on twitter: %s" % (puzzle_post_text))
+    publish_infos = []
+    for publish_info in request.args.getlist("publishingInfo"):
+        try:
+            publish_infos.append(parse_publish_info(publish_info))
+        except ValueError as e:
+            metrics.incr("error.publish_puzzle.invalid", 1)
+            return json_response({"message": "Invalid publishingInfo: %s" % e}, 400)
 
+    if len(publish_infos) == 0:
+        return json_response({"message": "Missing publishingInfo"}, 400)
+
+    jobs = []
     try:
-        # Note - we always want to publish these tweets using the primary bot account
-        response = twitter_client.post_tweet(puzzle_post_text, use_primary_bot=True)
-        tweet_id = response.data["id"]
-        print("Successfully published puzzle (tweet id: %s)" % (tweet_id))
-        persistence.set_config("twitter_%s" % (puzzle_id), tweet_id)
-        return Response(status=200)
+        publish_jobs = services.get_publish_jobs()
+        for exploded_publish_info in publish_infos:
+            job, queued = publish_jobs.submit(exploded_publish_info["id"], exploded_publish_info)
+            print("%s publish job %s for puzzle %s" % ("Queued" if queued else "Found existing", job.job_id,
+                                                      job.puzzle_id))
+            jobs.append(job)
     except Exception as e:
-        metrics.incr("error.publish_puzzle", 1)
-        error_message = str(e).replace('\n', ' ').replace('\r', '')
-        print("Failed to publish puzzle: message=%s" % (error_message))
-        resp = Response("{'message':'%s'}" % error_message, status=500, mimetype='application/json')
-        return resp
+        # e.g. redis is unreachable; the jobs queued so far are kept, so retrying the request is safe
+        metrics.incr("error.publish_puzzle.queue", 1)
+        print("Failed to queue publish jobs: %s" % (e))
+        response = json_response({"message": "Publish job queue unavailable, try again later"}, 503)
+        response.headers["Retry-After"] = "30"
+        return response
+
+    response = json_response({"jobs": [job.to_json() for job in jobs]}, 202)
+    if len(jobs) == 1:
+        response.headers["Location"] = "/publishPuzzle/%s" % jobs[0].job_id
+    return response
 
 
-def notify_user_unknown_error(player_name, tweet_id):
-    """ Tweet a generic error response to a submitter.
-    :param playerName: The name of the player we're responding to
-    :param tweetId: The ID of the tweet they submitted their answer with
+@web.route("/publishPuzzle/<job_id>", methods=["GET"])
+@login_required
+def on_get_publish_job(job_id):
+    """ Endpoint for checking on a publish job
+    :param job_id: The ID of the job, as returned by /publishPuzzle
+    :return: Response(200) + json job status, or Response(404)
     """
-    error_message = "Sorry, I encountered an error scoring that submission :("
-    metrics.incr("error.unknown", 1)
-    twitter_client.post_tweet(error_message, tweet_id)
-
+    job = services.get_publish_jobs().get(job_id)
+    if job is None:
+        return json_response({"message": "No such job"}, 404)
+    return json_response(job.to_json(), 200)
 
-def notify_user_highscore_already_exists(player_name, tweet_id, cached_result):
-    """ Tweet a response to a submitter saying that their high score already existed
-    :param playerName: The name of the player we're responding to
-    :param tweetId: The ID of the tweet they submitted their answer with
-    :param cachedResult: The duplicate high-score record
-    """
-    print("We should notify user %s of duplicate high score re: tweet with ID: %s" % (player_name, tweet_id))
-    error_message = "Sorry, someone already submitted that solution — try again with a different answer!"
-    media = None
-    if "fields" in cached_result and "gameplay" in cached_result["fields"] and len(
-            cached_result["fields"]["gameplay"]) > 0:
-        try:
-            media = twitter_client.upload_media(cached_result["fields"]["gameplay"], "video/mp4")
-        except Exception as e:
-            media = None
-    twitter_client.post_tweet(error_message, tweet_id, media)
 
-
-def notify_user_invalid_puzzle(player_name, tweet_id):
-    """ Tweet a response to a submitter saying that their submission was invalid, because the puzzle didn't exist
-    :param player_name:
-    :param tweet_id:
+@web.route("/leaderboard/<level>", methods=["GET"])
+@login_required
+def on_get_leaderboard(level):
+    """ Endpoint for reading a level's leaderboard, from this process's copy of it (see Leaderboards), so that
+        dashboards don't need to query airtable.  Responses carry an ETag, and are cached until the leaderboard
+        changes.
+    :param level: The level name
+    :return: Response(200) + json {"level", "total", "entries": [{"rank", "player", "time", "charCount"}, ...]},
+        Response(304) if the client's copy is current, or Response(503) while the leaderboards are loading
     """
-    print("We should notify user %s of invalid puzzle on tweet with ID: %s" % (player_name, tweet_id))
-    error_message = "I'm terribly sorry, but I'm not aware of a puzzle with that name!"
-    metrics.incr("error.invalid_puzzle", 1)
-    twitter_client.post_tweet(error_message, tweet_id)
+    ensure_leaderboard_polling()
+    leaderboards = services.get_persistence().leaderboards
+    if not leaderboards.loaded:
+        response = json_response({"message": "Leaderboards are still loading"}, 503)
+        response.headers["Retry-After"] = "5"
+        return response
+
+    limit = max(1, min(request.args.get("limit", LEADERBOARD_DEFAULT_LIMIT, type=int), LEADERBOARD_MAX_LIMIT))
+    version = leaderboards.get_version(level)
+    cached = leaderboard_responses.get((level, limit), None)
+    if cached is not None and cached[0] == version:
+        etag, body = cached[1], cached[2]
+    else:
+        # Note - the ETag is a hash of the body, not the version, since versions are only meaningful in this process
+        version, total, entries = leaderboards.get_top(level, limit)
+        body = json.dumps({"level": level, "total": total, "entries": entries})
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        leaderboard_responses.set((level, limit), (version, etag, body))
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, status=200, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = LEADERBOARD_MAX_AGE_SECONDS
+    return response
 
 
-async def do_scoring(work_row):
-    """ Perform scoring for an item on the work queue
-    :param workRow: A work item that needs to be scored and responded to
-    :return: N/A
+def parse_publish_info(publish_info):
+    """ Decompresses and validates the publishing info for a puzzle
+    :param publish_info: The compressed publishing info
+    :return: The publishing info, a dict with id, puzzleTitle, puzzleDescription and puzzleURL
     """
-    # Note - we need to load the puzzle URL from the Puzzles table
-    puzzle_id = work_row["fields"]["puzzleId"]
-    expression = work_row["fields"]["expression"]
-    player_name = work_row["fields"]["twitterHandle"]
-    tweet_id = work_row["fields"]["tweetId"]
-
-    # Keep track of how many times we've attempted to score this work item
-    attempts = persistence.increment_attempts_queued_work(tweet_id)
-
-    print("[Attempt %d] Scoring tweet: %s user: %s puzzle_id: %s expression: \"%s\"" % (
-    attempts, tweet_id, player_name, puzzle_id, expression))
-
-    puzzle_data = persistence.get_puzzle_data(puzzle_id)
-
-    # Validate that the puzzle exists
-    if puzzle_data is None:
-        persistence.complete_queued_work(tweet_id)
-        notify_user_invalid_puzzle(player_name, tweet_id)
-        return
-
-    # Construct the proper level URL based on the puzzle id + expression by using the puzzle data URL
-    # and decoding its contents, and then inserting the expression into it
-    puzzle_url = puzzle_data["fields"]["puzzleURL"]
-    url_parts = puzzle_url.partition("?")
-    url_prefix = url_parts[0]
-    lzstr_base64_encoded_data = url_parts[2]
-    lztranscoder = lzstring.LZString()
-    exploded_puzzle_data = json.loads(lztranscoder.decompressFromBase64(lzstr_base64_encoded_data))
-    exploded_puzzle_data["expressionOverride"] = expression
-
-    responses = [
-        "Grooooovy! You're on the leaderboard for %s with a time of %f (speedy!!) and a character count of %d! Also, we made you an *awesome* video of your run!\r\nCheck your spot on the leaderboards here: %s",
-        "Woohoo!! You're on the leaderboard for %s with a time of %f (vroom vroom!) and a character count of %d! Check out this super cool video of your run!\r\nCheck your spot on the leaderboards here: %s",
-        "🥳🥳🥳 You're on the %s leaderboard with a super speedy time of %f and a character count of %d! We even made this groovy video of your run!\r\nCheck your spot on the leaderboards here: %s",
-        "Cowabunga! You've made it onto the %s leaderboard! You got an unbelievably fast time of %f (WOW!) and a character count of %d! There's even a super cool video of your run!\r\nCheck your spot on the leaderboards here: %s",
-    ]
-
-    # update messages if copy update is needed
-    # thread_messages = [
-    #    "Grooooovy! You're on the leaderboard for %s with a time of %f (speedy!!) and a character count of %d! Also, we made you an *awesome* video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
-    #    "Woohoo!! You're on the leaderboard for %s with a time of %f (vroom vroom!) and a character count of %d! Check out this super cool video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
-    #    "🥳🥳🥳 You're on the %s leaderboard with a super speedy time of %f and a character count of %d! We even made this groovy video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
-    #    "Cowabunga! You've made it onto the %s leaderboard! You got an unbelievably fast time of %f (WOW!) and a character count of %d! There's even a super cool video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
-    # ]
-
-    submission_url = url_prefix + "?" + lztranscoder.compressToBase64(json.dumps(exploded_puzzle_data))
-
-    # See if we have already scored this submission
-    cached_result = persistence.get_submission_with_url(submission_url)
-    if cached_result is not None:
-        print("Invalid (duplicate) submission...")
-        persistence.complete_queued_work(tweet_id)
-        notify_user_highscore_already_exists(player_name, tweet_id, cached_result)
-        return
-
     try:
-        response = requests.post(url=scoring_service_uri, json={"level": submission_url}, verify=False)
-
-        if response.status_code != 200:
-            notify_user_unknown_error(player_name, tweet_id)
-            persistence.complete_queued_work(tweet_id)
+        exploded_publish_info = json.loads(lz_string.decompress_from_base64(publish_info) or "")
+    except (ValueError, TypeError):
+        raise ValueError("not compressed JSON")
 
-        score_data = json.loads(response.text)
-        persistence.add_leaderboard_entry(player_name, score_data, submission_url)
+    if not isinstance(exploded_publish_info, dict):
+        raise ValueError("not a JSON object")
+    for field in PUBLISH_INFO_FIELDS:
+        if not isinstance(exploded_publish_info.get(field, None), str) or exploded_publish_info[field] == "":
+            raise ValueError("missing %s" % field)
+    return exploded_publish_info
 
-        # Mark this job as complete
-        persistence.complete_queued_work(tweet_id)
 
-        if "time" not in score_data or score_data["time"] is None:
-            print("Invalid (>30s) submission...")
-            msg = "Sorry, that submission takes longer than 30 seconds to evaluate, so we had to disqualify it. :( Try again with a new solution!"
-            twitter_client.post_tweet(msg, tweet_id)
-        else:
-            print("Successful submission!")
-            msg = random.choice(responses) % (
-                score_data["level"], score_data["time"], score_data["charCount"], leaderboard_uri)
-
-            try:
-                # Upload video...
-                media_ids = twitter_client.upload_media(score_data["gameplay"], "video/mp4")
-
-                # Respond to the submission thread
-                print("Replying to submission thread")
-                twitter_client.post_tweet(msg, tweet_id, media_ids)
-
-                # Post on the original thread challenging others
-                original_thread_id = persistence.get_config("twitter_%s" % puzzle_id, None)
-                if original_thread_id is not None:
-                    print("Replying to original thread (%s)" % (original_thread_id))
-                    message = "We've just gotten a new submission in from {}! Can you beat them?".format(player_name)
-                    twitter_client.post_tweet(message, original_thread_id, media_ids, use_primary_bot=True)
-            except Exception as e:
-                print(e)
-
-    except Exception as e:
-        metrics.incr("error.scoring_failure", 1)
-        traceback.print_exc()
+def json_response(payload, status):
+    return Response(json.dumps(payload), status=status, mimetype='application/json')
 
-        # We need to eventually give up...
-        if attempts >= 3:
-            notify_user_unknown_error(player_name, tweet_id)
-            persistence.complete_queued_work(tweet_id)
 
-def process_work_queue():
-    asyncio.run(process_work_queue_async())
+def ensure_publishing():
+    """ Starts this process's publishing thread, if it hasn't been started yet """
+    global publishing_thread
+    with publishing_thread_lock:
+        if publishing_thread is None:
+            publishing_thread = threading.Thread(target=start_publishing, daemon=True)
+            publishing_thread.start()
 
-async def process_work_queue_async():
-    """ Attempt to process everything in the work queue. """
-    try:
-        print("Processing work queue")
-        metrics.incr("workqueue.start", 1)
-        queued_work = persistence.get_all_queued_work()
-        tasks = []
-        for work in queued_work:
-            metrics.incr("workqueue.work", 1)
-            tasks.append(do_scoring(work))
-        print("PRE asyncio.gather")
-        await asyncio.gather(*tasks)
-        print("POST asyncio.gather")
-
-    except Exception as e:
-        metrics.incr("error.workqueue", 1)
-        print("Exception: %s" % e)
-    print("Work queue end")
-    sys.stdout.flush()
 
+def ensure_leaderboard_polling():
+    """ Starts keeping this process's copy of the leaderboards up to date, if it hasn't been started yet """
+    def build():
+        thread = threading.Thread(target=start_leaderboard_polling, daemon=True)
+        thread.start()
+        return thread
+    services.get_or_build("leaderboard_polling", build)
 
-def start_work_queue_polling():
-    """ Attempts to process the work queue every 10 seconds. """
-    polling.poll(process_work_queue, step=10, poll_forever=True)
 
+def start_leaderboard_polling():
+    """ Loads the leaderboards, then picks up new entries every LEADERBOARD_REFRESH_SECONDS """
+    persistence = services.get_persistence()
+    while True:
+        try:
+            persistence.submission_index.reconcile()
+        except Exception:
+            metrics.incr("error.leaderboard_refresh", 1)
+            traceback.print_exc()
+        time.sleep(LEADERBOARD_REFRESH_SECONDS)
 
-def start_refresh_token_polling():
-    """ Attempts to refresh all user tokens every 5 minutes. """
-    polling.poll(twitter_client.refresh_all_tokens, step=60, poll_forever=True)
 
+def start_publishing():
+    """ Publishes queued puzzles, as they're queued by this process or (every PUBLISH_JOB_POLL_SECONDS) by others """
+    while True:
+        try:
+            publish_jobs = services.get_publish_jobs()
+            job = publish_jobs.claim()
+            if job is None:
+                publish_jobs.wait_for_jobs(PUBLISH_JOB_POLL_SECONDS)
+                continue
+            publish_puzzle(publish_jobs, job)
+        except Exception as e:
+            metrics.incr("error.publish_puzzle.poll", 1)
+            print("Failed to poll publish jobs: %s" % (e))
+            time.sleep(PUBLISH_JOB_POLL_SECONDS)
 
-def start_submission_tweet_polling():
-    """ Attempts to poll Twitter seconds for new submissions to process.  NOTE: this polls every 16
-        seconds, which is very much by design (maximum # of requests for GET_2_tweets_search_recent
-        is 60 per 15 minutes - see https://developer.twitter.com/en/docs/twitter-api/rate-limits)"""
-    polling.poll(twitter_client.queue_new_tweet_submissions, step=16, poll_forever=True)
 
-def start_duplicates_polling():
+def publish_puzzle(publish_jobs, job):
+    """ Publishes a puzzle on Twitter
+    :param publish_jobs: The PublishJobQueue
+    :param job: The PublishJob for the puzzle
     """
-        Poll airtable every 30 minutes to remove duplicate submissions 
-    """
-    polling.poll(persistence.poll_duplicate_submissions, step=60*30, poll_forever=True)
-
-
-if AUTHORIZE_MANUALLY:
-    twitter_client.force_user_authentication()
+    puzzle_id = job.puzzle_id
+    publish_info = job.publish_info
+    puzzle_url = publish_info["puzzleURL"]
+    persistence = services.get_persistence()
 
-
-def post_test_tweets():
-    # This tweet should timeout
-    twitter_client.post_tweet("#testrider puzzle_1 x%s" % (str(random.randint(-1000000, 1000000))))
-
-    # This is a valid submission that should be scored
-    rand_num = random.randint(0, 1000000)
-    solution = '.001x^2\\cdot .001x^4-2\\ +\\ -.05x^2\\ +\\ \\left(.5\\log \\left(x\\right)+5\\right)+\\sin \\left(17t\\right)' \
-        .replace(" ", "")
-    twitter_client.post_tweet("#testrider puzzle_21 %s+%d-%d" % (solution, rand_num, rand_num))
-
-    # This tweet should result in an "invalid puzzle" response
-    twitter_client.post_tweet("#testrider puzzle_234234 x%s" % (str(random.randint(-1000000, 1000000))))
+    try:
+        # Skip the tweet if an earlier attempt got as far as posting it, or if the puzzle was published by a job we've
+        # lost track of (e.g. one taken over from a publisher that died)
+        tweet_id = job.tweet_id
+        saved_tweet_id = persistence.get_config("twitter_%s" % (puzzle_id), None, cached=False)
+        if tweet_id is None:
+            tweet_id = saved_tweet_id
+        if tweet_id is None:
+            puzzle_post_text = "%s - %s %s" % (publish_info["puzzleTitle"], publish_info["puzzleDescription"], puzzle_url)
+            print("Publishing puzzle on twitter: %s" % (puzzle_post_text))
+            # Note - we always want to publish these tweets using the primary bot account
+            with metrics.timer("publish.tweet"):
+                response = services.get_twitter_client().post_tweet(puzzle_post_text, use_primary_bot=True)
+            tweet_id = response.data["id"]
+            print("Successfully published puzzle (tweet id: %s)" % (tweet_id))
+            # Recorded on the job straight away, so that if saving it to the Config table fails, the retry only does
+            # that
+            publish_jobs.record_tweet(job, tweet_id)
+        else:
+            print("Puzzle %s was already published (tweet id: %s)" % (puzzle_id, tweet_id))
+        if saved_tweet_id != tweet_id:
+            persistence.set_config("twitter_%s" % (puzzle_id), tweet_id)
+        publish_jobs.complete(job, tweet_id)
+        metrics.incr("publish.job.published", 1)
+        refresh_cached_puzzle(puzzle_id, puzzle_url)
+    except Exception as e:
+        metrics.incr("error.publish_puzzle", 1)
+        error_message = str(e).replace('\n', ' ').replace('\r', '')
+        print("Failed to publish puzzle %s (attempt %d): message=%s" % (puzzle_id, job.attempts, error_message))
+        publish_jobs.fail(job, error_message)
 
 
-if TESTING:
-    post_test_tweets()
+def refresh_cached_puzzle(puzzle_id, puzzle_url):
+    """ Makes sure we don't score submissions for a newly-published puzzle against a stale cached definition.  The
+        worker is usually another process, so this bumps the puzzle's version in the Config table, which every
+        process's PuzzleCache checks.
+    :param puzzle_id: The ID of the published puzzle
+    :param puzzle_url: The puzzle URL from the publishing info
+    """
+    try:
+        services.get_puzzle_cache().publish(puzzle_id, puzzle_url)
+    except Exception as e:
+        # Not every puzzle URL carries its definition, in which case we'll load it on the first submission.
+        # Otherwise the worker picks the puzzle up when its cached copy expires.
+        metrics.incr("error.publish.refresh_puzzle", 1)
+        print("Couldn't refresh cached puzzle %s: %s" % (puzzle_id, e))
 
 
-def start_server():
+def start_server(app):
     """ Starts up the server. """
     app.run(port=8080, debug=True, use_reloader=False)
 
 
-if "PROC_TYPE" not in os.environ:
-    print("PROC_TYPE=null (probably running locally)")
-    threading.Thread(target=start_server).start()
-    threading.Thread(target=start_work_queue_polling).start()
-    threading.Thread(target=start_refresh_token_polling).start()
-    threading.Thread(target=start_submission_tweet_polling).start()
-    threading.Thread(target=start_duplicates_polling).start()
-elif os.environ["PROC_TYPE"] == "web":
-    print("PROC_TYPE=web, starting server...")
-    threading.Thread(target=start_server).start()
-elif os.environ["PROC_TYPE"] == "worker":
-    print("PROC_TYPE=worker, starting polling...")
-    threading.Thread(target=start_work_queue_polling).start()
-    threading.Thread(target=start_refresh_token_polling).start()
-    threading.Thread(target=start_submission_tweet_polling).start()
-    threading.Thread(target=start_duplicates_polling).start()
-else:
-    print("INVALID WORKER TYPE")
+if __name__ == "__main__":
+    if "PROC_TYPE" not in os.environ:
+        print("PROC_TYPE=null (probably running locally)")
+        threading.Thread(target=start_server, args=(create_app(),)).start()
+        import worker
+        worker.start_worker()
+    elif os.environ["PROC_TYPE"] == "web":
+        print("PROC_TYPE=web, starting server...")
+        threading.Thread(target=start_server, args=(create_app(),)).start()
+    elif os.environ["PROC_TYPE"] == "worker":
+        print("PROC_TYPE=worker, starting polling...")
+        import worker
+        worker.start_worker()
+    else:
+        print("INVALID WORKER TYPE")
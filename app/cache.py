@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, name, max_size, ttl_seconds=None):
+        """ Constructor for a thread-safe, size-bounded LRU cache whose entries optionally expire
+        :param name: Name of the cache, used for its hit/miss metrics (cache.<name>.hit etc.)
+        :param max_size: The maximum number of entries; the least recently used entry is evicted past this
+        :param ttl_seconds: (optional) How long an entry stays valid, or None for entries that never expire
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Returns the cached value for a key, counting a hit or a miss
+        :param key: The key to look up
+        :param default: The value to return if the key isn't cached (or has expired)
+        :return: The cached value or the default
+        """
+        with self.__lock:
+            value = self.__get_locked(key)
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if value is _MISSING:
+            metrics.incr("cache.%s.miss" % self.name, 1)
+            return default
+        metrics.incr("cache.%s.hit" % self.name, 1)
+        return value
+
+    def set(self, key, value, ttl_seconds=None):
+        """ Caches a value, evicting the least recently used entry if the cache is full
+        :param key: The key to cache the value under
+        :param value: The value
+        :param ttl_seconds: (optional) Overrides the cache-wide TTL for this entry
+        """
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        expires_at = None if ttl_seconds is None else time.monotonic() + ttl_seconds
+        evicted = 0
+        with self.__lock:
+            self.__entries[key] = (value, expires_at)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+
+        if evicted > 0:
+            metrics.incr("cache.%s.eviction" % self.name, evicted)
+
+    def invalidate(self, key):
+        """ Removes a key from the cache, if present
+        :param key: The key to remove
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self.__lock:
+            self.__entries.clear()
+
+    def __contains__(self, key):
+        with self.__lock:
+            return self.__get_locked(key, touch=False) is not _MISSING
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def __get_locked(self, key, touch=True):
+        entry = self.__entries.get(key, None)
+        if entry is None:
+            return _MISSING
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.__entries[key]
+            return _MISSING
+
+        if touch:
+            self.__entries.move_to_end(key)
+        return value
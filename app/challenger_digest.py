@@ -0,0 +1,157 @@
+import json
+import time
+
+from metrics import metrics
+
+
+class ChallengerDigest:
+    # The most players we name in one digest, so it fits in a tweet
+    MAX_NAMED_PLAYERS = 5
+
+    # Redis keys: the puzzles with pending entries (by when their oldest pending entry was added), each puzzle's
+    # entries (entry id -> JSON) and when each of them was added, and the counter entry ids come from
+    PUZZLES_KEY = "challenger_digest:puzzles"
+    ENTRIES_KEY = "challenger_digest:entries:%s"
+    ADDED_KEY = "challenger_digest:added:%s"
+    NEXT_ID_KEY = "challenger_digest:next_id"
+
+    # Removes entries (ARGV[2], ...) from puzzle ARGV[1], then moves the puzzle's window to start at its oldest
+    # remaining entry, or drops the puzzle if there aren't any
+    REMOVE_SCRIPT = """
+        for i = 2, #ARGV do
+            redis.call("HDEL", KEYS[1], ARGV[i])
+            redis.call("ZREM", KEYS[2], ARGV[i])
+        end
+        local oldest = redis.call("ZRANGE", KEYS[2], 0, 0, "WITHSCORES")
+        if #oldest == 0 then
+            redis.call("ZREM", KEYS[3], ARGV[1])
+        else
+            redis.call("ZADD", KEYS[3], oldest[2], ARGV[1])
+        end
+        return 1
+    """
+
+    def __init__(self, redis_client, window_seconds=15 * 60, max_age_seconds=6 * 60 * 60):
+        """ Constructor for the digest of new leaderboard entries that we post on each puzzle's original thread
+            ("new challengers"), one reply per puzzle per window rather than one per submission.  Entries are kept in
+            redis until they've been posted, so a restart (or a new dyno) doesn't lose them.
+        :param redis_client: The redis client
+        :param window_seconds: (optional) How long after a puzzle's first pending entry we post its digest
+        :param max_age_seconds: (optional) How long we keep retrying a digest that fails to post before dropping it
+            (its videos will have expired by then anyway)
+        """
+        self.redis = redis_client
+        self.window_seconds = window_seconds
+        self.max_age_seconds = max_age_seconds
+        self.__remove = redis_client.register_script(self.REMOVE_SCRIPT)
+
+    def add(self, puzzle_id, player_name, time_seconds, char_count, media_ids):
+        """ Adds a new leaderboard entry to its puzzle's next digest
+        :param puzzle_id: The ID of the puzzle
+        :param player_name: The twitter handle of the player
+        :param time_seconds: The player's time
+        :param char_count: The player's character count
+        :param media_ids: The twitter media IDs of the player's gameplay video, or None
+        """
+        entry_id = self.redis.incr(self.NEXT_ID_KEY)
+        added_at = time.time()
+        entry = {"player_name": player_name, "time": time_seconds, "char_count": char_count, "media_ids": media_ids,
+                 "added_at": added_at}
+        pipeline = self.redis.pipeline()
+        pipeline.hset(self.ENTRIES_KEY % puzzle_id, entry_id, json.dumps(entry))
+        pipeline.zadd(self.ADDED_KEY % puzzle_id, {entry_id: added_at})
+        pipeline.zadd(self.PUZZLES_KEY, {puzzle_id: added_at}, nx=True)
+        pipeline.execute()
+        metrics.incr("challengers.digest.added", 1)
+
+    def get_due_puzzle_ids(self):
+        """ Returns the puzzles whose digest window has ended
+        :return: A list of puzzle IDs
+        """
+        return self.redis.zrangebyscore(self.PUZZLES_KEY, "-inf", time.time() - self.window_seconds)
+
+    def get_entries(self, puzzle_id):
+        """ Returns a puzzle's pending entries, best (fastest, then shortest) first
+        :param puzzle_id: The ID of the puzzle
+        :return: A list of dicts with id, puzzle_id, player_name, time, char_count, media_ids and added_at
+        """
+        entries = []
+        for entry_id, entry_json in self.redis.hgetall(self.ENTRIES_KEY % puzzle_id).items():
+            entry = json.loads(entry_json)
+            entry["id"] = int(entry_id)
+            entry["puzzle_id"] = puzzle_id
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: (entry["time"], entry["char_count"], entry["id"]))
+
+    def remove(self, entries):
+        """ Removes entries that have been posted (or given up on)
+        :param entries: Entries of one puzzle, as returned by get_entries
+        """
+        if len(entries) == 0:
+            return
+        puzzle_id = entries[0]["puzzle_id"]
+        self.__remove(keys=[self.ENTRIES_KEY % puzzle_id, self.ADDED_KEY % puzzle_id, self.PUZZLES_KEY],
+                      args=[puzzle_id] + [entry["id"] for entry in entries])
+
+    def flush_due(self, post):
+        """ Posts the digest of every puzzle whose window has ended
+        :param post: A function that posts a digest, given the puzzle ID, the message and the media IDs to attach
+        :return: How many digests were posted
+        """
+        posted = 0
+        for puzzle_id in self.get_due_puzzle_ids():
+            entries = self.get_entries(puzzle_id)
+            if len(entries) == 0:
+                continue
+
+            try:
+                post(puzzle_id, self.format_message(entries), self.best_media_ids(entries))
+                self.remove(entries)
+                metrics.incr("challengers.digest.posted", 1)
+                metrics.timing("challengers.digest.entries", len(entries))
+                posted += 1
+            except Exception as e:
+                metrics.incr("error.challengers.digest", 1)
+                print("Failed to post new challenger digest for %s: %s" % (puzzle_id, e))
+                expired = [entry for entry in entries if entry["added_at"] < time.time() - self.max_age_seconds]
+                if len(expired) > 0:
+                    print("Dropping %d new challengers for %s that we've failed to post for too long" % (
+                        len(expired), puzzle_id))
+                    self.remove(expired)
+        return posted
+
+    @staticmethod
+    def best_media_ids(entries):
+        """ Returns the gameplay video of the best entry that has one
+        :param entries: Entries, best first
+        :return: A list of media IDs, or None
+        """
+        for entry in entries:
+            if entry["media_ids"] is not None:
+                return entry["media_ids"]
+        return None
+
+    @staticmethod
+    def format_message(entries):
+        """ Returns the digest reply for a puzzle's new entries
+        :param entries: Entries, best first
+        :return: The text of the reply
+        """
+        if len(entries) == 1:
+            return "We've just gotten a new submission in from {}! Can you beat them?".format(entries[0]["player_name"])
+
+        names = []
+        for entry in entries:
+            if entry["player_name"] not in names:
+                names.append(entry["player_name"])
+        if len(names) > ChallengerDigest.MAX_NAMED_PLAYERS:
+            named = ", ".join(names[:ChallengerDigest.MAX_NAMED_PLAYERS]) + \
+                    " and %d others" % (len(names) - ChallengerDigest.MAX_NAMED_PLAYERS)
+        elif len(names) > 1:
+            named = ", ".join(names[:-1]) + " and " + names[-1]
+        else:
+            named = names[0]
+        best = entries[0]
+        return "We've just gotten {} new submissions in from {}! {} leads with a time of {:f} and a character count " \
+               "of {}. Can you beat them?".format(len(entries), named, best["player_name"], best["time"],
+                                                  best["char_count"])
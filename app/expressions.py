@@ -0,0 +1,105 @@
+import hashlib
+import re
+import threading
+
+from metrics import metrics
+
+# LaTeX spacing commands, and plain whitespace, none of which change what an expression means.  A control word (like
+# \sin) is matched along with any spacing after it, since that spacing is what ends the word: "\sin x" is not "\sinx".
+_SPACING = re.compile(r"(?P<word>\\[A-Za-z]+)?(?:\\[ ,:;!]|~|\s)+")
+_LETTER = re.compile(r"[A-Za-z]")
+# \left( ... \right) etc. are just sized brackets
+_SIZED_BRACKETS = re.compile(r"\\(?:left|right)(?=[()\[\]|.]|\\[{}])")
+_EMPTY_SIZED_BRACKETS = re.compile(r"\\(?:left|right)\.")
+# A number added and then subtracted again (or the other way around), like the "+N-N" post_test_tweets appends.
+# It has to follow an operand (and not \cdot etc.), and be followed by the end of a term, so that e.g. "+5-5x" or
+# "x^+5-5" aren't touched.
+_NUMBER = r"(?:\d+\.?\d*|\.\d+)"
+_NO_OP_TERMS = re.compile(r"(?<=[A-Za-z0-9)}\]|!])(?<!\\cdot)(?<!\\times)"
+                          r"(?:\+(?P<a>%s)-(?P=a)|-(?P<b>%s)\+(?P=b))(?![\d.])(?=$|[+\-)}\]|])" % (_NUMBER, _NUMBER))
+
+
+def _strip_spacing(match):
+    """ Removes a run of spacing, keeping a single space after a control word if a letter follows it """
+    word = match.group("word")
+    if word is None:
+        return ""
+    if _LETTER.match(match.string, match.end()):
+        return word + " "
+    return word
+
+
+def canonicalize(expression):
+    """ Returns a canonical form of a submitted expression, so that submissions that only differ in spacing,
+        \\left / \\right brackets or no-op "+N-N" terms compare equal.  This never changes what the expression
+        evaluates to.
+    :param expression: A sinerider graph expression (LaTeX)
+    :return: The canonical form of the expression
+    """
+    canonical = _SPACING.sub(_strip_spacing, expression)
+    canonical = _EMPTY_SIZED_BRACKETS.sub("", canonical)
+    canonical = _SIZED_BRACKETS.sub("", canonical)
+
+    # Removing one no-op term can line up another, e.g. "x+1+2-2-1"
+    while True:
+        reduced = _NO_OP_TERMS.sub("", canonical)
+        if reduced == canonical:
+            break
+        canonical = reduced
+
+    if canonical.startswith("+"):
+        canonical = canonical[1:]
+    return canonical
+
+
+class ExpressionIndex:
+    def __init__(self):
+        """ Constructor for an in-memory index of the canonical expressions on each level's leaderboard, mapped to
+            their leaderboard record ids.  Only a fixed-size hash of each (level, expression) is kept.  Filled in by
+            SubmissionIndex, as part of its scans of the Leaderboard table, and as new entries are added.
+        """
+        self.__record_ids = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(level, expression):
+        """ Returns the fingerprint that a submission is indexed under
+        :param level: The level (puzzle name) of the submission
+        :param expression: The submitted expression (canonicalized here)
+        :return: 16 bytes
+        """
+        key = "%s\0%s" % (level, canonicalize(expression))
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def add(self, level, expression, record_id):
+        """ Records that an expression has been scored for a level
+        :param level: The level (puzzle name) of the submission
+        :param expression: The submitted expression
+        :param record_id: The airtable record id of its leaderboard entry
+        """
+        with self.__lock:
+            self.__record_ids.setdefault(self.fingerprint(level, expression), record_id)
+
+    def remove(self, record_id):
+        """ Removes a leaderboard entry that's been deleted from the Leaderboard table.  Looks through the whole
+            index, but this only happens when we come across a deleted entry.
+        :param record_id: The airtable record id of the leaderboard entry
+        """
+        with self.__lock:
+            for fingerprint in [fingerprint for fingerprint, indexed_record_id in self.__record_ids.items()
+                                if indexed_record_id == record_id]:
+                del self.__record_ids[fingerprint]
+
+    def find(self, level, expression):
+        """ Returns the leaderboard record id of an equivalent expression scored for the same level
+        :param level: The level (puzzle name) of the submission
+        :param expression: The submitted expression
+        :return: A record id, or None
+        """
+        record_id = self.__record_ids.get(self.fingerprint(level, expression), None)
+        if record_id is not None:
+            metrics.incr("scoring.renders_avoided", 1)
+        return record_id
+
+    def __len__(self):
+        return len(self.__record_ids)
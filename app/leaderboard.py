@@ -0,0 +1,166 @@
+import threading
+
+from sortedcontainers import SortedList
+
+from metrics import metrics
+
+
+class Leaderboards:
+    # The Leaderboard table fields we read
+    FIELDS = ["level", "time", "charCount", "player"]
+
+    def __init__(self):
+        """ Constructor for an in-memory copy of every level's leaderboard, each sorted by time and then character
+            count, so that a rank can be looked up without scanning the Leaderboard table.  Adding an entry and
+            looking up a rank are both O(log n).  Entries without a time (disqualified submissions) aren't ranked.
+            Filled in by SubmissionIndex, as part of its scans of the Leaderboard table, and rebuilt by its periodic
+            full scans (see start_reload), which is how entries deleted from the table are dropped.
+        """
+        self.loaded = False
+        # level -> SortedList of (time, charCount, record id)
+        self.__levels = {}
+        # level -> how many times it's changed, for ETags
+        self.__versions = {}
+        # record id -> (level, time, charCount, player)
+        self.__entries = {}
+        # record id -> entry (or None if it was removed) for changes made while a reload is scanning the table, which
+        # the scan may have missed; None when not reloading
+        self.__changes_during_reload = None
+        self.__lock = threading.Lock()
+
+    def add(self, record_id, level, time, char_count, player):
+        """ Adds an entry to its level's leaderboard, unless it's already there
+        :param record_id: The airtable record id of the entry
+        :param level: The level (puzzle) name
+        :param time: The entry's time, or None if it was disqualified
+        :param char_count: The entry's character count
+        :param player: The player's name
+        :return: True if the entry was added
+        """
+        if time is None or char_count is None or level is None:
+            return False
+
+        with self.__lock:
+            if self.__changes_during_reload is not None:
+                self.__changes_during_reload[record_id] = (level, time, char_count, player)
+            if record_id in self.__entries:
+                return False
+            self.__entries[record_id] = (level, time, char_count, player)
+            self.__levels.setdefault(level, SortedList()).add((time, char_count, record_id))
+            self.__versions[level] = self.__versions.get(level, 0) + 1
+        return True
+
+    def remove(self, record_id):
+        """ Removes an entry that's been deleted from the Leaderboard table
+        :param record_id: The airtable record id of the entry
+        :return: True if the entry was removed
+        """
+        with self.__lock:
+            if self.__changes_during_reload is not None:
+                self.__changes_during_reload[record_id] = None
+            entry = self.__entries.pop(record_id, None)
+            if entry is None:
+                return False
+            level, time, char_count, _ = entry
+            self.__levels[level].remove((time, char_count, record_id))
+            if len(self.__levels[level]) == 0:
+                del self.__levels[level]
+            self.__versions[level] = self.__versions.get(level, 0) + 1
+        return True
+
+    def add_row(self, row):
+        """ Adds a row of the Leaderboard table
+        :param row: The row, with at least FIELDS
+        :return: True if the entry was added
+        """
+        fields = row["fields"]
+        return self.add(row["id"], fields.get("level", None), fields.get("time", None),
+                        fields.get("charCount", None), fields.get("player", None))
+
+    def start_reload(self):
+        """ Starts rebuilding the leaderboards from a full scan of the Leaderboard table.  Entries added and removed
+            here until finish_reload are carried over to the rebuilt leaderboards.
+        :return: Empty Leaderboards to add the scanned rows to
+        """
+        with self.__lock:
+            self.__changes_during_reload = {}
+        return Leaderboards()
+
+    def finish_reload(self, reloaded):
+        """ Replaces the leaderboards with rebuilt ones, dropping entries that are no longer in the table.  Levels
+            whose entries haven't changed keep their version.
+        :param reloaded: The Leaderboards returned by start_reload, with every row of the table added
+        """
+        with self.__lock:
+            for record_id, entry in self.__changes_during_reload.items():
+                if entry is None:
+                    reloaded.remove(record_id)
+                else:
+                    reloaded.add(record_id, *entry)
+            self.__changes_during_reload = None
+
+            for level in set(self.__levels) | set(reloaded.__levels):
+                if self.__levels.get(level, None) != reloaded.__levels.get(level, None):
+                    self.__versions[level] = self.__versions.get(level, 0) + 1
+            self.__levels = reloaded.__levels
+            self.__entries = reloaded.__entries
+
+    def cancel_reload(self):
+        """ Gives up on a reload, e.g. after its scan failed """
+        with self.__lock:
+            self.__changes_during_reload = None
+
+    def mark_loaded(self):
+        """ Records that every existing entry has been added, so ranks are meaningful """
+        self.loaded = True
+        metrics.gauge("leaderboards.entries", len(self.__entries))
+
+    def rank(self, level, time, char_count):
+        """ Returns where an entry with a given time and character count ranks on a level's leaderboard.  Entries that
+            tie share a rank.
+        :param level: The level name
+        :param time: The time
+        :param char_count: The character count
+        :return: (rank, starting at 1, number of entries on the leaderboard)
+        """
+        with self.__lock:
+            entries = self.__levels.get(level, None)
+            if entries is None:
+                return 1, 0
+            # Note - (time, char_count) sorts before every (time, char_count, record id), so this counts the entries
+            # that are strictly better
+            return entries.bisect_left((time, char_count)) + 1, len(entries)
+
+    def get_version(self, level):
+        """ Returns how many times a level's leaderboard has changed, which changes whenever its contents do
+        :param level: The level name
+        :return: A number, 0 for a level with no entries
+        """
+        return self.__versions.get(level, 0)
+
+    def get_top(self, level, limit):
+        """ Returns the best entries on a level's leaderboard
+        :param level: The level name
+        :param limit: The most entries to return
+        :return: (The level's version, how many entries it has, a list of dicts with rank, player, time and charCount,
+            best first)
+        """
+        with self.__lock:
+            entries = self.__levels.get(level, None)
+            version = self.__versions.get(level, 0)
+            if entries is None:
+                return version, 0, []
+
+            top = []
+            rank = 0
+            previous = None
+            for position, (time, char_count, record_id) in enumerate(entries.islice(0, limit)):
+                if (time, char_count) != previous:
+                    rank = position + 1
+                    previous = (time, char_count)
+                top.append({"rank": rank, "player": self.__entries[record_id][3], "time": time,
+                            "charCount": char_count})
+            return version, len(entries), top
+
+    def __len__(self):
+        return len(self.__entries)
@@ -0,0 +1,212 @@
+""" LZ-String compression (https://pieroxy.net/blog/pages/lz-string/index.html), as used to encode puzzle definitions
+    into SineRider URLs.  The output is identical to the lzstring package's LZString.compressToBase64 and
+    decompressFromBase64, but the codes are packed into and out of the base64 characters a whole code at a time
+    (rather than a bit at a time), with lookup tables for the base64 alphabet.
+"""
+
+_BASE64_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+
+
+def _reverse_6_bits(value):
+    return int("{:06b}".format(value)[::-1], 2)
+
+
+# LZ-String writes each base64 character most significant bit first, but each code least significant bit first.  We
+# keep the bit stream least significant bit first, so a 6 bit chunk of it is a base64 digit with its bits reversed.
+_CHUNK_TO_BASE64 = bytes(ord(_BASE64_ALPHABET[_reverse_6_bits(i)]) if i < 64 else 0 for i in range(256))
+# ...and the other way around.  "=" counts as a zero digit (as in the lzstring package); anything that isn't part of
+# the alphabet maps to _INVALID.
+_INVALID = 0xFF
+_BASE64_TO_CHUNK = bytearray([_INVALID] * 256)
+for _digit, _char in enumerate(_BASE64_ALPHABET):
+    _BASE64_TO_CHUNK[ord(_char)] = _reverse_6_bits(_digit & 63)
+_BASE64_TO_CHUNK = bytes(_BASE64_TO_CHUNK)
+
+
+def compress_to_base64(uncompressed):
+    """ Compresses a string into LZ-String's base64 format
+    :param uncompressed: The string to compress
+    :return: The compressed string (padded to a multiple of 4 characters), or "" if 'uncompressed' is None
+    """
+    if uncompressed is None:
+        return ""
+
+    chunks = bytearray()
+    bit_buffer = 0
+    bit_count = 0
+
+    def write(value, width):
+        nonlocal bit_buffer, bit_count
+        bit_buffer |= value << bit_count
+        bit_count += width
+        while bit_count >= 6:
+            chunks.append(bit_buffer & 63)
+            bit_buffer >>= 6
+            bit_count -= 6
+
+    # Single characters get a code as soon as they're seen, but are written out as literals the first time they're
+    # used.  Longer phrases are keyed by (code of the phrase minus its last character, last character).
+    char_codes = {}
+    unwritten_chars = set()
+    phrase_codes = {}
+    dict_size = 3
+    num_bits = 2
+    enlarge_in = 2
+
+    w_code = None
+    w_char = None
+    for c in uncompressed:
+        c_code = char_codes.get(c, None)
+        if c_code is None:
+            c_code = char_codes[c] = dict_size
+            dict_size += 1
+            unwritten_chars.add(c)
+
+        if w_code is None:
+            w_code = c_code
+            w_char = c
+            continue
+
+        phrase_key = (w_code << 21) | ord(c)
+        phrase_code = phrase_codes.get(phrase_key, None)
+        if phrase_code is not None:
+            w_code = phrase_code
+            w_char = None
+            continue
+
+        if w_char is not None and w_char in unwritten_chars:
+            value = ord(w_char)
+            if value < 256:
+                write(value << num_bits, num_bits + 8)
+            else:
+                write(1 | ((value & 0xFFFF) << num_bits), num_bits + 16)
+            enlarge_in -= 1
+            if enlarge_in == 0:
+                enlarge_in = 1 << num_bits
+                num_bits += 1
+            unwritten_chars.discard(w_char)
+        else:
+            write(w_code, num_bits)
+
+        enlarge_in -= 1
+        if enlarge_in == 0:
+            enlarge_in = 1 << num_bits
+            num_bits += 1
+
+        phrase_codes[phrase_key] = dict_size
+        dict_size += 1
+        w_code = c_code
+        w_char = c
+
+    if w_code is not None:
+        if w_char is not None and w_char in unwritten_chars:
+            value = ord(w_char)
+            if value < 256:
+                write(value << num_bits, num_bits + 8)
+            else:
+                write(1 | ((value & 0xFFFF) << num_bits), num_bits + 16)
+            enlarge_in -= 1
+            if enlarge_in == 0:
+                enlarge_in = 1 << num_bits
+                num_bits += 1
+        else:
+            write(w_code, num_bits)
+
+    enlarge_in -= 1
+    if enlarge_in == 0:
+        num_bits += 1
+
+    # End of stream marker, then whatever bits are left over, padded out to a whole character (which may be all
+    # padding)
+    write(2, num_bits)
+    chunks.append(bit_buffer)
+
+    compressed = chunks.translate(_CHUNK_TO_BASE64).decode("ascii")
+    return compressed + "=" * (-len(compressed) % 4)
+
+
+def decompress_from_base64(compressed):
+    """ Decompresses a string from LZ-String's base64 format
+    :param compressed: The compressed string
+    :return: The decompressed string, "" if 'compressed' is None, or None if 'compressed' is empty or refers to a
+        phrase that doesn't exist
+    :raises ValueError: If 'compressed' is truncated or contains characters outside the base64 alphabet
+    """
+    if compressed is None:
+        return ""
+    if compressed == "":
+        return None
+
+    chunks = compressed.encode("ascii", "replace").translate(_BASE64_TO_CHUNK)
+    # The lzstring package reads a character ahead, so it fails as soon as the bit before the end of the data (or
+    # before an invalid character) has been read.  Stop at the same point, so that the two agree on what's valid.
+    valid_length = chunks.find(_INVALID)
+    if valid_length < 0:
+        valid_length = len(chunks)
+    bit_limit = valid_length * 6
+
+    bit_buffer = 0
+    bit_count = 0
+    position = 0
+
+    def read(width):
+        nonlocal bit_buffer, bit_count, position
+        while bit_count < width:
+            if position >= valid_length:
+                raise ValueError("Truncated or invalid LZ-String data")
+            bit_buffer |= chunks[position] << bit_count
+            bit_count += 6
+            position += 1
+        value = bit_buffer & ((1 << width) - 1)
+        bit_buffer >>= width
+        bit_count -= width
+        if position * 6 - bit_count >= bit_limit:
+            raise ValueError("Truncated or invalid LZ-String data")
+        return value
+
+    code = read(2)
+    if code == 0:
+        c = chr(read(8))
+    elif code == 1:
+        c = chr(read(16))
+    elif code == 2:
+        return ""
+    else:
+        raise ValueError("Invalid LZ-String data")
+
+    dictionary = [None, None, None, c]
+    w = c
+    result = [c]
+    num_bits = 3
+    enlarge_in = 4
+    while True:
+        code = read(num_bits)
+        if code == 0:
+            code = len(dictionary)
+            dictionary.append(chr(read(8)))
+            enlarge_in -= 1
+        elif code == 1:
+            code = len(dictionary)
+            dictionary.append(chr(read(16)))
+            enlarge_in -= 1
+        elif code == 2:
+            return "".join(result)
+
+        if enlarge_in == 0:
+            enlarge_in = 1 << num_bits
+            num_bits += 1
+
+        if code < len(dictionary):
+            entry = dictionary[code]
+        elif code == len(dictionary):
+            entry = w + w[0]
+        else:
+            return None
+        result.append(entry)
+
+        dictionary.append(w + entry[0])
+        enlarge_in -= 1
+        w = entry
+        if enlarge_in == 0:
+            enlarge_in = 1 << num_bits
+            num_bits += 1
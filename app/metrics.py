@@ -1,5 +1,11 @@
+import atexit
+import functools
 import os
+import threading
+import time
+
 import statsd
+from statsd.client.timer import Timer
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,7 +14,142 @@ environment = os.environ.get("PYTHON_ENV")
 graphite = os.environ.get("GRAPHITE")
 proc_type = os.environ.get("PROC_TYPE")
 
-if graphite is None:
-    raise ValueError("Graphite host not configured!")
+# How often buffered metrics are sent, and how many we'll buffer before sending them early
+METRICS_FLUSH_INTERVAL_SECONDS = float(os.environ.get("METRICS_FLUSH_INTERVAL_SECONDS", "1"))
+METRICS_MAX_BUFFERED = int(os.environ.get("METRICS_MAX_BUFFERED", "100"))
+
+
+class BufferedStatsClient(statsd.StatsClient):
+    def __init__(self, host, port=8125, prefix=None, maxudpsize=512, flush_interval_seconds=1, max_buffered=100):
+        """ Constructor for a statsd client that buffers metrics and sends them in as few UDP packets as possible
+            (each up to maxudpsize bytes), every flush_interval_seconds or once max_buffered metrics are waiting.
+            Timers (metrics.timer(...)) work as context managers and decorators, as with the plain statsd client.
+        :param host: The statsd host
+        :param port: (optional) The statsd port
+        :param prefix: (optional) Prefix for every stat name
+        :param maxudpsize: (optional) The largest packet to send
+        :param flush_interval_seconds: (optional) The longest a metric is buffered for
+        :param max_buffered: (optional) How many metrics to buffer before sending them early
+        """
+        super().__init__(host, port, prefix=prefix, maxudpsize=maxudpsize)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_buffered = max_buffered
+        self.__buffer = []
+        self.__buffer_lock = threading.Lock()
+        self.__flush_thread = threading.Thread(target=self.__flush_periodically, daemon=True)
+        self.__flush_thread.start()
+        atexit.register(self.flush)
+
+    def _send(self, data):
+        with self.__buffer_lock:
+            self.__buffer.append(data)
+            buffer_full = len(self.__buffer) >= self.max_buffered
+
+        if buffer_full:
+            self.flush()
+
+    def flush(self):
+        """ Sends every buffered metric now """
+        with self.__buffer_lock:
+            buffered = self.__buffer
+            self.__buffer = []
+
+        packet = None
+        for data in buffered:
+            if packet is None:
+                packet = data
+            elif len(packet) + len(data) + 1 >= self._maxudpsize:
+                super()._send(packet)
+                packet = data
+            else:
+                packet += "\n" + data
+        if packet is not None:
+            super()._send(packet)
+
+    def __flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval_seconds)
+            self.flush()
+
+
+class LazyStatsClient:
+    def __init__(self, build):
+        """ Constructor for a stand-in for a statsd client, which builds the client the first time a metric is sent,
+            so that importing this module doesn't need graphite configured, open a socket or start a flush thread
+        :param build: A function that builds the client
+        """
+        self.__build = build
+        self.__client = None
+        self.__lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self.__client is None:
+            with self.__lock:
+                if self.__client is None:
+                    self.__client = self.__build()
+        return getattr(self.__client, name)
+
+    def timer(self, stat, rate=1):
+        # Note - timers are made when decorated functions are defined, so this mustn't build the client
+        return Timer(self, stat, rate)
+
+
+class ApiCallCounter:
+    # The APIs we count calls to
+    APIS = ["airtable", "twitter"]
+
+    def __init__(self, metrics_client):
+        """ Constructor for a counter of the HTTP calls made to each API (via response hooks on their sessions), both
+            in total and per unit of work, e.g. per work item scored.  Calls are attributed to whatever is being
+            counted on the thread that made them.
+        :param metrics_client: The statsd client to report to
+        """
+        self.metrics = metrics_client
+        self.__local = threading.local()
+
+    def response_hook(self, api):
+        """ Returns a requests response hook that counts a session's calls
+        :param api: The API the session calls, one of APIS
+        :return: A function suitable for session.hooks["response"]
+        """
+        def hook(response, *args, **kwargs):
+            self.metrics.incr("api.%s.calls" % api, 1)
+            counts = getattr(self.__local, "counts", None)
+            if counts is not None:
+                counts[api] = counts.get(api, 0) + 1
+        return hook
+
+    def counted(self, stat):
+        """ Decorator that reports how many calls to each API a function made, as the distributions
+            "<stat>.airtable_calls" etc. (sent as timers, which is how statsd keeps distributions)
+        :param stat: The stat name to report under
+        :return: A decorator
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapped(*args, **kwargs):
+                outer_counts = getattr(self.__local, "counts", None)
+                counts = self.__local.counts = {}
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.__local.counts = outer_counts
+                    for api in self.APIS:
+                        self.metrics.timing("%s.%s_calls" % (stat, api), counts.get(api, 0))
+                        if outer_counts is not None:
+                            outer_counts[api] = outer_counts.get(api, 0) + counts.get(api, 0)
+            return wrapped
+        return decorator
+
+
+def build_metrics_client():
+    if graphite is None:
+        raise ValueError("Graphite host not configured!")
+
+    return BufferedStatsClient(graphite, 8125, prefix=f'{environment}.sinerider-twitter-bot.{proc_type}.',
+                               flush_interval_seconds=METRICS_FLUSH_INTERVAL_SECONDS,
+                               max_buffered=METRICS_MAX_BUFFERED)
+
 
-metrics = statsd.StatsClient(graphite, 8125, prefix=f'{environment}.sinerider-twitter-bot.{proc_type}.')
+metrics = LazyStatsClient(build_metrics_client)
+api_calls = ApiCallCounter(metrics)
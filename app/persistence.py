@@ -1,18 +1,67 @@
+from datetime import datetime, timedelta
+
 from pyairtable import Table
-from pyairtable.formulas import EQUAL, AND, IF, FIELD, to_airtable_value
-from metrics import metrics
+from pyairtable.formulas import EQUAL, OR, FIELD, to_airtable_value
+from requests import HTTPError
+from metrics import metrics, api_calls
+from cache import TTLCache
+from airtable_governor import AirtableGovernor, GovernedSession, SharedTokenBucket
+from submission_index import SubmissionIndex
+from leaderboard import Leaderboards
+from expressions import ExpressionIndex
+from work_queue import AirtableWorkQueue, SqliteWorkQueue
+from airtable_formulas import CREATED_AFTER, parse_created_time, format_airtable_time, AIRTABLE_TIME_FORMAT
 
 
 class Persistence:
-    def __init__(self, airtable_api_key, airtable_base_id):
+    # We only ingest tweets less than a day old, so two work items for the same tweet are always created within
+    # this window of each other.  The duplicate scan only needs to remember tweets this recent.
+    DUPLICATE_SCAN_WINDOW = timedelta(days=2)
+    # Each scan re-reads a little before the cursor, in case rows were still being written during the last scan
+    DUPLICATE_SCAN_OVERLAP = timedelta(minutes=5)
+
+    def __init__(self, airtable_api_key, airtable_base_id, config_cache_ttl_seconds=300, config_cache_size=256,
+                 work_queue_backend="airtable", work_queue_sqlite_path="work_queue.db", mirror_work_queue=True,
+                 airtable_requests_per_second=5, redis_client=None):
         """ Constructor
         :param airtable_api_key: API key for airtable
         :param airtable_base_id: Base ID for airtable
+        :param config_cache_ttl_seconds: (optional) How long a config value read from airtable is cached for
+        :param config_cache_size: (optional) The maximum number of config values to cache
+        :param work_queue_backend: (optional) Where the work queue is kept, "airtable" or "sqlite"
+        :param work_queue_sqlite_path: (optional) Path of the SQLite database, for the "sqlite" work queue backend
+        :param mirror_work_queue: (optional) Whether the "sqlite" work queue backend copies work items to airtable
+        :param airtable_requests_per_second: (optional) How many airtable requests we make per second, at most (see
+            AirtableGovernor).  With a redis client this is shared by every process, otherwise it's this process's share
+        :param redis_client: (optional) Redis client, used to share the airtable rate limit between processes
         """
         self.work_queue_table = Table(airtable_api_key, airtable_base_id, "TwitterWorkQueue")
         self.leaderboard_table = Table(airtable_api_key, airtable_base_id, "Leaderboard")
         self.config_table = Table(airtable_api_key, airtable_base_id, "Config")
         self.puzzle_table = Table(airtable_api_key, airtable_base_id, "Puzzles")
+        # Every table's requests go through the one governor, since airtable's rate limit is for the whole base
+        shared_bucket = SharedTokenBucket(redis_client, "airtable:%s:rate_limit" % airtable_base_id,
+                                          airtable_requests_per_second) if redis_client is not None else None
+        self.governor = AirtableGovernor(airtable_requests_per_second, shared_bucket=shared_bucket)
+        for table in [self.work_queue_table, self.leaderboard_table, self.config_table, self.puzzle_table]:
+            session = GovernedSession(self.governor)
+            session.headers.update(table.session.headers)
+            session.hooks["response"].append(api_calls.response_hook("airtable"))
+            table.session = session
+        self.config_cache = TTLCache("config", config_cache_size, config_cache_ttl_seconds)
+        if work_queue_backend == "sqlite":
+            mirror = AirtableWorkQueue(self) if mirror_work_queue else None
+            self.work_queue = SqliteWorkQueue(work_queue_sqlite_path, mirror)
+        elif work_queue_backend == "airtable":
+            self.work_queue = AirtableWorkQueue(self)
+        else:
+            raise ValueError("Unknown work queue backend: %s" % work_queue_backend)
+        self.leaderboards = Leaderboards()
+        self.expression_index = ExpressionIndex()
+        self.submission_index = SubmissionIndex(self.leaderboard_table, self.leaderboards, self.expression_index)
+        # tweetId -> (record id, completed, created time) of work items seen by the duplicate scan
+        self.duplicate_scan_seen = {}
+        self.duplicate_scan_cursor = None
 
     def config_exists(self, key):
         """ Checks whether a config exists with a given key
@@ -21,66 +70,91 @@ class Persistence:
         """
         return self.get_one_row(self.config_table, key, None) is not None
 
-    def get_config(self, key, default):
-        """ Gets a config associated with the key
+    def get_config(self, key, default, cached=True):
+        """ Gets a config associated with the key.  Values are cached for a while; missing keys are not, since
+            they may be created by another process (e.g. the web dyno publishing a puzzle)
         :param key: The key whose value you want
         :param default: The default value to return if the key didn't exist
+        :param cached: (optional) Set to False to always read the value from airtable, e.g. for values that another
+            process changes
         :return: The value associated with the key or the default value
         """
+        if cached:
+            cached_value = self.config_cache.get(key, None)
+            if cached_value is not None:
+                return cached_value
+
         val = self.get_one_row(self.config_table, "config_name", key)
         if val is None:
             return default
-        return val["fields"]["value"]
 
-    def queue_work(self, tweetId, twitterHandle, puzzleId, expression):
+        value = val["fields"]["value"]
+        self.config_cache.set(key, value)
+        return value
+
+    def queue_work(self, tweetId, twitterHandle, puzzleId, expression, check_existing=True):
         """ Queues a user-submitted solution to the work queue for later processing
         :param tweetId: The ID of the tweet that was submitted
         :param twitterHandle: The twitter handle of the user that tweeted the submission
         :param puzzleId: The ID of the puzzle associated with the submission
         :param expression: The sinerider graph expression in the submission
+        :param check_existing: (optional) Set to False if the caller already checked the tweet isn't queued
         """
         print("queueing: %s %s %s %s" % (tweetId, twitterHandle, puzzleId, expression))
-        existing_submission = self.get_one_row(self.work_queue_table, "tweetId", tweetId)
-        if existing_submission is None:
-            self.work_queue_table.create(
-                {"tweetId": tweetId, "twitterHandle": twitterHandle, "puzzleId": puzzleId, "expression": expression,
-                "completed": False, "attempts": 0})
-        else: print(f"Dupicate submission with id {tweetId}... Skipping!")
-    
-    def increment_attempts_queued_work(self, tweet_id):
-        """ Increments the amount of times a piece of queued work as been attempted to be processed.
-        :param tweet_id: The tweet ID of the associated completed work.
-        :return: The newly-incremented number of attempts.
+        self.work_queue.queue_work(tweetId, twitterHandle, puzzleId, expression, check_existing)
+
+    def get_queued_tweet_ids(self, tweet_ids):
+        """ Returns which of the given tweets have already been queued, in as few requests as possible
+        :param tweet_ids: Tweet IDs to check
+        :return: A set of tweet IDs
+        """
+        return self.work_queue.get_queued_tweet_ids(tweet_ids)
+
+    def get_all_queued_work(self, page_size=100, max_rows=None):
+        """ Returns all queued non-completed work in the work queue (submissions to be scored and responded to), a
+            page at a time as they're read, so that work can start before the whole queue has been read
+        :param page_size: (optional) How many work items to read at once (at most 100 for airtable)
+        :param max_rows: (optional) The most work items to return in total, or None for all of them
+        :return: A generator of lists of QueuedWork items
         """
-        row = self.get_one_row(self.work_queue_table, "tweetId", tweet_id)
-        attempts = row["fields"]["attempts"] + 1
-        self.work_queue_table.update(row["id"], {"attempts": attempts})
-        return attempts
+        return self.work_queue.get_all_queued_work(page_size, max_rows)
 
-    def get_all_queued_work(self):
-        """ Returns all queued non-completed work in the work queue (submissions to be scored and responded to)
-        :return: A list of rows from the work queue table
+    def wait_for_queued_work(self, timeout):
+        """ Blocks until new work may have been queued.  With the airtable work queue this just waits out the
+            timeout, since we can't tell when another process queues work.
+        :param timeout: The most seconds to wait
         """
-        formula = AND(EQUAL(FIELD("completed"), to_airtable_value(0)), IF("{attempts} < 3", 1, 0))
-        return self.work_queue_table.all(formula=formula)
+        self.work_queue.wait_for_work(timeout)
 
     def get_one_row(self, table, fieldToMatch, value):
-        """ Returns one row from a table with an optional field to match, or None
+        """ Returns one row from a table with an optional field to match, or None.  Only asks airtable for a single
+            record, and lets airtable errors propagate so that they can't be mistaken for a missing row.
         :param table: The table you'd like to get a row from
         :param fieldToMatch: The field that you would like to match
         :param value: The value you'd like to look up in 'fieldToMatch'
         :return: One row from the table, or None
         """
         formula = EQUAL(FIELD(fieldToMatch), to_airtable_value(value))
-        try:
-            all_rows = table.all(formula=formula)
-            if len(all_rows) == 0:
-                return None
+        return table.first(formula=formula)
 
-            return all_rows[0]
-        except:
-            print("Shouldn't have happened!")
-        return None
+    def get_rows_by_keys(self, table, fieldToMatch, keys, chunk_size=25):
+        """ Looks up many rows at once, using one OR formula per chunk of keys instead of one request per key
+        :param table: The table you'd like to get rows from
+        :param fieldToMatch: The field that you would like to match
+        :param keys: The values you'd like to look up in 'fieldToMatch'
+        :param chunk_size: (optional) How many keys to put into each formula, which keeps request URLs short
+        :return: A dict of key -> row for every key that was found (keys that weren't found are left out)
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        rows_by_key = {}
+        for i in range(0, len(unique_keys), chunk_size):
+            chunk = unique_keys[i:i + chunk_size]
+            formula = OR(*[EQUAL(FIELD(fieldToMatch), to_airtable_value(key)) for key in chunk])
+            for row in table.all(formula=formula):
+                key = row["fields"].get(fieldToMatch, None)
+                if key not in rows_by_key:
+                    rows_by_key[key] = row
+        return rows_by_key
 
     def validate_puzzle_id(self, puzzle_id):
         """ Returns whether the given puzzle_id is valid
@@ -96,23 +170,31 @@ class Persistence:
             print("error validating puzzle id, probably failed to query airtable")
         return False
 
-    def complete_queued_work(self, tweet_id):
-        """ Marks a particular piece of work as completed.
-        :param tweet_id: The tweet ID of the associated completed work.
+    def complete_queued_work(self, work):
+        """ Marks a particular piece of work as completed.  With the airtable work queue the update is buffered until
+            the next flush.
+        :param work: The QueuedWork item that was completed
         """
-        print("Marking work item (tweetid: %s) complete" % (tweet_id))
-        row = self.get_one_row(self.work_queue_table, "tweetId", tweet_id)
-        self.work_queue_table.update(row["id"], {"completed": True})
+        print("Marking work item (tweetid: %s) complete" % (work.tweet_id))
+        self.work_queue.complete(work)
 
-    def increment_attempts_queued_work(self, tweet_id):
-        """ Increments the amount of times a piece of queued work as been attempted to be processed.
-        :param tweet_id: The tweet ID of the associated completed work.
+    def increment_attempts_queued_work(self, work):
+        """ Increments the amount of times a piece of queued work as been attempted to be processed.  With the
+            airtable work queue the update is buffered until the next flush.
+        :param work: The QueuedWork item being attempted
         :return: The newly-incremented number of attempts.
         """
-        row = self.get_one_row(self.work_queue_table, "tweetId", tweet_id)
-        attempts = row["fields"]["attempts"] + 1
-        self.work_queue_table.update(row["id"], {"attempts": attempts})
-        return attempts
+        return self.work_queue.increment_attempts(work)
+
+    def flush_queued_work_updates(self):
+        """ Writes all buffered work queue updates to airtable """
+        self.work_queue.flush()
+
+    def get_queued_work_ids_pending_update(self):
+        """ Returns the record ids of the work items whose updates haven't been written yet
+        :return: A set of record ids
+        """
+        return self.work_queue.get_pending_update_ids()
 
     def set_config(self, key, value):
         """ Persists the associated key with a value
@@ -125,10 +207,14 @@ class Persistence:
         else:
             self.config_table.update(existing_config["id"], {"value": value})
 
+        # Write through, so e.g. refreshed tokens are used straight away
+        self.config_cache.set(key, value)
+
     def add_leaderboard_entry(self, playerName, scoringPayload, submission_url):
         """ Adds a leaderboard entry to the leaderboard table
         :param playerName: The name of the player
         :param scoringPayload: The payload received from the scoring service
+        :return: The record id of the new leaderboard entry
         """
         print("adding leaderboard entry")
         expression = scoringPayload["expression"]
@@ -137,9 +223,13 @@ class Persistence:
         charCount = scoringPayload["charCount"]
         playURL = submission_url
         time = scoringPayload["time"]
-        self.leaderboard_table.create(
+        record = self.leaderboard_table.create(
             {"expression": expression, "time": time, "level": level, "playURL": playURL, "charCount": charCount,
              "player": playerName, "gameplay": gameplayUrl})
+        self.submission_index.add(playURL, record["id"])
+        self.leaderboards.add(record["id"], level, time, charCount, playerName)
+        self.expression_index.add(level, expression, record["id"])
+        return record["id"]
 
     def get_puzzle_data(self, puzzle_id):
         """ Returns the data associated with a given puzzle
@@ -150,31 +240,99 @@ class Persistence:
 
     def get_submission_with_url(self, submission_url):
         """ Returns an entry from the leaderboard table that matches a given URL.  This is mainly used for checking
-            for duplicate submissions.
+            for duplicate submissions.  Once the submission index is loaded, only actual duplicates hit airtable.
         :param submission_url: The URL of a given submission
         :return: Leaderboard data associated with that URL, or None
         """
-        return self.get_one_row(self.leaderboard_table, "playURL", submission_url)
+        if not self.submission_index.loaded:
+            return self.get_one_row(self.leaderboard_table, "playURL", submission_url)
+
+        return self.get_leaderboard_entry(self.submission_index.find(submission_url))
+
+    def get_submission_with_expression(self, level, expression):
+        """ Returns an entry from the leaderboard table for an equivalent expression (see expressions.canonicalize)
+            that was submitted for the same level.  Submissions made before the worker started are known once the
+            submission index has loaded.
+        :param level: The level (puzzle name) of the submission
+        :param expression: The submitted expression
+        :return: Leaderboard data for the equivalent submission, or None
+        """
+        return self.get_leaderboard_entry(self.expression_index.find(level, expression))
+
+    def get_leaderboard_entry(self, record_id):
+        """ Returns an entry from the leaderboard table by its record id
+        :param record_id: The airtable record id of the entry, or None
+        :return: Leaderboard data, or None if there's no such entry
+        """
+        if record_id is None:
+            return None
+
+        try:
+            return self.leaderboard_table.get(record_id)
+        except HTTPError as e:
+            # The entry was deleted from the leaderboard since we indexed it
+            if e.response is not None and e.response.status_code == 404:
+                self.submission_index.remove(record_id)
+                return None
+            raise
 
     def poll_duplicate_submissions(self):
         """
             Will delete duplicate submissions from airtable.
-            If one of the duplicates has been marked as completed, it won't be deleted
-        """
-        submissions_dict = {}
-        for submission in self.work_queue_table.all():
-            key = submission["fields"]["tweetId"]
-            existing_submission = submissions_dict.get(key, None)
-            
-            if existing_submission is None:
-                submissions_dict[key] = submission
-            else:
+            If one of the duplicates has been marked as completed, it won't be deleted.
+            Only work items created since the last scan are fetched (just their tweetId and completed fields), and
+            the scan resumes from the cursor stored in the Config table after a restart.
+        """
+        if self.duplicate_scan_cursor is None:
+            stored_cursor = self.get_config("duplicate_scan_cursor", None)
+            if stored_cursor is not None:
+                self.duplicate_scan_cursor = datetime.strptime(stored_cursor, AIRTABLE_TIME_FORMAT)
+
+        # After a restart we've forgotten which tweets we've seen, so we look back over the whole window
+        if self.duplicate_scan_cursor is None:
+            formula = None
+        elif len(self.duplicate_scan_seen) == 0:
+            formula = CREATED_AFTER(self.duplicate_scan_cursor - self.DUPLICATE_SCAN_WINDOW)
+        else:
+            formula = CREATED_AFTER(self.duplicate_scan_cursor - self.DUPLICATE_SCAN_OVERLAP)
+
+        to_delete = []
+        newest_created_time = self.duplicate_scan_cursor
+        for page in self.work_queue_table.iterate(fields=["tweetId", "completed"], formula=formula):
+            for submission in page:
+                created_time = parse_created_time(submission)
+                if newest_created_time is None or created_time > newest_created_time:
+                    newest_created_time = created_time
+
+                key = submission["fields"].get("tweetId", None)
+                completed = submission["fields"].get("completed", False)
+                existing_submission = self.duplicate_scan_seen.get(key, None)
+
+                if existing_submission is None or existing_submission[0] == submission["id"]:
+                    self.duplicate_scan_seen[key] = (submission["id"], completed, created_time)
+                    continue
+
                 metrics.incr("errors.duplicate_submission", 1)
                 print("Duplicate submission here...")
-                # if submission["fields"]["completed"]:
-                #     # delete existing item from dict if not completed
-                #     if not existing_submission["fields"]["completed"]:
-                #         self.work_queue_table.delete(existing_submission["id"])
-                #         submissions_dict[key] = submission
-                # else:
-                #     self.work_queue_table.delete(submission["id"])
+                if completed:
+                    # delete existing item from dict if not completed
+                    if not existing_submission[1]:
+                        to_delete.append(existing_submission[0])
+                        self.duplicate_scan_seen[key] = (submission["id"], completed, created_time)
+                else:
+                    to_delete.append(submission["id"])
+
+        if len(to_delete) > 0:
+            self.work_queue_table.batch_delete(to_delete)
+            metrics.incr("workqueue.duplicates.deleted", len(to_delete))
+            print("Deleted %d duplicate submissions" % len(to_delete))
+
+        if newest_created_time is not None:
+            # Forget tweets that are too old to be duplicated again
+            oldest_to_keep = newest_created_time - self.DUPLICATE_SCAN_WINDOW
+            self.duplicate_scan_seen = {key: seen for key, seen in self.duplicate_scan_seen.items()
+                                        if seen[2] >= oldest_to_keep}
+            if newest_created_time != self.duplicate_scan_cursor:
+                self.duplicate_scan_cursor = newest_created_time
+                self.set_config("duplicate_scan_cursor", format_airtable_time(newest_created_time))
+        metrics.gauge("workqueue.duplicates.seen", len(self.duplicate_scan_seen))
@@ -0,0 +1,410 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from metrics import metrics
+
+
+class PublishJob:
+    STATUS_QUEUED = "queued"
+    STATUS_PUBLISHING = "publishing"
+    STATUS_PUBLISHED = "published"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, job_id, puzzle_id, publish_info, status, attempts=0, tweet_id=None, error=None):
+        """ A request to publish a puzzle on twitter
+        :param job_id: The ID of the job
+        :param puzzle_id: The ID of the puzzle to publish
+        :param publish_info: The (decompressed) publishing info: id, puzzleTitle, puzzleDescription and puzzleURL
+        :param status: One of the STATUS_* values
+        :param attempts: (optional) How many times we've tried to publish the puzzle
+        :param tweet_id: (optional) The ID of the tweet, once it's been published
+        :param error: (optional) Why the last attempt failed
+        """
+        self.job_id = job_id
+        self.puzzle_id = puzzle_id
+        self.publish_info = publish_info
+        self.status = status
+        self.attempts = attempts
+        self.tweet_id = tweet_id
+        self.error = error
+        # Set on the jobs returned by PublishJobQueue.claim, to prove this publisher still holds the job
+        self.claim_token = None
+
+    def to_json(self):
+        """ Returns the job as it's shown by the job status endpoint
+        :return: A dict
+        """
+        return {"jobId": self.job_id, "puzzleId": self.puzzle_id, "status": self.status, "attempts": self.attempts,
+                "tweetId": self.tweet_id, "error": self.error}
+
+
+class PublishJobQueue(ABC):
+    def __init__(self, max_attempts=3, claim_timeout_seconds=300):
+        """ Constructor for the queue of puzzles waiting to be published.  Each puzzle has one job, whose idempotency
+            key is derived from the puzzle id, so a retried request gets the job that's already there rather than
+            publishing the puzzle twice.  Only the publisher that claimed a job can record its outcome, so a publisher
+            that took too long and had its job taken over can't overwrite what the new one did.  See
+            RedisPublishJobQueue and SqlitePublishJobQueue for the backends.
+        :param max_attempts: (optional) How many times we try to publish a puzzle before giving up on it
+        :param claim_timeout_seconds: (optional) How long a publisher has to finish a job before another one can
+            take it over, in case the first one died part way through
+        """
+        self.max_attempts = max_attempts
+        self.claim_timeout_seconds = claim_timeout_seconds
+        self.__condition = threading.Condition()
+        self.__submitted_count = 0
+        self.__waited_count = 0
+
+    @staticmethod
+    def idempotency_key(puzzle_id):
+        """ Returns the idempotency key of the job that publishes a puzzle
+        :param puzzle_id: The ID of the puzzle
+        :return: A string
+        """
+        return "publish_%s" % puzzle_id
+
+    @abstractmethod
+    def submit(self, puzzle_id, publish_info):
+        """ Queues a puzzle to be published, unless it already has a job.  A job that failed for good is queued
+            again, since that's what a caller publishing the same puzzle again wants.
+        :param puzzle_id: The ID of the puzzle
+        :param publish_info: The publishing info
+        :return: (The PublishJob, whether it was queued by this call)
+        """
+        pass
+
+    @abstractmethod
+    def get(self, job_id):
+        """ Returns a job
+        :param job_id: The ID of the job
+        :return: The PublishJob, or None if there's no such job
+        """
+        pass
+
+    @abstractmethod
+    def claim(self):
+        """ Takes the oldest queued job (or one whose publisher seems to have died) for this publisher to publish.
+            A job whose publisher died on its last attempt is failed instead.  Safe to call from several processes at
+            once.
+        :return: The PublishJob, or None if there's nothing to publish
+        """
+        pass
+
+    @abstractmethod
+    def record_tweet(self, job, tweet_id):
+        """ Records the tweet a job has posted, before the job is complete, so that a retry doesn't post it again
+        :param job: The PublishJob, as returned by claim
+        :param tweet_id: The ID of the tweet the puzzle was published in
+        :return: False if the job has been taken over by another publisher
+        """
+        pass
+
+    @abstractmethod
+    def complete(self, job, tweet_id):
+        """ Marks a job as published
+        :param job: The PublishJob, as returned by claim
+        :param tweet_id: The ID of the tweet the puzzle was published in
+        :return: False if the job has been taken over by another publisher
+        """
+        pass
+
+    @abstractmethod
+    def fail(self, job, error):
+        """ Records a failed attempt at a job, queueing it to be tried again unless it's run out of attempts
+        :param job: The PublishJob, as returned by claim
+        :param error: Why the attempt failed
+        :return: False if the job has been taken over by another publisher
+        """
+        pass
+
+    def wait_for_jobs(self, timeout):
+        """ Blocks until a job has been queued by this process since the last time we waited, or until the timeout
+            (jobs queued by other processes are picked up when it runs out)
+        :param timeout: The most seconds to wait
+        """
+        with self.__condition:
+            if self.__submitted_count == self.__waited_count:
+                self.__condition.wait(timeout)
+            self.__waited_count = self.__submitted_count
+
+    def _record_submitted(self, queued):
+        """ Counts a submitted job, waking wait_for_jobs if it was queued """
+        if queued:
+            metrics.incr("publish.job.queued", 1)
+            with self.__condition:
+                self.__submitted_count += 1
+                self.__condition.notify_all()
+        else:
+            metrics.incr("publish.job.duplicate", 1)
+
+    @staticmethod
+    def _record_claim_lost(job):
+        """ Reports an attempt whose outcome wasn't recorded, since its job was taken over by another publisher """
+        metrics.incr("publish.job.lost_claim", 1)
+        print("Publish job %s was taken over by another publisher, not recording this attempt's outcome" % (
+            job.job_id))
+
+
+class RedisPublishJobQueue(PublishJobQueue):
+    # Redis keys: each job is a hash, found by its puzzle's idempotency key, and the queued and publishing jobs are
+    # kept in sorted sets (by when they were created and claimed respectively)
+    JOB_KEY = "publish_jobs:job:%s"
+    IDEMPOTENCY_KEY = "publish_jobs:key:%s"
+    QUEUED_KEY = "publish_jobs:queued"
+    PUBLISHING_KEY = "publish_jobs:publishing"
+
+    # Queues a puzzle's job, unless it already has one that hasn't failed for good.  Returns {job id, 1 if queued}.
+    SUBMIT_SCRIPT = """
+        local job_id = redis.call("GET", KEYS[1])
+        if job_id then
+            local job_key = ARGV[1] .. job_id
+            if redis.call("HGET", job_key, "status") ~= ARGV[4] then
+                return {job_id, 0}
+            end
+            redis.call("HSET", job_key, "status", ARGV[5], "attempts", 0, "error", "", "publish_info", ARGV[3])
+            redis.call("ZADD", KEYS[2], redis.call("HGET", job_key, "created_at"), job_id)
+            return {job_id, 1}
+        end
+        job_id = ARGV[2]
+        redis.call("HSET", ARGV[1] .. job_id, "id", job_id, "puzzle_id", ARGV[6], "publish_info", ARGV[3],
+                   "status", ARGV[5], "attempts", 0, "created_at", ARGV[7])
+        redis.call("SET", KEYS[1], job_id)
+        redis.call("ZADD", KEYS[2], ARGV[7], job_id)
+        return {job_id, 1}
+    """
+    # Fails the jobs whose publisher died on their last attempt and requeues the others, then claims the oldest
+    # queued job.  Returns its id, or nil.
+    CLAIM_SCRIPT = """
+        local now = tonumber(ARGV[2])
+        for _, job_id in ipairs(redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", now - tonumber(ARGV[4]))) do
+            local job_key = ARGV[1] .. job_id
+            redis.call("ZREM", KEYS[2], job_id)
+            if tonumber(redis.call("HGET", job_key, "attempts")) >= tonumber(ARGV[5]) then
+                redis.call("HSET", job_key, "status", ARGV[7], "error", "Publisher stopped responding",
+                           "claim_token", "")
+            else
+                redis.call("HSET", job_key, "status", ARGV[8], "claim_token", "")
+                redis.call("ZADD", KEYS[1], redis.call("HGET", job_key, "created_at"), job_id)
+            end
+        end
+        local job_id = redis.call("ZRANGE", KEYS[1], 0, 0)[1]
+        if not job_id then
+            return nil
+        end
+        local job_key = ARGV[1] .. job_id
+        redis.call("ZREM", KEYS[1], job_id)
+        redis.call("ZADD", KEYS[2], now, job_id)
+        redis.call("HINCRBY", job_key, "attempts", 1)
+        redis.call("HSET", job_key, "status", ARGV[6], "claim_token", ARGV[3], "claimed_at", now)
+        return job_id
+    """
+    # Updates a job's fields (ARGV[3], ARGV[4], ...), if it's still claimed with the token ARGV[2].  ARGV[1] is
+    # "queued" / "done" to move the job back to the queue / off the publishing set, or "" to leave it there.
+    # Returns 1 if the job was updated.
+    UPDATE_SCRIPT = """
+        if redis.call("HGET", KEYS[1], "claim_token") ~= ARGV[2] then
+            return 0
+        end
+        local fields = {}
+        for i = 3, #ARGV do
+            fields[#fields + 1] = ARGV[i]
+        end
+        redis.call("HSET", KEYS[1], unpack(fields))
+        local job_id = redis.call("HGET", KEYS[1], "id")
+        if ARGV[1] ~= "" then
+            redis.call("ZREM", KEYS[3], job_id)
+            redis.call("HSET", KEYS[1], "claim_token", "")
+        end
+        if ARGV[1] == "queued" then
+            redis.call("ZADD", KEYS[2], redis.call("HGET", KEYS[1], "created_at"), job_id)
+        end
+        return 1
+    """
+
+    def __init__(self, redis_client, max_attempts=3, claim_timeout_seconds=300):
+        """ Constructor for a publish job queue kept in redis, so that it survives restarts and every web process
+            (on every dyno) shares it
+        :param redis_client: The redis client
+        :param max_attempts: (optional) How many times we try to publish a puzzle before giving up on it
+        :param claim_timeout_seconds: (optional) How long a publisher has to finish a job before another one can
+            take it over, in case the first one died part way through
+        """
+        super().__init__(max_attempts, claim_timeout_seconds)
+        self.redis = redis_client
+        self.__submit = redis_client.register_script(self.SUBMIT_SCRIPT)
+        self.__claim = redis_client.register_script(self.CLAIM_SCRIPT)
+        self.__update = redis_client.register_script(self.UPDATE_SCRIPT)
+
+    def submit(self, puzzle_id, publish_info):
+        job_id, queued = self.__submit(
+            keys=[self.IDEMPOTENCY_KEY % self.idempotency_key(puzzle_id), self.QUEUED_KEY],
+            args=[self.JOB_KEY % "", uuid.uuid4().hex, json.dumps(publish_info), PublishJob.STATUS_FAILED,
+                  PublishJob.STATUS_QUEUED, puzzle_id, time.time()])
+        self._record_submitted(queued)
+        return self.get(job_id), bool(queued)
+
+    def get(self, job_id):
+        return self.__to_job(self.redis.hgetall(self.JOB_KEY % job_id))
+
+    def claim(self):
+        claim_token = uuid.uuid4().hex
+        job_id = self.__claim(keys=[self.QUEUED_KEY, self.PUBLISHING_KEY],
+                              args=[self.JOB_KEY % "", time.time(), claim_token, self.claim_timeout_seconds,
+                                    self.max_attempts, PublishJob.STATUS_PUBLISHING, PublishJob.STATUS_FAILED,
+                                    PublishJob.STATUS_QUEUED])
+        if job_id is None:
+            return None
+        job = self.get(job_id)
+        job.claim_token = claim_token
+        return job
+
+    def record_tweet(self, job, tweet_id):
+        job.tweet_id = tweet_id
+        return self.__update_claimed(job, "", "tweet_id", tweet_id)
+
+    def complete(self, job, tweet_id):
+        job.status = PublishJob.STATUS_PUBLISHED
+        job.tweet_id = tweet_id
+        job.error = None
+        return self.__update_claimed(job, "done", "status", job.status, "tweet_id", tweet_id, "error", "")
+
+    def fail(self, job, error):
+        job.status = PublishJob.STATUS_QUEUED if job.attempts < self.max_attempts else PublishJob.STATUS_FAILED
+        job.error = error
+        return self.__update_claimed(job, job.status if job.status == PublishJob.STATUS_QUEUED else "done",
+                                     "status", job.status, "error", error)
+
+    def __update_claimed(self, job, move_to, *fields):
+        updated = self.__update(keys=[self.JOB_KEY % job.job_id, self.QUEUED_KEY, self.PUBLISHING_KEY],
+                                args=[move_to, job.claim_token] + list(fields)) == 1
+        if not updated:
+            self._record_claim_lost(job)
+        return updated
+
+    @staticmethod
+    def __to_job(fields):
+        if not fields:
+            return None
+        # Note - redis has no nulls, so unset fields are empty strings
+        return PublishJob(fields["id"], fields["puzzle_id"], json.loads(fields["publish_info"]), fields["status"],
+                          int(fields["attempts"]), fields.get("tweet_id", "") or None, fields.get("error", "") or None)
+
+
+class SqlitePublishJobQueue(PublishJobQueue):
+    # The columns we read into a PublishJob
+    COLUMNS = "id, puzzle_id, publish_info, status, attempts, tweet_id, error"
+
+    def __init__(self, path, max_attempts=3, claim_timeout_seconds=300):
+        """ Constructor for a publish job queue kept in a local SQLite database (in WAL mode), for when there's no
+            redis.  Every web process on the machine shares it.
+            NOTE: the database lives on the local disk, so it only survives restarts where the disk does.  Publishing
+            checks the Config table for the puzzle's tweet before every attempt, so a lost job can't tweet twice.
+        :param path: Path of the SQLite database file
+        :param max_attempts: (optional) How many times we try to publish a puzzle before giving up on it
+        :param claim_timeout_seconds: (optional) How long a publisher has to finish a job before another one can
+            take it over, in case the first one died part way through
+        """
+        super().__init__(max_attempts, claim_timeout_seconds)
+        self.path = path
+        self.__local = threading.local()
+
+        connection = self.__connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS publish_jobs (
+                id TEXT PRIMARY KEY,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                puzzle_id TEXT NOT NULL,
+                publish_info TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                tweet_id TEXT,
+                error TEXT,
+                claim_token TEXT,
+                claimed_at REAL,
+                created_at REAL NOT NULL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS publish_jobs_status ON publish_jobs (status, created_at)")
+
+    def submit(self, puzzle_id, publish_info):
+        key = self.idempotency_key(puzzle_id)
+        with self.__connection() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO publish_jobs (id, idempotency_key, puzzle_id, publish_info, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (uuid.uuid4().hex, key, puzzle_id, json.dumps(publish_info), PublishJob.STATUS_QUEUED, time.time()))
+            queued = cursor.rowcount > 0
+            if not queued:
+                cursor = connection.execute(
+                    "UPDATE publish_jobs SET status = ?, attempts = 0, error = NULL, publish_info = ? "
+                    "WHERE idempotency_key = ? AND status = ?",
+                    (PublishJob.STATUS_QUEUED, json.dumps(publish_info), key, PublishJob.STATUS_FAILED))
+                queued = cursor.rowcount > 0
+        self._record_submitted(queued)
+        return self.__get_one("idempotency_key = ?", (key,)), queued
+
+    def get(self, job_id):
+        return self.__get_one("id = ?", (job_id,))
+
+    def claim(self):
+        now = time.time()
+        claim_token = uuid.uuid4().hex
+        with self.__connection() as connection:
+            connection.execute(
+                "UPDATE publish_jobs SET status = ?, error = ?, claim_token = NULL "
+                "WHERE status = ? AND claimed_at < ? AND attempts >= ?",
+                (PublishJob.STATUS_FAILED, "Publisher stopped responding", PublishJob.STATUS_PUBLISHING,
+                 now - self.claim_timeout_seconds, self.max_attempts))
+            connection.execute(
+                "UPDATE publish_jobs SET status = ?, attempts = attempts + 1, claim_token = ?, claimed_at = ? "
+                "WHERE id = (SELECT id FROM publish_jobs WHERE (status = ? OR (status = ? AND claimed_at < ?)) "
+                "AND attempts < ? ORDER BY created_at LIMIT 1)",
+                (PublishJob.STATUS_PUBLISHING, claim_token, now, PublishJob.STATUS_QUEUED,
+                 PublishJob.STATUS_PUBLISHING, now - self.claim_timeout_seconds, self.max_attempts))
+        job = self.__get_one("claim_token = ?", (claim_token,))
+        if job is not None:
+            job.claim_token = claim_token
+        return job
+
+    def record_tweet(self, job, tweet_id):
+        job.tweet_id = tweet_id
+        return self.__update_claimed(job, "tweet_id = ?", (tweet_id,))
+
+    def complete(self, job, tweet_id):
+        job.status = PublishJob.STATUS_PUBLISHED
+        job.tweet_id = tweet_id
+        job.error = None
+        return self.__update_claimed(job, "status = ?, tweet_id = ?, error = NULL, claim_token = NULL",
+                                     (job.status, tweet_id))
+
+    def fail(self, job, error):
+        job.status = PublishJob.STATUS_QUEUED if job.attempts < self.max_attempts else PublishJob.STATUS_FAILED
+        job.error = error
+        return self.__update_claimed(job, "status = ?, error = ?, claim_token = NULL", (job.status, error))
+
+    def __update_claimed(self, job, assignments, params):
+        with self.__connection() as connection:
+            cursor = connection.execute("UPDATE publish_jobs SET %s WHERE id = ? AND claim_token = ?" % assignments,
+                                        params + (job.job_id, job.claim_token))
+        updated = cursor.rowcount > 0
+        if not updated:
+            self._record_claim_lost(job)
+        return updated
+
+    def __get_one(self, where, params):
+        row = self.__connection().execute("SELECT %s FROM publish_jobs WHERE %s" % (self.COLUMNS, where),
+                                          params).fetchone()
+        if row is None:
+            return None
+        return PublishJob(row[0], row[1], json.loads(row[2]), row[3], row[4], row[5], row[6])
+
+    def __connection(self):
+        """ Returns this thread's connection to the database, since SQLite connections can't be shared """
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self.__local.connection = connection
+        return connection
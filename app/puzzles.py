@@ -0,0 +1,105 @@
+import json
+import time
+
+import lz_string
+from cache import TTLCache
+
+
+class DecodedPuzzle:
+    def __init__(self, puzzle_url):
+        """ A puzzle definition, decoded from its (LZ-compressed) puzzle URL
+        :param puzzle_url: The puzzle URL, e.g. https://sinerider.com/?<lz-string base64 data>
+        """
+        url_parts = puzzle_url.partition("?")
+        self.url_prefix = url_parts[0]
+        self.data = json.loads(lz_string.decompress_from_base64(url_parts[2]))
+        # The scoring service reports the puzzle's name as the level its leaderboard entries are for
+        self.level = self.data.get("name", None)
+
+    def with_expression(self, expression):
+        """ Returns a copy of the puzzle definition with the player's expression filled in.  The cached definition
+            itself is never modified, since it is shared between work items.
+        :param expression: The expression the player submitted
+        :return: A dict containing the puzzle definition
+        """
+        exploded_puzzle_data = dict(self.data)
+        exploded_puzzle_data["expressionOverride"] = expression
+        return exploded_puzzle_data
+
+
+class PuzzleCache:
+    # The Config key that records when a puzzle was last published, so every process can tell its cached
+    # definition is stale
+    VERSION_CONFIG_KEY = "puzzle_version_%s"
+
+    def __init__(self, persistence, max_size=64, ttl_seconds=60 * 60, version_check_seconds=60):
+        """ Constructor for an LRU cache of decoded puzzle definitions, keyed by puzzle id.  Publishing a puzzle
+            writes a new version of it to the Config table, and a cached definition is only used while its version is
+            still current, so a puzzle published by another process (the web dyno) is picked up here too.
+        :param persistence: Persistence API, used to load puzzles that aren't cached yet
+        :param max_size: (optional) The maximum number of puzzles to keep decoded
+        :param ttl_seconds: (optional) How long a puzzle stays cached, so that edits in airtable are picked up
+        :param version_check_seconds: (optional) How often we re-read each puzzle's version from the Config table
+        """
+        self.persistence = persistence
+        # puzzle id -> (version, DecodedPuzzle)
+        self.cache = TTLCache("puzzle", max_size, ttl_seconds)
+        # puzzle id -> version, or "" if the puzzle hasn't been published since we started recording versions
+        self.versions = TTLCache("puzzle_version", max(1, max_size), version_check_seconds)
+
+    def get(self, puzzle_id):
+        """ Returns the decoded puzzle for a puzzle id, loading it from the Puzzles table on a cache miss (or if it's
+            been published again since we cached it).  Unknown puzzle ids aren't cached, since the puzzle may still
+            be published.
+        :param puzzle_id: The ID of the puzzle
+        :return: A DecodedPuzzle, or None if the puzzle doesn't exist
+        """
+        version = self.get_version(puzzle_id)
+        cached = self.cache.get(puzzle_id, None)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        puzzle_data = self.persistence.get_puzzle_data(puzzle_id)
+        if puzzle_data is None:
+            return None
+
+        puzzle = DecodedPuzzle(puzzle_data["fields"]["puzzleURL"])
+        self.cache.set(puzzle_id, (version, puzzle))
+        return puzzle
+
+    def get_version(self, puzzle_id):
+        """ Returns a puzzle's current version, reading it from the Config table at most every version_check_seconds
+        :param puzzle_id: The ID of the puzzle
+        :return: The version, or "" if it doesn't have one
+        """
+        version = self.versions.get(puzzle_id, None)
+        if version is None:
+            version = self.persistence.get_config(self.VERSION_CONFIG_KEY % puzzle_id, "", cached=False)
+            self.versions.set(puzzle_id, version)
+        return version
+
+    def publish(self, puzzle_id, puzzle_url):
+        """ Records that a puzzle has just been published, so every process drops its cached definition, and
+            caches the new one here
+        :param puzzle_id: The ID of the puzzle
+        :param puzzle_url: The puzzle URL
+        """
+        version = "%.6f" % time.time()
+        self.persistence.set_config(self.VERSION_CONFIG_KEY % puzzle_id, version)
+        self.versions.set(puzzle_id, version)
+        self.cache.invalidate(puzzle_id)
+        self.warm(puzzle_id, puzzle_url)
+
+    def warm(self, puzzle_id, puzzle_url):
+        """ Decodes and caches a puzzle we already know the URL of, e.g. one that's just been published
+        :param puzzle_id: The ID of the puzzle
+        :param puzzle_url: The puzzle URL
+        """
+        self.cache.set(puzzle_id, (self.get_version(puzzle_id), DecodedPuzzle(puzzle_url)))
+
+    def invalidate(self, puzzle_id):
+        """ Drops a puzzle from the cache, so that it is loaded from the Puzzles table next time
+        :param puzzle_id: The ID of the puzzle
+        """
+        self.cache.invalidate(puzzle_id)
+        self.versions.invalidate(puzzle_id)
@@ -0,0 +1,161 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+from metrics import metrics
+
+
+class RateLimitScheduler:
+    def __init__(self, max_wait_seconds=30):
+        """ Constructor for a scheduler that spreads calls across a pool of twitter accounts, based on the rate limit
+            budget twitter reports for each account and endpoint (the x-rate-limit-* response headers)
+        :param max_wait_seconds: (optional) How long a caller will wait for budget when every account is exhausted,
+            before we give up waiting and let it try the account that resets soonest
+        """
+        self.max_wait_seconds = max_wait_seconds
+        # (account, endpoint) -> [remaining calls, epoch seconds at which the budget resets]
+        self.__budgets = {}
+        self.__last_used = {}
+        self.__uses = 0
+        self.__condition = threading.Condition()
+
+    @staticmethod
+    def endpoint(method, url):
+        """ Returns the name we track an endpoint's budget under, e.g. "POST /2/tweets"
+        :param method: HTTP method
+        :param url: The URL (or path) of the endpoint
+        :return: The endpoint name
+        """
+        return "%s %s" % (method.upper(), urlparse(url).path)
+
+    def acquire(self, accounts, endpoint):
+        """ Picks the account with the most remaining budget for an endpoint, waiting (up to max_wait_seconds) if
+            every account has run out.  Accounts we haven't heard about yet are assumed to have budget, and ties
+            go to the least recently used account.
+        :param accounts: The accounts that could make the call
+        :param endpoint: The endpoint that will be called (see endpoint())
+        :return: The account to use
+        """
+        deadline = time.time() + self.max_wait_seconds
+        with self.__condition:
+            waited = False
+            while True:
+                now = time.time()
+                account = max(accounts, key=lambda a: (self.__remaining(a, endpoint, now), -self.__last_used.get(a, 0)))
+                if self.__remaining(account, endpoint, now) > 0 or now >= deadline:
+                    break
+                if not waited:
+                    metrics.incr("twitter.ratelimit.wait", 1)
+                    waited = True
+                soonest_reset = min(self.__budgets[(a, endpoint)][1] for a in accounts)
+                self.__condition.wait(max(0.1, min(soonest_reset, deadline) - now))
+
+            if self.__remaining(account, endpoint, now) <= 0:
+                metrics.incr("twitter.ratelimit.exhausted", 1)
+                account = min(accounts, key=lambda a: self.__budgets[(a, endpoint)][1])
+
+            # Spend one call locally; the response headers will correct this once the call is made
+            budget = self.__budgets.get((account, endpoint), None)
+            if budget is not None and budget[1] > now:
+                budget[0] -= 1
+            self.__uses += 1
+            self.__last_used[account] = self.__uses
+            return account
+
+    def record(self, account, endpoint, remaining, reset_at):
+        """ Records the budget twitter reported for an account and endpoint
+        :param account: The account that made the call
+        :param endpoint: The endpoint that was called (see endpoint())
+        :param remaining: Calls remaining in the current window
+        :param reset_at: Epoch seconds at which the window resets
+        """
+        with self.__condition:
+            self.__budgets[(account, endpoint)] = [remaining, reset_at]
+            self.__condition.notify_all()
+
+        stat = endpoint.lower().replace(" /", ".").replace("/", "_").replace(".json", "")
+        metrics.gauge("twitter.ratelimit.%s.%s.remaining" % (account, stat), remaining)
+
+    def budget(self, accounts, endpoint):
+        """ Returns the combined budget left for an endpoint across a pool of accounts
+        :param accounts: The accounts in the pool
+        :param endpoint: The endpoint (see endpoint())
+        :return: A tuple of (calls remaining, epoch seconds of the latest reset), or None if any account's budget is
+            unknown (i.e. not constrained as far as we know)
+        """
+        now = time.time()
+        remaining = 0
+        reset_at = now
+        with self.__condition:
+            for account in accounts:
+                budget = self.__budgets.get((account, endpoint), None)
+                if budget is None or budget[1] <= now:
+                    return None
+                remaining += max(0, budget[0])
+                reset_at = max(reset_at, budget[1])
+        return remaining, reset_at
+
+    def response_hook(self, account):
+        """ Returns a requests response hook that records the budget reported in an account's responses
+        :param account: The account whose HTTP session the hook will be attached to
+        :return: A function suitable for session.hooks["response"]
+        """
+        def hook(response, *args, **kwargs):
+            remaining = response.headers.get("x-rate-limit-remaining", None)
+            reset_at = response.headers.get("x-rate-limit-reset", None)
+            if remaining is not None and reset_at is not None:
+                self.record(account, self.endpoint(response.request.method, response.request.url), int(remaining),
+                            int(reset_at))
+        return hook
+
+    def __remaining(self, account, endpoint, now):
+        budget = self.__budgets.get((account, endpoint), None)
+        if budget is None or budget[1] <= now:
+            # Never called, or the window has reset since
+            return float("inf")
+        return budget[0]
+
+
+class AdaptivePollInterval:
+    def __init__(self, rate_limits, accounts, endpoint, min_seconds=5, max_seconds=60, initial_seconds=16):
+        """ Constructor for a poll interval that speeds up while polls are finding things, slows down while they
+            aren't, and never polls faster than the accounts' remaining rate limit budget allows
+        :param rate_limits: The RateLimitScheduler tracking the accounts' budgets
+        :param accounts: The accounts that polls are spread across
+        :param endpoint: The endpoint that each poll calls (see RateLimitScheduler.endpoint)
+        :param min_seconds: (optional) The shortest interval
+        :param max_seconds: (optional) The longest interval
+        :param initial_seconds: (optional) The interval to start with
+        """
+        self.rate_limits = rate_limits
+        self.accounts = accounts
+        self.endpoint = endpoint
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.interval = initial_seconds
+        self.requests_per_poll = 1
+
+    def record_poll(self, found, requests):
+        """ Adjusts the interval after a poll
+        :param found: How many new items the poll found
+        :param requests: How many requests the poll made
+        """
+        if found > 0:
+            self.interval = max(self.min_seconds, self.interval / 2)
+        else:
+            self.interval = min(self.max_seconds, self.interval * 1.5)
+        self.requests_per_poll = max(1, requests)
+
+    def next_interval(self):
+        """ Returns how long to wait before the next poll
+        :return: Seconds
+        """
+        interval = self.interval
+        budget = self.rate_limits.budget(self.accounts, self.endpoint)
+        if budget is not None:
+            remaining, reset_at = budget
+            # Spread what's left of the budget evenly until it resets
+            polls_left = remaining / self.requests_per_poll
+            interval = max(interval, (reset_at - time.time()) / max(polls_left, 1))
+        metrics.gauge("twitter.submissions.poll_interval", int(interval))
+        return interval
@@ -0,0 +1,98 @@
+import bisect
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+
+class ScoringServiceError(Exception):
+    def __init__(self, status_code, text):
+        """ Raised when the scoring service responds with anything other than a 200
+        :param status_code: The HTTP status code of the response
+        :param text: The body of the response
+        """
+        super().__init__("Scoring service responded with %d: %s" % (status_code, text[:200]))
+        self.status_code = status_code
+
+
+class ScoringClient:
+    # Upper bounds (in seconds) of the buckets in the latency histogram; anything slower lands in a final bucket
+    LATENCY_BUCKETS = [1, 2, 5, 10, 20, 30, 60, 90]
+
+    def __init__(self, scoring_service_uri, max_concurrency=4, connect_timeout=5, read_timeout=90, verify=True):
+        """ Constructor for a client of the scoring service, which renders a submission and returns its score
+        :param scoring_service_uri: URI of the scoring service
+        :param max_concurrency: (optional) The maximum number of renders we'll ask the scoring service for at once
+        :param connect_timeout: (optional) Seconds to wait for a connection to the scoring service
+        :param read_timeout: (optional) Seconds to wait for the scoring service to respond
+        :param verify: (optional) Whether to verify the scoring service's TLS certificate, or the path of a CA bundle to
+            verify it with
+        """
+        self.scoring_service_uri = scoring_service_uri
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=max_concurrency))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=max_concurrency))
+        self.latency_histogram = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.__renders = threading.BoundedSemaphore(max_concurrency)
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def score(self, submission_url):
+        """ Scores a submission.  If the same submission is already being scored, we wait for that render instead
+            of asking for another one.
+        :param submission_url: The level URL of the submission, with the player's expression in it
+        :return: A tuple of (the scoring service's json payload, whether it was shared with an identical request)
+        """
+        with self.__lock:
+            future = self.__in_flight.get(submission_url, None)
+            shared = future is not None
+            if not shared:
+                future = Future()
+                self.__in_flight[submission_url] = future
+
+        if shared:
+            metrics.incr("scoring.coalesced", 1)
+            return future.result(), True
+
+        try:
+            score_data = self.__request_score(submission_url)
+            future.set_result(score_data)
+            return score_data, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.__lock:
+                del self.__in_flight[submission_url]
+
+    def __request_score(self, submission_url):
+        """ Asks the scoring service to score a submission, waiting for a free render slot first
+        :param submission_url: The level URL of the submission
+        :return: The scoring service's json payload
+        """
+        with self.__renders:
+            metrics.incr("scoring.request", 1)
+            start = time.time()
+            try:
+                response = self.session.post(url=self.scoring_service_uri, json={"level": submission_url},
+                                             timeout=self.timeout, verify=self.verify)
+            finally:
+                self.__record_latency(time.time() - start)
+
+        if response.status_code != 200:
+            metrics.incr("error.scoring.status.%d" % response.status_code, 1)
+            raise ScoringServiceError(response.status_code, response.text)
+        return json.loads(response.text)
+
+    def __record_latency(self, elapsed):
+        metrics.timing("scoring.request.duration", elapsed * 1000)
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, elapsed)
+        with self.__lock:
+            self.latency_histogram[bucket] += 1
@@ -0,0 +1,145 @@
+""" The clients that the web and worker processes use, each built (and its module imported) the first time it's asked
+    for, so that a process only pays for the clients it actually uses and a misconfigured client doesn't stop the
+    process from booting.
+"""
+import json
+import os
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+AUTHORIZE_MANUALLY = False
+TESTING = False
+
+_services = {}
+# Note - reentrant, since building a client can build the clients it depends on
+_services_lock = threading.RLock()
+
+
+def get_or_build(name, build):
+    """ Returns a client, building it the first time it's asked for
+    :param name: The name of the client
+    :param build: A function that builds the client
+    :return: The client
+    """
+    service = _services.get(name, None)
+    if service is None:
+        with _services_lock:
+            service = _services.get(name, None)
+            if service is None:
+                service = build()
+                _services[name] = service
+    return service
+
+
+def get_if_built(name):
+    """ Returns a client if it's already been built, without building it
+    :param name: The name of the client
+    :return: The client, or None
+    """
+    return _services.get(name, None)
+
+
+def _get_verify_tls(value):
+    """ Parses a TLS verification setting for requests: "true", "false", or the path of a CA bundle
+    :param value: The setting
+    :return: True, False or the path
+    """
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    return value
+
+
+def get_redis():
+    """ Returns the redis client, if REDIS_URL is set
+    :return: A redis client, or None
+    """
+    if "REDIS_URL" not in os.environ:
+        return None
+
+    def build():
+        import redis
+        return redis.Redis.from_url(os.environ["REDIS_URL"], decode_responses=True, socket_timeout=10,
+                                    health_check_interval=30)
+    return get_or_build("redis", build)
+
+
+def get_airtable_requests_per_second():
+    """ Returns how many airtable requests per second this process may make.  AIRTABLE_REQUESTS_PER_SECOND is the
+        budget for the whole base.  With redis, every process shares it; without, it's split evenly between
+        AIRTABLE_PROCESS_COUNT processes, which defaults to the worker plus WEB_CONCURRENCY gunicorn workers (1 unless
+        set) on a single web dyno.  Raise AIRTABLE_PROCESS_COUNT when running more dynos.
+    :return: Requests per second
+    """
+    requests_per_second = float(os.environ.get("AIRTABLE_REQUESTS_PER_SECOND", "5"))
+    if get_redis() is not None:
+        return requests_per_second
+    process_count = int(os.environ.get("AIRTABLE_PROCESS_COUNT", 1 + int(os.environ.get("WEB_CONCURRENCY", "1"))))
+    return requests_per_second / max(1, process_count)
+
+
+def get_persistence():
+    def build():
+        from persistence import Persistence
+        return Persistence(os.environ["AIRTABLE_API_KEY"], os.environ["AIRTABLE_BASE_ID"],
+                           config_cache_ttl_seconds=int(os.environ.get("CONFIG_CACHE_TTL_SECONDS", "300")),
+                           work_queue_backend=os.environ.get("WORK_QUEUE_BACKEND", "airtable"),
+                           work_queue_sqlite_path=os.environ.get("WORK_QUEUE_SQLITE_PATH", "work_queue.db"),
+                           mirror_work_queue=os.environ.get("WORK_QUEUE_AIRTABLE_MIRROR", "true").lower() == "true",
+                           airtable_requests_per_second=get_airtable_requests_per_second(),
+                           redis_client=get_redis())
+    return get_or_build("persistence", build)
+
+
+def get_twitter_client():
+    def build():
+        from twitter import TwitterClient
+        return TwitterClient(get_persistence(), json.loads(os.environ["TWITTER_CREDENTIALS_JSON"]),
+                             os.environ["REDIRECT_URI"], TESTING)
+    return get_or_build("twitter_client", build)
+
+
+def get_puzzle_cache():
+    def build():
+        from puzzles import PuzzleCache
+        return PuzzleCache(get_persistence())
+    return get_or_build("puzzle_cache", build)
+
+
+def get_scoring_client():
+    def build():
+        from scoring import ScoringClient
+        return ScoringClient(os.environ["SINERIDER_SCORING_SERVICE"],
+                             max_concurrency=int(os.environ.get("SCORING_SERVICE_MAX_CONCURRENCY", "4")),
+                             read_timeout=float(os.environ.get("SCORING_SERVICE_TIMEOUT_SECONDS", "90")),
+                             verify=_get_verify_tls(os.environ.get("SCORING_SERVICE_VERIFY_TLS", "true")))
+    return get_or_build("scoring_client", build)
+
+
+def get_publish_jobs():
+    def build():
+        max_attempts = int(os.environ.get("PUBLISH_JOB_MAX_ATTEMPTS", "3"))
+        redis_client = get_redis()
+        if redis_client is not None:
+            from publish_jobs import RedisPublishJobQueue
+            return RedisPublishJobQueue(redis_client, max_attempts=max_attempts)
+        # Without redis, jobs are only shared by the web processes on this dyno (see SqlitePublishJobQueue)
+        from publish_jobs import SqlitePublishJobQueue
+        return SqlitePublishJobQueue(os.environ.get("PUBLISH_JOBS_SQLITE_PATH", "publish_jobs.db"),
+                                     max_attempts=max_attempts)
+    return get_or_build("publish_jobs", build)
+
+
+def get_challenger_digest():
+    def build():
+        from challenger_digest import ChallengerDigest
+        redis_client = get_redis()
+        if redis_client is None:
+            raise RuntimeError("REDIS_URL must be set, challenger digests are kept in redis")
+        return ChallengerDigest(redis_client,
+                                window_seconds=float(os.environ.get("CHALLENGER_DIGEST_WINDOW_SECONDS", "900")))
+    return get_or_build("challenger_digest", build)
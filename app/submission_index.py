@@ -0,0 +1,170 @@
+import hashlib
+import threading
+import time
+from datetime import timedelta
+
+from metrics import metrics
+from airtable_formulas import CREATED_AFTER, parse_created_time
+
+
+class SubmissionIndex:
+    # How far back each reconciliation looks past the newest row we've seen, to allow for clock skew and rows
+    # that were still being written during the last scan
+    RECONCILE_OVERLAP = timedelta(minutes=5)
+    # How often reconciling scans the whole table again instead, which is how rows deleted from the table are dropped
+    FULL_LOAD_INTERVAL = timedelta(hours=6)
+
+    def __init__(self, leaderboard_table, leaderboards=None, expression_index=None):
+        """ Constructor for an in-memory index of every submission URL on the leaderboard.  Only a fixed-size hash of
+            each URL is kept (mapped to its leaderboard record id), since the URLs themselves are long.
+        :param leaderboard_table: The airtable Leaderboard table
+        :param leaderboards: (optional) Leaderboards to fill in from the same scans
+        :param expression_index: (optional) An ExpressionIndex to fill in from the same scans
+        """
+        self.leaderboard_table = leaderboard_table
+        self.leaderboards = leaderboards
+        self.expression_index = expression_index
+        self.fields = ["playURL"] + (leaderboards.FIELDS if leaderboards is not None else [])
+        if expression_index is not None:
+            self.fields += [field for field in ["level", "expression"] if field not in self.fields]
+        self.loaded = False
+        self.__record_ids = {}
+        self.__newest_created_time = None
+        self.__loaded_at = None
+        # Entries added / record ids removed while a load is scanning the table, which the scan may have missed; None
+        # when not loading
+        self.__added_during_load = None
+        self.__removed_during_load = None
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(submission_url):
+        """ Returns the fingerprint that a submission URL is indexed under
+        :param submission_url: The URL of a given submission
+        :return: 16 bytes
+        """
+        return hashlib.blake2b(submission_url.encode("utf-8"), digest_size=16).digest()
+
+    def load(self):
+        """ Builds the index (and the leaderboards) from scratch in one paged scan of the Leaderboard table.  Entries
+            added or removed while the scan is running are carried over, since the scan may have already passed them.
+        """
+        with self.__lock:
+            self.__added_during_load = {}
+            self.__removed_during_load = set()
+        leaderboards = self.leaderboards.start_reload() if self.leaderboards is not None else None
+        record_ids = {}
+        newest_created_time = None
+        try:
+            for page in self.leaderboard_table.iterate(fields=self.fields):
+                for row in page:
+                    newest_created_time = self.__index_row(record_ids, row, newest_created_time, leaderboards)
+        except Exception:
+            with self.__lock:
+                self.__added_during_load = None
+                self.__removed_during_load = None
+            if self.leaderboards is not None:
+                self.leaderboards.cancel_reload()
+            raise
+
+        with self.__lock:
+            for fingerprint, record_id in self.__added_during_load.items():
+                record_ids.setdefault(fingerprint, record_id)
+            if len(self.__removed_during_load) > 0:
+                record_ids = {fingerprint: record_id for fingerprint, record_id in record_ids.items()
+                              if record_id not in self.__removed_during_load}
+            self.__added_during_load = None
+            self.__removed_during_load = None
+            self.__record_ids = record_ids
+            self.__newest_created_time = newest_created_time
+            self.__loaded_at = time.monotonic()
+            self.loaded = True
+        if self.leaderboards is not None:
+            self.leaderboards.finish_reload(leaderboards)
+            self.leaderboards.mark_loaded()
+        metrics.gauge("submission_index.size", len(record_ids))
+        print("Loaded submission index (%d submissions)" % len(record_ids))
+
+    def reconcile(self):
+        """ Picks up leaderboard rows that were added since we last looked (e.g. by another process).  Builds the
+            whole index if it hasn't been loaded yet, and rebuilds it every FULL_LOAD_INTERVAL to drop rows that
+            were deleted. """
+        if not self.loaded or self.__newest_created_time is None or \
+                time.monotonic() - self.__loaded_at > self.FULL_LOAD_INTERVAL.total_seconds():
+            self.load()
+            return
+
+        since = self.__newest_created_time - self.RECONCILE_OVERLAP
+        formula = CREATED_AFTER(since)
+        added = 0
+        for page in self.leaderboard_table.iterate(fields=self.fields, formula=formula):
+            with self.__lock:
+                for row in page:
+                    size_before = len(self.__record_ids)
+                    self.__newest_created_time = self.__index_row(self.__record_ids, row, self.__newest_created_time,
+                                                                  self.leaderboards)
+                    added += len(self.__record_ids) - size_before
+
+        if added > 0:
+            metrics.incr("submission_index.reconciled", added)
+            print("Submission index picked up %d submissions added elsewhere" % added)
+        metrics.gauge("submission_index.size", len(self))
+
+    def add(self, submission_url, record_id):
+        """ Adds a newly-created leaderboard entry to the index
+        :param submission_url: The URL of the submission
+        :param record_id: The airtable record id of the leaderboard entry
+        """
+        fingerprint = self.fingerprint(submission_url)
+        with self.__lock:
+            self.__record_ids.setdefault(fingerprint, record_id)
+            if self.__added_during_load is not None:
+                self.__added_during_load.setdefault(fingerprint, record_id)
+
+    def remove(self, record_id):
+        """ Removes a leaderboard entry that's been deleted from the Leaderboard table, from the index and the
+            leaderboards.  Looks through the whole index, since it's keyed by URL, but this only happens when we
+            come across a deleted entry.
+        :param record_id: The airtable record id of the leaderboard entry
+        """
+        with self.__lock:
+            for fingerprint in [fingerprint for fingerprint, indexed_record_id in self.__record_ids.items()
+                                if indexed_record_id == record_id]:
+                del self.__record_ids[fingerprint]
+            if self.__removed_during_load is not None:
+                self.__removed_during_load.add(record_id)
+                self.__added_during_load = {fingerprint: indexed_record_id for fingerprint, indexed_record_id
+                                            in self.__added_during_load.items() if indexed_record_id != record_id}
+        if self.leaderboards is not None:
+            self.leaderboards.remove(record_id)
+        if self.expression_index is not None:
+            self.expression_index.remove(record_id)
+        metrics.incr("submission_index.removed", 1)
+
+    def find(self, submission_url):
+        """ Returns the leaderboard record id of a submission URL, without any network calls
+        :param submission_url: The URL of a given submission
+        :return: A record id, or None if nobody has submitted that URL
+        """
+        return self.__record_ids.get(self.fingerprint(submission_url), None)
+
+    def __len__(self):
+        return len(self.__record_ids)
+
+    def __index_row(self, record_ids, row, newest_created_time, leaderboards):
+        """ Adds a leaderboard row to 'record_ids', 'leaderboards' and the expression index, returning the newest
+            created time seen so far """
+        fields = row["fields"]
+        play_url = fields.get("playURL", None)
+        if play_url is not None:
+            record_ids.setdefault(self.fingerprint(play_url), row["id"])
+        if leaderboards is not None:
+            leaderboards.add_row(row)
+        if self.expression_index is not None and fields.get("level", None) is not None and \
+                fields.get("expression", None) is not None:
+            self.expression_index.add(fields["level"], fields["expression"], row["id"])
+
+        created_time = parse_created_time(row)
+        if newest_created_time is None or created_time > newest_created_time:
+            return created_time
+        return newest_created_time
@@ -0,0 +1,110 @@
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class TokenRefreshScheduler:
+    def __init__(self, accounts, refresh, get_expires_at, refresh_margin_seconds=15 * 60, jitter_seconds=60,
+                 min_backoff_seconds=30, max_backoff_seconds=10 * 60, max_sleep_seconds=5 * 60, max_concurrency=4):
+        """ Constructor for a scheduler that refreshes each account's OAuth2 token shortly before it expires, rather
+            than refreshing every token on a fixed interval.  Tokens that are due are refreshed concurrently, each
+            after a random delay so they don't all hit twitter (and airtable) at once, and a failed refresh is
+            retried with exponential backoff.
+        :param accounts: The accounts whose tokens we refresh (v2.0 client ids)
+        :param refresh: A function that refreshes an account's token and returns when the new one expires (epoch
+            seconds)
+        :param get_expires_at: A function that returns when an account's current token expires (epoch seconds), or
+            None if we don't know, in which case it's refreshed straight away
+        :param refresh_margin_seconds: (optional) How long before a token expires we refresh it
+        :param jitter_seconds: (optional) The most we delay each refresh by
+        :param min_backoff_seconds: (optional) How long we wait before retrying a failed refresh the first time
+        :param max_backoff_seconds: (optional) The longest we wait before retrying a failed refresh
+        :param max_sleep_seconds: (optional) The longest we sleep between checks, so the time to expiry gauges stay
+            current
+        :param max_concurrency: (optional) How many tokens we refresh at once
+        """
+        self.accounts = accounts
+        self.refresh = refresh
+        self.get_expires_at = get_expires_at
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.jitter_seconds = jitter_seconds
+        self.min_backoff_seconds = min_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_sleep_seconds = max_sleep_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(accounts))),
+                                           thread_name_prefix="token_refresh")
+        # account -> epoch seconds its token expires, once we know it
+        self.__expires_at = {}
+        # account -> (consecutive failures, epoch seconds of the next retry)
+        self.__failures = {}
+        self.__lock = threading.Lock()
+
+    def next_refresh_at(self, account):
+        """ Returns when an account's token should next be refreshed
+        :param account: The account
+        :return: Epoch seconds, which may be in the past
+        """
+        with self.__lock:
+            if account not in self.__expires_at:
+                expires_at = self.get_expires_at(account)
+                self.__expires_at[account] = expires_at
+            expires_at = self.__expires_at[account]
+            failure = self.__failures.get(account, None)
+
+        if failure is not None:
+            return failure[1]
+        if expires_at is None:
+            return 0
+        return expires_at - self.refresh_margin_seconds
+
+    def refresh_due(self):
+        """ Refreshes every token that's due, concurrently, and waits for them all
+        :return: How many tokens were refreshed successfully
+        """
+        now = time.time()
+        due = [account for account in self.accounts if self.next_refresh_at(account) <= now]
+        futures = [self.executor.submit(self.__refresh_with_jitter, account) for account in due]
+        return sum(1 for future in futures if future.result())
+
+    def run_forever(self):
+        """ Refreshes tokens as they come due, sleeping in between """
+        while True:
+            try:
+                self.refresh_due()
+                self.report_time_to_expiry()
+                next_refresh_at = min(self.next_refresh_at(account) for account in self.accounts)
+                time.sleep(min(self.max_sleep_seconds, max(1, next_refresh_at - time.time())))
+            except Exception:
+                metrics.incr("tokens.refresh.scheduler_error", 1)
+                traceback.print_exc()
+                time.sleep(self.min_backoff_seconds)
+
+    def report_time_to_expiry(self):
+        """ Reports how long each account's token has left, as the gauge tokens.<account>.seconds_to_expiry """
+        now = time.time()
+        with self.__lock:
+            expiries = dict(self.__expires_at)
+        for account, expires_at in expiries.items():
+            if expires_at is not None:
+                metrics.gauge("tokens.%s.seconds_to_expiry" % account, int(expires_at - now))
+
+    def __refresh_with_jitter(self, account):
+        time.sleep(random.uniform(0, self.jitter_seconds))
+        try:
+            expires_at = self.refresh(account)
+        except Exception as e:
+            with self.__lock:
+                failures = self.__failures.get(account, (0, 0))[0] + 1
+                backoff = min(self.max_backoff_seconds, self.min_backoff_seconds * 2 ** (failures - 1))
+                self.__failures[account] = (failures, time.time() + backoff)
+            print("Failed refreshing token for %s (%d in a row), retrying in %ds: %s" % (account, failures, backoff, e))
+            return False
+
+        with self.__lock:
+            self.__expires_at[account] = expires_at
+            self.__failures.pop(account, None)
+        return True
@@ -1,15 +1,36 @@
 import re
+import threading
+import time
 import traceback
 
 import tweepy
-import uuid
+import tempfile
 import requests
-import os
 from datetime import datetime, timedelta
-from metrics import metrics
+from metrics import metrics, api_calls
+from cache import TTLCache
+from rate_limits import RateLimitScheduler, AdaptivePollInterval
 
 
 class TwitterClient:
+    # Gameplay videos are streamed through a temporary spool which keeps up to this many bytes in memory before
+    # rolling over to disk, so memory use doesn't grow with video size
+    MEDIA_SPOOL_MAX_MEMORY_BYTES = 1024 * 1024
+    MEDIA_DOWNLOAD_CHUNK_BYTES = 64 * 1024
+    MEDIA_DOWNLOAD_TIMEOUT_SECONDS = (5, 60)
+    # Uploaded media can be attached to tweets until Twitter expires it (expires_after_secs, normally 24 hours).
+    # We stop reusing a media id a little before then, in case the reply is slow to go out.
+    MEDIA_DEFAULT_EXPIRY_SECONDS = 24 * 60 * 60
+    MEDIA_EXPIRY_MARGIN_SECONDS = 15 * 60
+    # The endpoints we track rate limit budgets for (see RateLimitScheduler.endpoint)
+    CREATE_TWEET_ENDPOINT = "POST /2/tweets"
+    SEARCH_RECENT_TWEETS_ENDPOINT = "GET /2/tweets/search/recent"
+    # The most results search_recent_tweets will return per request
+    SEARCH_PAGE_SIZE = 100
+    MEDIA_UPLOAD_ENDPOINT = "POST /1.1/media/upload.json"
+    # How long user tokens last, when twitter doesn't say
+    TOKEN_DEFAULT_EXPIRY_SECONDS = 2 * 60 * 60
+
     def __init__(self, persistence, credentials_json, redirect_uri, testing):
         """ Constructor
         :param persistence: Persistence API
@@ -19,12 +40,19 @@ class TwitterClient:
         self.persistence = persistence
         self.credentials_json = credentials_json
         self.v11_creds = credentials_json["v11_tokens"]
-        self.v11_client_counter = 0
         self.v20_creds = credentials_json["v20_tokens"]
-        self.v20_client_counter = 0
         self.redirect_uri = redirect_uri
         self.scopes = ["tweet.read", "users.read", "tweet.write", "offline.access"]
         self.testing = testing
+        # Long-lived tweepy clients, one per credential, so that each keeps its HTTP session's connections alive
+        self.v20_clients = {}
+        self.v11_clients = {}
+        self.clients_lock = threading.Lock()
+        self.rate_limits = RateLimitScheduler()
+        self.submission_poll_interval = AdaptivePollInterval(self.rate_limits,
+                                                             ["v20_%d" % i for i in range(len(self.v20_creds))],
+                                                             self.SEARCH_RECENT_TWEETS_ENDPOINT)
+        self.media_cache = TTLCache("media", 512, self.MEDIA_DEFAULT_EXPIRY_SECONDS - self.MEDIA_EXPIRY_MARGIN_SECONDS)
 
     def post_tweet(self, text, in_reply_to_tweet_id=None, media_ids=None, use_primary_bot=False):
         """ Post a tweet
@@ -32,54 +60,105 @@ class TwitterClient:
         :param in_reply_to_tweet_id: (optional) The twitter tweet ID that you want to respond to
         :param media_ids: (optional) A list of Twitter media IDs that you want to upload alongside this tweet
         :param use_primary_bot: (optional) Whether or not to return the primary bot, or a random one from the pool
+        :return: The tweepy Response, whose data has the new tweet's id
         """
         print("Posting tweet to %s with text: %s" % (in_reply_to_tweet_id, text))
-        self.__get_next_v20_client(use_primary_bot). \
+        return self.__get_next_v20_client(use_primary_bot, self.CREATE_TWEET_ENDPOINT). \
             create_tweet(text=text, user_auth=False, in_reply_to_tweet_id=in_reply_to_tweet_id, media_ids=media_ids)
 
     def upload_media(self, media_uri, file_type):
-        """ Upload media to twitter
+        """ Upload media to twitter.  Media we've uploaded recently is reused rather than downloaded and uploaded again,
+            since it's been shared with every account in the pool.
         :param media_uri: A uri that points to a piece of media
         :param file_type: MIME type of the media you wish to upload
         :return: an integer (media id) or None
         """
-        filename = "./%s-gameplay.%s" % (uuid.uuid4(), file_type.split("/")[1])
+        cached_media_ids = self.media_cache.get(media_uri, None)
+        if cached_media_ids is not None:
+            return cached_media_ids
+
+        filename = "gameplay.%s" % (file_type.split("/")[1])
         try:
             metrics.incr("upload.media.attempt", 1)
-            r = requests.get(media_uri, allow_redirects=True)
-            file = open(filename, 'wb')
-            file.write(r.content)
-            file.flush()
-            file.close()
-            media = self.__get_next_v11_client().chunked_upload(filename, file_type=file_type,
-                                                                additional_owners=self.get_all_owners())
+            with tempfile.SpooledTemporaryFile(max_size=self.MEDIA_SPOOL_MAX_MEMORY_BYTES) as file:
+                self.__download_media(media_uri, file)
+                file.seek(0)
+                media = self.__get_next_v11_client(self.MEDIA_UPLOAD_ENDPOINT).chunked_upload(
+                    filename, file=file, file_type=file_type, additional_owners=self.get_all_owners())
             metrics.incr("upload.media.success", 1)
-            return [media.media_id_string]
+            media_ids = [media.media_id_string]
+
+            expires_after_secs = getattr(media, "expires_after_secs", None) or self.MEDIA_DEFAULT_EXPIRY_SECONDS
+            if expires_after_secs > self.MEDIA_EXPIRY_MARGIN_SECONDS:
+                self.media_cache.set(media_uri, media_ids, expires_after_secs - self.MEDIA_EXPIRY_MARGIN_SECONDS)
+            return media_ids
         except Exception as e:
             metrics.incr("error.upload_media_failure", 1)
             print(e)
-        finally:
-            if os.path.exists(filename):
-                os.remove(filename)
         return None
 
+    def __download_media(self, media_uri, file):
+        """ Streams a piece of media into a file, a chunk at a time
+        :param media_uri: A uri that points to a piece of media
+        :param file: The (binary) file to write the media to
+        """
+        start = time.time()
+        total_bytes = 0
+        with requests.get(media_uri, allow_redirects=True, stream=True,
+                          timeout=self.MEDIA_DOWNLOAD_TIMEOUT_SECONDS) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=self.MEDIA_DOWNLOAD_CHUNK_BYTES):
+                file.write(chunk)
+                total_bytes += len(chunk)
+
+        elapsed = time.time() - start
+        metrics.incr("upload.media.download.bytes", total_bytes)
+        metrics.timing("upload.media.download.duration", elapsed * 1000)
+        if elapsed > 0:
+            metrics.gauge("upload.media.download.bytes_per_second", int(total_bytes / elapsed))
+
     def force_user_authentication(self):
         """ Forces all users managed by this module to login manually.  This only needs to be done once."""
         for config in self.v20_creds:
             self.__login(config)
 
     def refresh_all_tokens(self):
-        """ Forces all users managed by this module to refresh their authentication tokens.  This needs to happen
-        periodically, and should be done no less than 2 hours. """
-        for config in self.v20_creds:
+        """ Forces all users managed by this module to refresh their authentication tokens, one after another.  The
+            worker refreshes each token as it comes close to expiring instead (see TokenRefreshScheduler). """
+        for i in range(len(self.v20_creds)):
             try:
-                metrics.incr("tokens.refresh.attempt", 1)
-                self.__refresh(config)
-                metrics.incr("tokens.refresh.success", 1)
+                self.refresh_token("v20_%d" % i)
             except Exception as e:
-                metrics.incr("tokens.refresh.failure", 1)
                 print("Failed refreshing tokens: %s" % (str(e)))
 
+    def get_v20_accounts(self):
+        """ Returns the names of the v2.0 accounts in the pool, e.g. "v20_0"
+        :return: A list of account names
+        """
+        return ["v20_%d" % i for i in range(len(self.v20_creds))]
+
+    def refresh_token(self, account):
+        """ Refreshes one account's authentication token
+        :param account: The account, e.g. "v20_0"
+        :return: When the new token expires (epoch seconds)
+        """
+        try:
+            metrics.incr("tokens.refresh.attempt", 1)
+            expires_at = self.__refresh(self.v20_creds[int(account[len("v20_"):])])
+            metrics.incr("tokens.refresh.success", 1)
+            return expires_at
+        except Exception:
+            metrics.incr("tokens.refresh.failure", 1)
+            raise
+
+    def get_token_expires_at(self, account):
+        """ Returns when an account's current authentication token expires
+        :param account: The account, e.g. "v20_0"
+        :return: Epoch seconds, or None if we don't know (e.g. it was stored before we kept track)
+        """
+        config = self.v20_creds[int(account[len("v20_"):])]
+        expires_at = self.persistence.get_config("user_token_expires_at_%s" % (config["client_id"]), None)
+        return float(expires_at) if expires_at is not None else None
 
     def __find_submissions_since(self, since_id=None):
         """ Returns all submissions posted since the last (newest) tweet we've processed.  Does the work here to
@@ -87,10 +166,12 @@ class TwitterClient:
             relevant information we need to process jobs.
             NOTE: we only return submissions that are less than 1 day old and more recent than input context 'since_id'
         :param since_id: Only tweets posted after the given ID will be returned.
-        :return: A list of objects containing submission information such as the puzzle ID, expression, and author info
+        :return: A tuple of (a list of objects containing submission information such as the puzzle ID, expression, and
+            author info, the number of search requests made)
         """
         print("Polling Twitter for submissions...")
         tweets = []
+        requests_made = 0
 
         expansions = ["author_id", "entities.mentions.username", "in_reply_to_user_id"]
         tweet_fields = ["author_id", "created_at"]
@@ -101,14 +182,16 @@ class TwitterClient:
         start_time = yesterday if since_id is None else None
 
         while True:
-            response = self.__get_next_v20_client(False).search_recent_tweets("My solution for the #sinerider puzzle of the day",
-                                                                              expansions=expansions,
-                                                                              tweet_fields=tweet_fields,
-                                                                              user_fields=user_fields,
-                                                                              since_id=since_id,
-                                                                              next_token=next_token,
-                                                                              start_time=start_time,
-                                                                              max_results=10)
+            client = self.__get_next_v20_client(False, self.SEARCH_RECENT_TWEETS_ENDPOINT)
+            response = client.search_recent_tweets("My solution for the #sinerider puzzle of the day",
+                                                   expansions=expansions,
+                                                   tweet_fields=tweet_fields,
+                                                   user_fields=user_fields,
+                                                   since_id=since_id,
+                                                   next_token=next_token,
+                                                   start_time=start_time,
+                                                   max_results=self.SEARCH_PAGE_SIZE)
+            requests_made += 1
 
             # Subsequent searches should just use the next_token
             since_id = None
@@ -139,14 +222,14 @@ class TwitterClient:
 
         print("Done polling Twitter!")
 
-        return tweets
+        return tweets, requests_made
 
     def __get_tweet_submission(self, tweet, user_info):
         text = tweet["text"]
         author_id = tweet["author_id"]
         if not self.testing and author_id in self.get_all_owners():
             print("Detected bot tweet, ignoring...")
-            return "We don't respond to bots"
+            return None
 
         match = re.search(
             r"#(?P<puzzle_id>puzzle_[0-9]+)(?P<middle>.*characters)(?P<expression>.*)(Try solving it yourself: .+)",
@@ -175,14 +258,23 @@ class TwitterClient:
 
         try:
             metrics.incr("twitter.submissions.query.attempt", 1)
-            submissions = self.__find_submissions_since(newest_tweet_id)
+            submissions, requests_made = self.__find_submissions_since(newest_tweet_id)
             print("New submissions: %d" % (len(submissions)))
+            self.submission_poll_interval.record_poll(len(submissions), requests_made)
+
+            # Look up which of these tweets are already queued in as few requests as possible
+            already_queued = self.persistence.get_queued_tweet_ids(
+                [str(submission["id"]) for submission in submissions])
 
             for submission in submissions:
                 try:
                     metrics.incr("twitter.submissions.query.result", 1)
+                    if str(submission["id"]) in already_queued:
+                        print(f"Dupicate submission with id {submission['id']}... Skipping!")
+                        continue
                     self.persistence.queue_work(str(submission["id"]), submission["author_username"],
-                                                submission["puzzle_id"], submission["expression"])
+                                                submission["puzzle_id"], submission["expression"],
+                                                check_existing=False)
                 except Exception as e:
                     metrics.incr("error.twitter_submissions_exception", 1)
                     traceback.print_exc()
@@ -196,30 +288,54 @@ class TwitterClient:
         """
         return map(lambda config: config["twitter_user_id"], self.v20_creds)
 
-    def __get_next_v20_client(self, use_primary_bot):
-        """ Returns a valid tweepy v2.0 twitter client
+    def __get_next_v20_client(self, use_primary_bot, endpoint):
+        """ Returns a valid tweepy v2.0 twitter client, for the account with the most rate limit budget left
 
         :param use_primary_bot: Instead of returning the next client from the pool, return the main twitter bot.
             This is particularly useful for supporting publishing puzzles via one singular account.
+        :param endpoint: The endpoint the client will be used to call, e.g. CREATE_TWEET_ENDPOINT
         :return: A tweepy Client (v2.0)
         """
-        self.v20_client_counter += 1
-        index = 0 if use_primary_bot else self.v20_client_counter % len(self.v20_creds)
-        config = self.v20_creds[index]
+        candidates = ["v20_0"] if use_primary_bot else ["v20_%d" % i for i in range(len(self.v20_creds))]
+        account = self.rate_limits.acquire(candidates, endpoint)
+        config = self.v20_creds[int(account[len("v20_"):])]
         bearer_token = self.persistence.get_config("user_bearer_token_%s" % (config["client_id"]), "<unknown>")
-        return tweepy.Client(bearer_token)
 
-    def __get_next_v11_client(self):
-        """ Returns a valid tweepy v1.1 twitter client
+        with self.clients_lock:
+            client = self.v20_clients.get(config["client_id"], None)
+            if client is None or client.bearer_token != bearer_token:
+                # The bearer token has been refreshed since we built this client, but its connections are still good
+                new_client = tweepy.Client(bearer_token)
+                if client is not None:
+                    new_client.session = client.session
+                else:
+                    new_client.session.hooks["response"].append(self.rate_limits.response_hook(account))
+                    new_client.session.hooks["response"].append(api_calls.response_hook("twitter"))
+                client = new_client
+                self.v20_clients[config["client_id"]] = client
+                metrics.incr("twitter.clients.v20.built", 1)
+        return client
+
+    def __get_next_v11_client(self, endpoint):
+        """ Returns a valid tweepy v1.1 twitter client, for the account with the most rate limit budget left
+        :param endpoint: The endpoint the client will be used to call, e.g. MEDIA_UPLOAD_ENDPOINT
         :return: A tweepy API (v1.1)
         """
-        self.v11_client_counter += 1
-        config = self.v11_creds[self.v11_client_counter % len(self.v11_creds)]
-
-        return tweepy.API(tweepy.OAuth1UserHandler(config["consumer_key"],
-                                                   config["consumer_secret"],
-                                                   config["access_token"],
-                                                   config["access_token_secret"]))
+        account = self.rate_limits.acquire(["v11_%d" % i for i in range(len(self.v11_creds))], endpoint)
+        config = self.v11_creds[int(account[len("v11_"):])]
+
+        with self.clients_lock:
+            client = self.v11_clients.get(account, None)
+            if client is None:
+                client = tweepy.API(tweepy.OAuth1UserHandler(config["consumer_key"],
+                                                             config["consumer_secret"],
+                                                             config["access_token"],
+                                                             config["access_token_secret"]))
+                client.session.hooks["response"].append(self.rate_limits.response_hook(account))
+                client.session.hooks["response"].append(api_calls.response_hook("twitter"))
+                self.v11_clients[account] = client
+                metrics.incr("twitter.clients.v11.built", 1)
+        return client
 
     def __login(self, credentials):
         """ Forces the user to manually login given a set of credentials
@@ -242,11 +358,13 @@ class TwitterClient:
 
         self.persistence.set_config(bearer_token_key, access_token["access_token"])
         self.persistence.set_config(refresh_token_key, access_token["refresh_token"])
+        self.__store_expires_at(credentials, access_token)
 
     def __refresh(self, credentials):
         """ Forces a set of credentials to be refreshed using the PKCE Refresh Token Flow
             See https://developer.twitter.com/en/docs/authentication/oauth-2-0/authorization-code for more details
         :param credentials: v2.0 authentication configuration
+        :return: When the new token expires (epoch seconds)
         """
 
         bearer_token_key = "user_bearer_token_%s" % (credentials["client_id"])
@@ -273,3 +391,16 @@ class TwitterClient:
         self.persistence.set_config(bearer_token_key, access_token["access_token"])
         self.persistence.set_config(refresh_token_key, access_token["refresh_token"])
         print("refreshed auth token for client id %s" % (credentials["client_id"]))
+        return self.__store_expires_at(credentials, access_token)
+
+    def __store_expires_at(self, credentials, access_token):
+        """ Persists when a newly-issued token expires, so that we know when to refresh it
+        :param credentials: v2.0 authentication configuration
+        :param access_token: The token twitter issued
+        :return: When the token expires (epoch seconds)
+        """
+        expires_at = access_token.get("expires_at", None)
+        if expires_at is None:
+            expires_at = time.time() + access_token.get("expires_in", self.TOKEN_DEFAULT_EXPIRY_SECONDS)
+        self.persistence.set_config("user_token_expires_at_%s" % (credentials["client_id"]), str(int(expires_at)))
+        return expires_at
@@ -0,0 +1,373 @@
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from pyairtable.formulas import EQUAL, AND, IF, FIELD, to_airtable_value
+from requests import HTTPError
+from metrics import metrics
+
+
+class QueuedWork:
+    # The airtable work queue fields we read
+    FIELDS = ["tweetId", "twitterHandle", "puzzleId", "expression", "attempts", "completed"]
+    # The fields a work item can't be scored without
+    REQUIRED_FIELDS = ["tweetId", "twitterHandle", "puzzleId", "expression"]
+
+    def __init__(self, record_id, tweet_id, twitter_handle, puzzle_id, expression, attempts=0, completed=False,
+                 mirror_record_id=None):
+        """ A work item from the work queue.  Keeps hold of its record id and attempt count, so that it can be
+            updated later without looking it up by tweet id again.
+        :param record_id: The id of the work item in its work queue backend
+        :param tweet_id: The ID of the tweet that was submitted
+        :param twitter_handle: The twitter handle of the user that tweeted the submission
+        :param puzzle_id: The ID of the puzzle associated with the submission
+        :param expression: The sinerider graph expression in the submission
+        :param attempts: (optional) How many times we've tried to score this work item
+        :param completed: (optional) Whether this work item has been completed
+        :param mirror_record_id: (optional) The airtable record id of this work item, when airtable is a mirror
+        """
+        self.record_id = record_id
+        self.tweet_id = tweet_id
+        self.twitter_handle = twitter_handle
+        self.puzzle_id = puzzle_id
+        self.expression = expression
+        self.attempts = attempts
+        self.completed = completed
+        self.mirror_record_id = mirror_record_id
+
+    @staticmethod
+    def from_airtable_row(row):
+        """ Creates a work item from a row of the airtable work queue table
+        :param row: A row from the work queue table
+        :return: A QueuedWork item
+        :raises ValueError: If the row is missing any of REQUIRED_FIELDS
+        """
+        # Note - airtable leaves out empty fields (including unchecked checkboxes) entirely
+        fields = row.get("fields", {})
+        missing = [field for field in QueuedWork.REQUIRED_FIELDS if fields.get(field, "") == ""]
+        if len(missing) > 0:
+            raise ValueError("work item %s is missing %s" % (row["id"], ", ".join(missing)))
+        return QueuedWork(row["id"], fields["tweetId"], fields["twitterHandle"], fields["puzzleId"],
+                          fields["expression"], fields.get("attempts", 0) or 0, fields.get("completed", False))
+
+
+class WorkQueue(ABC):
+    """ The work queue of submissions waiting to be scored and responded to.  See AirtableWorkQueue and
+        SqliteWorkQueue for the backends. """
+
+    @abstractmethod
+    def queue_work(self, tweet_id, twitter_handle, puzzle_id, expression, check_existing=True):
+        """ Queues a user-submitted solution for later processing
+        :param tweet_id: The ID of the tweet that was submitted
+        :param twitter_handle: The twitter handle of the user that tweeted the submission
+        :param puzzle_id: The ID of the puzzle associated with the submission
+        :param expression: The sinerider graph expression in the submission
+        :param check_existing: (optional) Set to False if the caller already checked the tweet isn't queued
+        :return: The record id of the new work item, or None if the tweet was already queued
+        """
+        pass
+
+    @abstractmethod
+    def get_queued_tweet_ids(self, tweet_ids):
+        """ Returns which of the given tweets have already been queued
+        :param tweet_ids: Tweet IDs to check
+        :return: A set of tweet IDs
+        """
+        pass
+
+    @abstractmethod
+    def get_all_queued_work(self, page_size=100, max_rows=None):
+        """ Returns all queued non-completed work, a page at a time
+        :param page_size: (optional) How many work items to read at once
+        :param max_rows: (optional) The most work items to return in total, or None for all of them
+        :return: A generator of lists of QueuedWork items
+        """
+        pass
+
+    @abstractmethod
+    def increment_attempts(self, work):
+        """ Increments the amount of times a piece of queued work as been attempted to be processed.
+        :param work: The QueuedWork item being attempted
+        :return: The newly-incremented number of attempts.
+        """
+        pass
+
+    @abstractmethod
+    def complete(self, work):
+        """ Marks a particular piece of work as completed.
+        :param work: The QueuedWork item that was completed
+        """
+        pass
+
+    def flush(self):
+        """ Writes any buffered updates """
+        pass
+
+    def get_pending_update_ids(self):
+        """ Returns the record ids of the work items whose updates are still buffered
+        :return: A set of record ids
+        """
+        return set()
+
+    def wait_for_work(self, timeout):
+        """ Blocks until new work may have been queued
+        :param timeout: The most seconds to wait
+        """
+        time.sleep(timeout)
+
+
+class AirtableWorkQueue(WorkQueue):
+    # Airtable's limit on how many records can be updated in one request
+    MAX_RECORDS_PER_BATCH = 10
+
+    def __init__(self, persistence):
+        """ Constructor for the work queue kept in the airtable TwitterWorkQueue table.  Attempt counts and completion
+            flags are buffered and written in batches.
+        :param persistence: Persistence API
+        """
+        self.persistence = persistence
+        self.table = persistence.work_queue_table
+        self.pending_updates = {}
+        self.pending_updates_lock = threading.Lock()
+
+    def queue_work(self, tweet_id, twitter_handle, puzzle_id, expression, check_existing=True):
+        existing_submission = self.persistence.get_one_row(self.table, "tweetId", tweet_id) if check_existing else None
+        if existing_submission is not None:
+            print(f"Dupicate submission with id {tweet_id}... Skipping!")
+            return None
+
+        record = self.table.create(
+            {"tweetId": tweet_id, "twitterHandle": twitter_handle, "puzzleId": puzzle_id, "expression": expression,
+             "completed": False, "attempts": 0})
+        return record["id"]
+
+    def get_queued_tweet_ids(self, tweet_ids):
+        return set(self.persistence.get_rows_by_keys(self.table, "tweetId", tweet_ids).keys())
+
+    def get_all_queued_work(self, page_size=100, max_rows=None):
+        formula = AND(EQUAL(FIELD("completed"), to_airtable_value(0)), IF("{attempts} < 3", 1, 0))
+        options = {"formula": formula, "page_size": page_size, "fields": QueuedWork.FIELDS}
+        if max_rows is not None:
+            options["max_records"] = max_rows
+        for page in self.table.iterate(**options):
+            work = []
+            for row in page:
+                try:
+                    work.append(QueuedWork.from_airtable_row(row))
+                except ValueError as e:
+                    # Completed, so that it isn't read back (and skipped) on every pass
+                    metrics.incr("error.workqueue.invalid_row", 1)
+                    print("Completing unscorable %s" % e)
+                    self.update(row["id"], {"completed": True})
+            yield work
+
+    def increment_attempts(self, work):
+        work.attempts += 1
+        self.update(work.record_id, {"attempts": work.attempts})
+        return work.attempts
+
+    def complete(self, work):
+        work.completed = True
+        self.update(work.record_id, {"completed": True})
+
+    def update(self, record_id, fields):
+        """ Buffers an update to a work queue record, merging it with any update already waiting for that record
+        :param record_id: The airtable record id of the work item
+        :param fields: The fields to update
+        """
+        with self.pending_updates_lock:
+            self.pending_updates.setdefault(record_id, {}).update(fields)
+            batch_full = len(self.pending_updates) >= self.MAX_RECORDS_PER_BATCH
+
+        if batch_full:
+            self.flush()
+
+    def get_pending_update_ids(self):
+        with self.pending_updates_lock:
+            return set(self.pending_updates.keys())
+
+    def flush(self):
+        """ Writes all buffered updates to airtable, MAX_RECORDS_PER_BATCH records per request.  If a request fails its
+            updates are kept, so that the next flush retries them, except for records airtable rejects outright (e.g.
+            ones that have been deleted), which would never succeed.
+        """
+        with self.pending_updates_lock:
+            records = [{"id": record_id, "fields": fields} for record_id, fields in self.pending_updates.items()]
+            self.pending_updates = {}
+
+        error = None
+        for i in range(0, len(records), self.MAX_RECORDS_PER_BATCH):
+            batch = records[i:i + self.MAX_RECORDS_PER_BATCH]
+            try:
+                self.table.batch_update(batch)
+                metrics.incr("workqueue.updates.flushed", len(batch))
+            except HTTPError as e:
+                if self.__is_rejected(e):
+                    # One bad record fails the whole batch, so find out which of them it was
+                    error = self.__update_one_at_a_time(batch) or error
+                else:
+                    error = e
+                    self.__rebuffer(batch)
+            except Exception as e:
+                error = e
+                self.__rebuffer(batch)
+
+        if error is not None:
+            metrics.incr("error.workqueue.updates_flush", 1)
+            raise error
+
+    def __update_one_at_a_time(self, records):
+        """ Writes updates one record at a time, dropping the ones airtable rejects and keeping the rest if a
+            request fails for any other reason
+        :return: The error that stopped us, or None
+        """
+        for i, record in enumerate(records):
+            try:
+                self.table.update(record["id"], record["fields"])
+                metrics.incr("workqueue.updates.flushed", 1)
+            except Exception as e:
+                if not isinstance(e, HTTPError) or not self.__is_rejected(e):
+                    self.__rebuffer(records[i:])
+                    return e
+                metrics.incr("workqueue.updates.dropped", 1)
+                print("Dropping update to work item %s, which airtable rejected: %s" % (record["id"], e))
+        return None
+
+    def __rebuffer(self, records):
+        with self.pending_updates_lock:
+            for record in records:
+                # Anything buffered since we started flushing is newer, so it wins
+                fields = record["fields"]
+                fields.update(self.pending_updates.get(record["id"], {}))
+                self.pending_updates[record["id"]] = fields
+
+    @staticmethod
+    def __is_rejected(error):
+        """ Whether airtable rejected an update in a way that retrying won't fix """
+        return error.response is not None and error.response.status_code in (404, 422)
+
+
+class SqliteWorkQueue(WorkQueue):
+    def __init__(self, path, mirror=None):
+        """ Constructor for a work queue kept in a local SQLite database (in WAL mode).  Work queued by this process
+            wakes up wait_for_work straight away, so it doesn't wait for the next poll.
+            NOTE: the database lives on the local disk, so it only survives restarts where the disk does.
+        :param path: Path of the SQLite database file
+        :param mirror: (optional) An AirtableWorkQueue that work items are copied to, for visibility
+        """
+        self.path = path
+        self.mirror = mirror
+        self.__local = threading.local()
+        self.__condition = threading.Condition()
+        self.__queued_count = 0
+        self.__waited_count = 0
+
+        connection = self.__connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS work_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tweet_id TEXT NOT NULL UNIQUE,
+                twitter_handle TEXT NOT NULL,
+                puzzle_id TEXT NOT NULL,
+                expression TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                completed INTEGER NOT NULL DEFAULT 0,
+                mirror_record_id TEXT,
+                created_at REAL NOT NULL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS work_queue_pending ON work_queue (completed, attempts)")
+
+    def queue_work(self, tweet_id, twitter_handle, puzzle_id, expression, check_existing=True):
+        with self.__connection() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO work_queue (tweet_id, twitter_handle, puzzle_id, expression, created_at) "
+                "VALUES (?, ?, ?, ?, ?)", (tweet_id, twitter_handle, puzzle_id, expression, time.time()))
+        if cursor.rowcount == 0:
+            print(f"Dupicate submission with id {tweet_id}... Skipping!")
+            return None
+        record_id = str(cursor.lastrowid)
+
+        if self.mirror is not None:
+            try:
+                mirror_record_id = self.mirror.queue_work(tweet_id, twitter_handle, puzzle_id, expression,
+                                                          check_existing=False)
+                with self.__connection() as connection:
+                    connection.execute("UPDATE work_queue SET mirror_record_id = ? WHERE id = ?",
+                                       (mirror_record_id, record_id))
+            except Exception as e:
+                metrics.incr("error.workqueue.mirror", 1)
+                print("Failed to mirror work item (tweetid: %s) to airtable: %s" % (tweet_id, e))
+
+        with self.__condition:
+            self.__queued_count += 1
+            self.__condition.notify_all()
+        return record_id
+
+    def get_queued_tweet_ids(self, tweet_ids):
+        queued = set()
+        tweet_ids = list(tweet_ids)
+        connection = self.__connection()
+        # Note - SQLite limits how many parameters a statement can have
+        for i in range(0, len(tweet_ids), 500):
+            chunk = tweet_ids[i:i + 500]
+            rows = connection.execute("SELECT tweet_id FROM work_queue WHERE tweet_id IN (%s)" %
+                                      ",".join("?" * len(chunk)), chunk)
+            queued.update(row[0] for row in rows)
+        return queued
+
+    def get_all_queued_work(self, page_size=100, max_rows=None):
+        # Note - each page is its own query, since the generator may be resumed on a different thread
+        last_id = 0
+        remaining = max_rows
+        while remaining is None or remaining > 0:
+            limit = page_size if remaining is None else min(page_size, remaining)
+            rows = self.__connection().execute(
+                "SELECT id, tweet_id, twitter_handle, puzzle_id, expression, attempts, completed, mirror_record_id "
+                "FROM work_queue WHERE completed = 0 AND attempts < 3 AND id > ? ORDER BY id LIMIT ?",
+                (last_id, limit)).fetchall()
+            if len(rows) == 0:
+                break
+            last_id = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+            yield [QueuedWork(str(row[0]), row[1], row[2], row[3], row[4], row[5], bool(row[6]), row[7])
+                   for row in rows]
+
+    def increment_attempts(self, work):
+        work.attempts += 1
+        with self.__connection() as connection:
+            connection.execute("UPDATE work_queue SET attempts = attempts + 1 WHERE id = ?", (work.record_id,))
+        self.__mirror_update(work, {"attempts": work.attempts})
+        return work.attempts
+
+    def complete(self, work):
+        work.completed = True
+        with self.__connection() as connection:
+            connection.execute("UPDATE work_queue SET completed = 1 WHERE id = ?", (work.record_id,))
+        self.__mirror_update(work, {"completed": True})
+
+    def flush(self):
+        if self.mirror is not None:
+            self.mirror.flush()
+
+    def wait_for_work(self, timeout):
+        """ Blocks until work has been queued since the last time we waited, or until the timeout
+        :param timeout: The most seconds to wait
+        """
+        with self.__condition:
+            if self.__queued_count == self.__waited_count:
+                self.__condition.wait(timeout)
+            self.__waited_count = self.__queued_count
+
+    def __mirror_update(self, work, fields):
+        if self.mirror is not None and work.mirror_record_id is not None:
+            self.mirror.update(work.mirror_record_id, fields)
+
+    def __connection(self):
+        """ Returns this thread's connection to the database, since SQLite connections can't be shared """
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self.__local.connection = connection
+        return connection
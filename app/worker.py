@@ -0,0 +1,464 @@
+""" The worker process: polls twitter for submissions, scores the work queue and replies, and keeps the airtable
+    housekeeping (tokens, duplicates, the submission index) up to date.  Run it with PROC_TYPE=worker python app/app.py
+"""
+import os
+import json
+import random
+import sys
+import asyncio
+import traceback
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import polling
+import lz_string
+import services
+from airtable_governor import AirtableGovernor
+from scoring import ScoringServiceError
+from token_refresh import TokenRefreshScheduler
+from metrics import metrics, api_calls
+
+# Maximum number of work items being scored at once, and how long we'll wait on any single one of them
+WORK_QUEUE_CONCURRENCY = int(os.environ.get("WORK_QUEUE_CONCURRENCY", "4"))
+WORK_ITEM_TIMEOUT_SECONDS = float(os.environ.get("WORK_ITEM_TIMEOUT_SECONDS", "180"))
+# How many work items we read from the queue per request, and at most per pass, so one pass can't hog the worker
+WORK_QUEUE_PAGE_SIZE = int(os.environ.get("WORK_QUEUE_PAGE_SIZE", "25"))
+WORK_QUEUE_MAX_ROWS_PER_CYCLE = int(os.environ.get("WORK_QUEUE_MAX_ROWS_PER_CYCLE", "200"))
+# How long before a user token expires we refresh it, and the most we delay each refresh by to spread them out
+TOKEN_REFRESH_MARGIN_SECONDS = float(os.environ.get("TOKEN_REFRESH_MARGIN_SECONDS", "900"))
+TOKEN_REFRESH_JITTER_SECONDS = float(os.environ.get("TOKEN_REFRESH_JITTER_SECONDS", "60"))
+# How we challenge others on a puzzle's original thread after a new leaderboard entry: "digest" (one reply per
+# puzzle every CHALLENGER_DIGEST_WINDOW_SECONDS, see ChallengerDigest), "each" (one reply per entry) or "off".
+# Digests are kept in redis, so without REDIS_URL we default to "each".
+CHALLENGER_REPLY_MODE = os.environ.get("CHALLENGER_REPLY_MODE", "digest" if "REDIS_URL" in os.environ else "each")
+CHALLENGER_DIGEST_POLL_SECONDS = float(os.environ.get("CHALLENGER_DIGEST_POLL_SECONDS", "30"))
+
+in_flight_work = set()
+# Work items that have finished scoring, but whose completion may not have been written yet.  They stay in
+# in_flight_work until it has, otherwise the next pass would read them back from the queue and score them again.
+finished_work = set()
+in_flight_work_lock = threading.Lock()
+
+
+def get_scoring_executor():
+    """ Returns the threads that do_scoring runs on, since it blocks (scoring service, airtable and twitter calls).
+        Their airtable requests are user-facing, so they go ahead of everything else's (see AirtableGovernor).
+    :return: A ThreadPoolExecutor
+    """
+    return services.get_or_build("scoring_executor", lambda: ThreadPoolExecutor(
+        max_workers=WORK_QUEUE_CONCURRENCY, thread_name_prefix="scoring",
+        initializer=services.get_persistence().governor.set_thread_priority,
+        initargs=(AirtableGovernor.PRIORITY_SCORING,)))
+
+
+@metrics.timer("scoring.stage.reply.error")
+def notify_user_unknown_error(player_name, tweet_id):
+    """ Tweet a generic error response to a submitter.
+    :param playerName: The name of the player we're responding to
+    :param tweetId: The ID of the tweet they submitted their answer with
+    """
+    error_message = "Sorry, I encountered an error scoring that submission :("
+    metrics.incr("error.unknown", 1)
+    services.get_twitter_client().post_tweet(error_message, tweet_id)
+
+
+@metrics.timer("scoring.stage.reply.duplicate")
+def notify_user_highscore_already_exists(player_name, tweet_id, cached_result):
+    """ Tweet a response to a submitter saying that their high score already existed
+    :param playerName: The name of the player we're responding to
+    :param tweetId: The ID of the tweet they submitted their answer with
+    :param cachedResult: The duplicate high-score record
+    """
+    print("We should notify user %s of duplicate high score re: tweet with ID: %s" % (player_name, tweet_id))
+    twitter_client = services.get_twitter_client()
+    error_message = "Sorry, someone already submitted that solution — try again with a different answer!"
+    media = None
+    if "fields" in cached_result and "gameplay" in cached_result["fields"] and len(
+            cached_result["fields"]["gameplay"]) > 0:
+        try:
+            media = twitter_client.upload_media(cached_result["fields"]["gameplay"], "video/mp4")
+        except Exception as e:
+            media = None
+    twitter_client.post_tweet(error_message, tweet_id, media)
+
+
+@metrics.timer("scoring.stage.reply.invalid_puzzle")
+def notify_user_invalid_puzzle(player_name, tweet_id):
+    """ Tweet a response to a submitter saying that their submission was invalid, because the puzzle didn't exist
+    :param player_name:
+    :param tweet_id:
+    """
+    print("We should notify user %s of invalid puzzle on tweet with ID: %s" % (player_name, tweet_id))
+    error_message = "I'm terribly sorry, but I'm not aware of a puzzle with that name!"
+    metrics.incr("error.invalid_puzzle", 1)
+    services.get_twitter_client().post_tweet(error_message, tweet_id)
+
+
+@api_calls.counted("scoring.work")
+def do_scoring(work):
+    """ Perform scoring for an item on the work queue.  NOTE: this blocks, so it should be run on the scoring executor.
+        Each stage is timed as scoring.stage.<stage>, and the airtable / twitter calls made are counted per work item.
+    :param work: A QueuedWork item that needs to be scored and responded to
+    :return: N/A
+    """
+    persistence = services.get_persistence()
+    twitter_client = services.get_twitter_client()
+
+    # Note - we need to load the puzzle URL from the Puzzles table
+    puzzle_id = work.puzzle_id
+    expression = work.expression
+    player_name = work.twitter_handle
+    tweet_id = work.tweet_id
+
+    # Note - the attempt was counted (and written) before scoring started, see process_work_queue_async
+    attempts = work.attempts
+
+    print("[Attempt %d] Scoring tweet: %s user: %s puzzle_id: %s expression: \"%s\"" % (
+    attempts, tweet_id, player_name, puzzle_id, expression))
+
+    try:
+        with metrics.timer("scoring.stage.puzzle_load"):
+            puzzle = services.get_puzzle_cache().get(puzzle_id)
+
+        # Validate that the puzzle exists
+        if puzzle is None:
+            persistence.complete_queued_work(work)
+            notify_user_invalid_puzzle(player_name, tweet_id)
+            return
+
+        # Construct the proper level URL based on the puzzle id + expression by using the (cached) decoded
+        # puzzle definition, and then inserting the expression into it
+        url_prefix = puzzle.url_prefix
+        exploded_puzzle_data = puzzle.with_expression(expression)
+
+        responses = [
+            "Grooooovy! You're on the leaderboard for %s with a time of %f (speedy!!) and a character count of %d! Also, we made you an *awesome* video of your run!\r\n%s",
+            "Woohoo!! You're on the leaderboard for %s with a time of %f (vroom vroom!) and a character count of %d! Check out this super cool video of your run!\r\n%s",
+            "🥳🥳🥳 You're on the %s leaderboard with a super speedy time of %f and a character count of %d! We even made this groovy video of your run!\r\n%s",
+            "Cowabunga! You've made it onto the %s leaderboard! You got an unbelievably fast time of %f (WOW!) and a character count of %d! There's even a super cool video of your run!\r\n%s",
+        ]
+
+        # update messages if copy update is needed
+        # thread_messages = [
+        #    "Grooooovy! You're on the leaderboard for %s with a time of %f (speedy!!) and a character count of %d! Also, we made you an *awesome* video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
+        #    "Woohoo!! You're on the leaderboard for %s with a time of %f (vroom vroom!) and a character count of %d! Check out this super cool video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
+        #    "🥳🥳🥳 You're on the %s leaderboard with a super speedy time of %f and a character count of %d! We even made this groovy video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
+        #    "Cowabunga! You've made it onto the %s leaderboard! You got an unbelievably fast time of %f (WOW!) and a character count of %d! There's even a super cool video of your run!\r\nCheck your spot on the leaderboards here: %s\r\nRemix their solution: %s",
+        # ]
+
+        submission_url = url_prefix + "?" + lz_string.compress_to_base64(json.dumps(exploded_puzzle_data))
+
+        # See if we have already scored this submission, or one that only differs trivially (e.g. in spacing)
+        with metrics.timer("scoring.stage.duplicate_check"):
+            cached_result = persistence.get_submission_with_url(submission_url)
+            if cached_result is None and puzzle.level is not None:
+                cached_result = persistence.get_submission_with_expression(puzzle.level, expression)
+        if cached_result is not None:
+            print("Invalid (duplicate) submission...")
+            persistence.complete_queued_work(work)
+            notify_user_highscore_already_exists(player_name, tweet_id, cached_result)
+            return
+
+        with metrics.timer("scoring.stage.scoring"):
+            score_data, shared = services.get_scoring_client().score(submission_url)
+
+        if shared:
+            # Someone else in this batch submitted the same solution, and they get the leaderboard spot
+            print("Invalid (duplicate) submission, scored concurrently...")
+            persistence.complete_queued_work(work)
+            notify_user_highscore_already_exists(player_name, tweet_id, {"fields": score_data})
+            return
+
+        with metrics.timer("scoring.stage.leaderboard_write"):
+            persistence.add_leaderboard_entry(player_name, score_data, submission_url)
+
+        # Mark this job as complete
+        persistence.complete_queued_work(work)
+
+        if "time" not in score_data or score_data["time"] is None:
+            print("Invalid (>30s) submission...")
+            msg = "Sorry, that submission takes longer than 30 seconds to evaluate, so we had to disqualify it. :( Try again with a new solution!"
+            with metrics.timer("scoring.stage.reply.disqualified"):
+                twitter_client.post_tweet(msg, tweet_id)
+        else:
+            print("Successful submission!")
+            leaderboards = persistence.leaderboards
+            if leaderboards.loaded:
+                rank, total = leaderboards.rank(score_data["level"], score_data["time"], score_data["charCount"])
+                leaderboard_message = "You're #%d of %d! See the leaderboards here: %s" % (
+                    rank, total, os.environ["LEADERBOARD_URI"])
+            else:
+                leaderboard_message = "Check your spot on the leaderboards here: %s" % os.environ["LEADERBOARD_URI"]
+            msg = random.choice(responses) % (
+                score_data["level"], score_data["time"], score_data["charCount"], leaderboard_message)
+
+            try:
+                # Upload video...
+                with metrics.timer("scoring.stage.media_upload"):
+                    media_ids = twitter_client.upload_media(score_data["gameplay"], "video/mp4")
+
+                # Respond to the submission thread
+                print("Replying to submission thread")
+                with metrics.timer("scoring.stage.reply.submission"):
+                    twitter_client.post_tweet(msg, tweet_id, media_ids)
+
+                # Challenge others on the original thread, in the next digest or straight away
+                if CHALLENGER_REPLY_MODE == "digest":
+                    services.get_challenger_digest().add(puzzle_id, player_name, score_data["time"],
+                                                         score_data["charCount"], media_ids)
+                elif CHALLENGER_REPLY_MODE == "each":
+                    with metrics.timer("scoring.stage.config_read"):
+                        original_thread_id = persistence.get_config("twitter_%s" % puzzle_id, None)
+                    if original_thread_id is not None:
+                        print("Replying to original thread (%s)" % (original_thread_id))
+                        message = "We've just gotten a new submission in from {}! Can you beat them?".format(
+                            player_name)
+                        with metrics.timer("scoring.stage.reply.original_thread"):
+                            twitter_client.post_tweet(message, original_thread_id, media_ids, use_primary_bot=True)
+            except Exception as e:
+                print(e)
+
+    except ScoringServiceError as e:
+        print(e)
+        notify_user_unknown_error(player_name, tweet_id)
+        persistence.complete_queued_work(work)
+
+    except Exception as e:
+        metrics.incr("error.scoring_failure", 1)
+        traceback.print_exc()
+
+        # We need to eventually give up...
+        if attempts >= 3:
+            notify_user_unknown_error(player_name, tweet_id)
+            persistence.complete_queued_work(work)
+
+def process_work_queue():
+    asyncio.run(process_work_queue_async())
+
+async def run_scoring_task(work, semaphore):
+    """ Scores a single work item on the scoring executor, isolating its failures from the rest of the batch
+    :param work: A QueuedWork item that needs to be scored and responded to
+    :param semaphore: Limits how many work items are in flight at once
+    :return: The number of seconds spent on this work item
+    """
+    async with semaphore:
+        start = time.time()
+        try:
+            future = get_scoring_executor().submit(do_scoring, work)
+            # Note - this fires when the scoring thread actually finishes, even if we stopped waiting on it
+            future.add_done_callback(lambda f: release_in_flight_work(work))
+            await asyncio.wait_for(asyncio.wrap_future(future), timeout=WORK_ITEM_TIMEOUT_SECONDS)
+            metrics.incr("workqueue.work.success", 1)
+        except asyncio.TimeoutError:
+            # Note - the scoring thread can't be interrupted, it'll finish (or fail) in the background
+            metrics.incr("error.workqueue.timeout", 1)
+            print("Timed out after %ds scoring tweet: %s" % (WORK_ITEM_TIMEOUT_SECONDS, work.tweet_id))
+        except Exception as e:
+            metrics.incr("error.workqueue.work", 1)
+            traceback.print_exc()
+        elapsed = time.time() - start
+        metrics.timing("workqueue.work.duration", elapsed * 1000)
+        return elapsed
+
+def release_in_flight_work(work):
+    with in_flight_work_lock:
+        finished_work.add(work.record_id)
+
+
+def record_work_attempts(persistence, page):
+    """ Counts an attempt at each work item in a page, and writes the counts.  NOTE: this blocks.
+    :param persistence: Persistence API
+    :param page: A list of QueuedWork items that are about to be scored
+    """
+    for work in page:
+        persistence.increment_attempts_queued_work(work)
+    flush_work_queue_updates(persistence)
+
+def flush_work_queue_updates(persistence):
+    """ Writes the buffered work queue updates, then stops treating finished work items whose updates have landed as
+        in flight
+    :param persistence: Persistence API
+    """
+    try:
+        persistence.flush_queued_work_updates()
+    except Exception as e:
+        print("Failed to flush work queue updates: %s" % e)
+
+    pending = persistence.get_queued_work_ids_pending_update()
+    with in_flight_work_lock:
+        released = finished_work - pending
+        finished_work.difference_update(released)
+        in_flight_work.difference_update(released)
+
+async def process_work_queue_async():
+    """ Attempt to process everything in the work queue, scoring up to WORK_QUEUE_CONCURRENCY items at once.  Work
+        items start being scored as soon as the page they're on has been read. """
+    print("Processing work queue")
+    metrics.incr("workqueue.start", 1)
+    persistence = services.get_persistence()
+    semaphore = asyncio.Semaphore(WORK_QUEUE_CONCURRENCY)
+    tasks = []
+    batch_start = time.time()
+    try:
+        loop = asyncio.get_running_loop()
+        # Completions buffered since the last pass (e.g. by work that timed out and finished late) have to land
+        # before we read the queue, or we'd score those items again
+        await loop.run_in_executor(None, flush_work_queue_updates, persistence)
+        pages = persistence.get_all_queued_work(page_size=WORK_QUEUE_PAGE_SIZE, max_rows=WORK_QUEUE_MAX_ROWS_PER_CYCLE)
+        while True:
+            # Note - reading a page blocks, so we do it off the event loop while earlier pages are being scored
+            page = await loop.run_in_executor(None, next, pages, None)
+            if page is None:
+                break
+            # Items that timed out last time may still be running, we don't want to reply to them twice
+            with in_flight_work_lock:
+                page = [work for work in page if work.record_id not in in_flight_work]
+                in_flight_work.update(work.record_id for work in page)
+
+            # Count each attempt, and write the counts before scoring, so that an item which keeps crashing the
+            # worker is still given up on after 3 attempts.  NOTE: buffering an update can write a full batch, so
+            # this is done off the event loop too
+            await loop.run_in_executor(None, record_work_attempts, persistence, page)
+
+            for work in page:
+                metrics.incr("workqueue.work", 1)
+                tasks.append(asyncio.create_task(run_scoring_task(work, semaphore)))
+
+    except Exception as e:
+        metrics.incr("error.workqueue", 1)
+        print("Exception: %s" % e)
+
+    # Anything we started scoring gets finished, even if reading a later page failed
+    durations = await asyncio.gather(*tasks)
+    batch_wall_time = time.time() - batch_start
+
+    if len(durations) > 0:
+        # Comparing these two tells us how much we're actually gaining from running work items concurrently
+        metrics.timing("workqueue.batch.wall_time", batch_wall_time * 1000)
+        metrics.timing("workqueue.batch.summed_work_time", sum(durations) * 1000)
+        print("Scored %d work items in %.2fs (%.2fs of work)" % (len(durations), batch_wall_time, sum(durations)))
+
+    # Completion flags are buffered while scoring, they need to land before the next poll
+    await asyncio.get_running_loop().run_in_executor(None, flush_work_queue_updates, persistence)
+    print("Work queue end")
+    sys.stdout.flush()
+
+
+def start_work_queue_polling():
+    """ Attempts to process the work queue every 10 seconds, or as soon as new work is queued if the work queue
+        backend can tell us (see WORK_QUEUE_BACKEND). """
+    while True:
+        process_work_queue()
+        services.get_persistence().wait_for_queued_work(10)
+
+
+def start_refresh_token_polling():
+    """ Refreshes each user token TOKEN_REFRESH_MARGIN_SECONDS before it expires (they last 2 hours), retrying failed
+        refreshes with backoff - see TokenRefreshScheduler. """
+    twitter_client = services.get_twitter_client()
+    scheduler = TokenRefreshScheduler(twitter_client.get_v20_accounts(), twitter_client.refresh_token,
+                                      twitter_client.get_token_expires_at,
+                                      refresh_margin_seconds=TOKEN_REFRESH_MARGIN_SECONDS,
+                                      jitter_seconds=TOKEN_REFRESH_JITTER_SECONDS)
+    scheduler.run_forever()
+
+
+def start_challenger_digest_polling():
+    """ Posts each puzzle's new challenger digest once its window has ended, checking every
+        CHALLENGER_DIGEST_POLL_SECONDS. """
+    persistence = services.get_persistence()
+    twitter_client = services.get_twitter_client()
+    challenger_digest = services.get_challenger_digest()
+
+    def post_digest(puzzle_id, message, media_ids):
+        original_thread_id = persistence.get_config("twitter_%s" % puzzle_id, None)
+        if original_thread_id is None:
+            # Not published by us, so there's no thread to reply to
+            return
+        print("Replying to original thread (%s) with new challenger digest" % (original_thread_id))
+        with metrics.timer("challengers.digest.reply"):
+            twitter_client.post_tweet(message, original_thread_id, media_ids, use_primary_bot=True)
+
+    polling.poll(lambda: challenger_digest.flush_due(post_digest), step=CHALLENGER_DIGEST_POLL_SECONDS,
+                 poll_forever=True, ignore_exceptions=(Exception,))
+
+
+def start_submission_tweet_polling():
+    """ Attempts to poll Twitter for new submissions to process.  NOTE: the interval adapts between 5 and 60
+        seconds depending on how busy the hashtag is, but never outpaces our remaining budget for
+        GET_2_tweets_search_recent (60 requests per 15 minutes per account - see
+        https://developer.twitter.com/en/docs/twitter-api/rate-limits)"""
+    twitter_client = services.get_twitter_client()
+    while True:
+        try:
+            twitter_client.queue_new_tweet_submissions()
+        except Exception as e:
+            traceback.print_exc()
+        time.sleep(twitter_client.submission_poll_interval.next_interval())
+
+def log_poll_errors(target, error_metric):
+    """ Wraps a polling target so that its failures are logged and counted, rather than silently ignored, before
+        polling carries on
+    :param target: The function to poll
+    :param error_metric: The metric to increment when target raises
+    :return: A function that calls target, returning None if it raised
+    """
+    def poll_target():
+        try:
+            return target()
+        except Exception as e:
+            metrics.incr(error_metric, 1)
+            traceback.print_exc()
+            return None
+    return poll_target
+
+def start_submission_index_polling():
+    """ Loads the duplicate submission index, then picks up leaderboard entries added elsewhere every 10 minutes. """
+    persistence = services.get_persistence()
+    persistence.governor.set_thread_priority(AirtableGovernor.PRIORITY_HOUSEKEEPING)
+    polling.poll(log_poll_errors(persistence.submission_index.reconcile, "submission_index.load_errors"),
+                 step=60*10, poll_forever=True)
+
+def start_duplicates_polling():
+    """
+        Poll airtable every 30 minutes to remove duplicate submissions 
+    """
+    persistence = services.get_persistence()
+    persistence.governor.set_thread_priority(AirtableGovernor.PRIORITY_HOUSEKEEPING)
+    polling.poll(log_poll_errors(persistence.poll_duplicate_submissions, "duplicates.scan_errors"),
+                 step=60*30, poll_forever=True)
+
+
+def post_test_tweets():
+    twitter_client = services.get_twitter_client()
+
+    # This tweet should timeout
+    twitter_client.post_tweet("#testrider puzzle_1 x%s" % (str(random.randint(-1000000, 1000000))))
+
+    # This is a valid submission that should be scored
+    rand_num = random.randint(0, 1000000)
+    solution = '.001x^2\\cdot .001x^4-2\\ +\\ -.05x^2\\ +\\ \\left(.5\\log \\left(x\\right)+5\\right)+\\sin \\left(17t\\right)' \
+        .replace(" ", "")
+    twitter_client.post_tweet("#testrider puzzle_21 %s+%d-%d" % (solution, rand_num, rand_num))
+
+    # This tweet should result in an "invalid puzzle" response
+    twitter_client.post_tweet("#testrider puzzle_234234 x%s" % (str(random.randint(-1000000, 1000000))))
+
+
+def start_worker(daemon=False):
+    """ Starts the worker's polling threads
+    :param daemon: (optional) Whether the threads should stop when the rest of the process does
+    """
+    if services.AUTHORIZE_MANUALLY:
+        services.get_twitter_client().force_user_authentication()
+
+    if services.TESTING:
+        post_test_tweets()
+
+    targets = [start_work_queue_polling, start_refresh_token_polling, start_submission_tweet_polling,
+               start_duplicates_polling, start_submission_index_polling]
+    if CHALLENGER_REPLY_MODE == "digest":
+        targets.append(start_challenger_digest_polling)
+    for target in targets:
+        threading.Thread(target=target, daemon=daemon).start()
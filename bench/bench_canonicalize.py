@@ -0,0 +1,76 @@
+""" Runs expressions.canonicalize over a corpus of resubmissions, checks which ones are recognised as equivalent, and
+    reports how many renders the expression index would have saved and how long canonicalizing takes:
+
+        python bench/bench_canonicalize.py [iterations]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("GRAPHITE", "127.0.0.1")
+
+from expressions import canonicalize, ExpressionIndex
+from sample_puzzles import SAMPLE_EXPRESSIONS
+
+# (original submission, resubmission, whether they should be treated as the same submission)
+CORPUS = [
+    ("\\sin\\left(x\\right)", "\\sin(x)", True),
+    ("\\sin\\left(x\\right)", "\\sin \\left( x \\right)", True),
+    ("x^{2}-3x", "x^{2}\\ -\\ 3x", True),
+    ("x^{2}-3x", "x^{2}\\,-\\;3x", True),
+    ("x^{2}-3x", "x^{2}-3x+482913-482913", True),
+    ("x^{2}-3x", "x^{2}-3x-17+17", True),
+    ("x^{2}-3x", "x^{2}-3x+1+2-2-1", True),
+    ("\\cos(x)", "\\cos(x+.5-.5)", True),
+    ("-\\left|x-4\\right|+3", "-|x-4|+3", True),
+    ("\\sin x", "\\sin\\ \\,  x", True),
+    (".001x^2\\cdot .001x^4-2\\ +\\ -.05x^2\\ +\\ \\left(.5\\log \\left(x\\right)+5\\right)+\\sin \\left(17t\\right)",
+     ".001x^2\\cdot.001x^4-2+-.05x^2+\\left(.5\\log\\left(x\\right)+5\\right)+\\sin\\left(17t\\right)+715-715", True),
+    # These change what the expression means, so they must still be scored
+    ("x", "x+5-5x", False),
+    ("x", "x+5-5^2", False),
+    ("x", "x+5-55", False),
+    ("x^2", "x^{+5-5}", False),
+    ("x", "x\\cdot+5-5", False),
+    ("\\sin(x)", "\\sin(2x)", False),
+    ("\\sin x", "\\sinx", False),
+]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    failures = 0
+    index = ExpressionIndex()
+    renders_avoided = 0
+    for i, (original, resubmission, should_match) in enumerate(CORPUS):
+        matches = canonicalize(original) == canonicalize(resubmission)
+        if matches != should_match:
+            failures += 1
+            print("MISMATCH: %r vs %r (expected %s, canonical forms %r / %r)" % (
+                original, resubmission, should_match, canonicalize(original), canonicalize(resubmission)))
+
+        if index.find("puzzle_1", original) is None:
+            index.add("puzzle_1", original, "rec%d" % i)
+        if index.find("puzzle_1", resubmission) is not None:
+            renders_avoided += 1
+        else:
+            index.add("puzzle_1", resubmission, "rec%d_resubmission" % i)
+
+    print("corpus: %d/%d pairs as expected, %d renders avoided" % (len(CORPUS) - failures, len(CORPUS),
+                                                                  renders_avoided))
+
+    expressions = [pair[1] for pair in CORPUS] + SAMPLE_EXPRESSIONS
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for expression in expressions:
+            canonicalize(expression)
+    elapsed = time.perf_counter() - start
+    print("canonicalize: %.2fus per expression" % (elapsed * 1e6 / (iterations * len(expressions))))
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+""" Measures the cold start of each process type with python -X importtime: the web process (importing app and
+    creating the Flask app, as gunicorn does) and the worker process (importing worker and building its clients), each
+    in a fresh interpreter with dummy configuration, taking the best of several runs.  Lists the heaviest imports, and
+    exits with status 1 if either process goes over its budget:
+
+        python bench/bench_import_time.py [--runs 5] [--web-budget-ms 250] [--worker-budget-ms 500] [--top 10]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+PROCESSES = {
+    "web": "import app; app.create_app()",
+    "worker": "import worker, services; services.get_persistence(); services.get_twitter_client(); "
+              "services.get_puzzle_cache(); services.get_scoring_client()",
+}
+
+DUMMY_ENVIRONMENT = {
+    "GRAPHITE": "127.0.0.1",
+    "SINERIDER_SCORING_SERVICE": "http://127.0.0.1:1/",
+    "LEADERBOARD_URI": "https://sinerider.com/leaderboard",
+    "AIRTABLE_API_KEY": "fake_airtable_key",
+    "AIRTABLE_BASE_ID": "appFakeBase",
+    "TWITTER_CREDENTIALS_JSON": json.dumps({"v20_tokens": [], "v11_tokens": []}),
+    "REDIRECT_URI": "http://127.0.0.1/",
+    # Nothing listens here, redis clients only connect when they're first used
+    "REDIS_URL": "redis://127.0.0.1:1/0",
+}
+
+
+def measure(proc_type, code):
+    """ Runs one cold start
+    :param proc_type: The process type
+    :param code: The code that starts the process
+    :return: (total import time in ms, {module: import time in ms, not counting the modules it imports})
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = dict(os.environ, PROC_TYPE=proc_type, WORK_QUEUE_SQLITE_PATH=os.path.join(work_dir, "work_queue.db"),
+                   **DUMMY_ENVIRONMENT)
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=APP_DIR, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+
+    total = 0
+    modules = {}
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nested imports are indented
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        modules[module.strip()] = int(self_us) / 1000
+        if not module.startswith("  "):
+            total += int(cumulative_us) / 1000
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--web-budget-ms", type=float, default=250)
+    parser.add_argument("--worker-budget-ms", type=float, default=500)
+    parser.add_argument("--top", type=int, default=10, help="How many of the heaviest imports to list")
+    args = parser.parse_args()
+
+    budgets = {"web": args.web_budget_ms, "worker": args.worker_budget_ms}
+    over_budget = False
+    for proc_type, code in PROCESSES.items():
+        total, modules = min((measure(proc_type, code) for _ in range(args.runs)), key=lambda run: run[0])
+        print("%-6s %7.1f ms (budget %.0f ms)" % (proc_type, total, budgets[proc_type]))
+        for name, ms in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+            print("    %-40s %7.1f ms" % (name, ms))
+        if total > budgets[proc_type]:
+            print("    over budget!")
+            over_budget = True
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+""" Checks Leaderboards' ranks against sorting the whole leaderboard, for a random stream of entries (with plenty of
+    ties) across a few levels, some of which are then removed, then times adding an entry and looking up its rank on a large leaderboard against
+    scanning it, which is what ranking each submission would take without it:
+
+        python bench/bench_leaderboard.py [entries]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("GRAPHITE", "127.0.0.1")
+
+from leaderboard import Leaderboards
+
+LEVELS = ["puzzle_1", "puzzle_2", "puzzle_3"]
+
+
+def random_entry(rng, i):
+    return "rec%014d" % i, rng.choice(LEVELS), round(rng.uniform(1, 30), 1), rng.randint(5, 40), "player_%d" % i
+
+
+def scan_rank(entries, level, time_seconds, char_count):
+    """ Ranks an entry the way we'd have to without Leaderboards: by looking at every entry for the level """
+    level_entries = [entry for entry in entries if entry[1] == level]
+    return 1 + sum(1 for entry in level_entries if (entry[2], entry[3]) < (time_seconds, char_count)), len(level_entries)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(25)
+
+    failures = 0
+    leaderboards = Leaderboards()
+    entries = []
+    for i in range(2000):
+        entry = random_entry(rng, i)
+        leaderboards.add(*entry)
+        # Adding an entry again (e.g. when reconciling) mustn't change anything
+        leaderboards.add(*entry)
+        entries.append(entry)
+        if leaderboards.rank(entry[1], entry[2], entry[3]) != scan_rank(entries, entry[1], entry[2], entry[3]):
+            failures += 1
+    # Entries deleted from the Leaderboard table are removed
+    for entry in entries[::7]:
+        leaderboards.remove(entry[0])
+    entries = [entry for i, entry in enumerate(entries) if i % 7 != 0]
+    for level in LEVELS:
+        _, total, top = leaderboards.get_top(level, 50)
+        expected = sorted((entry[2], entry[3]) for entry in entries if entry[1] == level)
+        if total != len(expected) or [(row["time"], row["charCount"]) for row in top] != expected[:50] or \
+                any(row["rank"] != scan_rank(entries, level, row["time"], row["charCount"])[0] for row in top):
+            failures += 1
+    print("correctness: %d ranks checked, %d mismatches" % (len(entries), failures))
+
+    leaderboards = Leaderboards()
+    entries = [random_entry(rng, i) for i in range(count)]
+    start = time.perf_counter()
+    for entry in entries:
+        leaderboards.add(*entry)
+    print("load %d entries: %.2fs" % (count, time.perf_counter() - start))
+
+    new_entries = [random_entry(rng, count + i) for i in range(1000)]
+    start = time.perf_counter()
+    for entry in new_entries:
+        leaderboards.add(*entry)
+        leaderboards.rank(entry[1], entry[2], entry[3])
+    incremental = (time.perf_counter() - start) / len(new_entries)
+
+    start = time.perf_counter()
+    for entry in new_entries[:20]:
+        scan_rank(entries, entry[1], entry[2], entry[3])
+    scan = (time.perf_counter() - start) / 20
+    print("add + rank: %.1fus incremental, %.1fus scanning (%.0fx)" % (incremental * 1e6, scan * 1e6,
+                                                                     scan / incremental))
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+""" End-to-end load test of the worker, offline.  Starts the stand-ins in fake_services.py (in their own process), points
+    the real app at them, and runs the worker's polling threads (submission search, work queue, token refresh,
+    duplicate scan and submission index) while submission tweets are posted at a steady rate.  Then waits for every
+    submission to be replied to, and reports:
+
+    - latency from each submission tweet being posted to the bot's first reply to it (p50 / p95 / p99)
+    - API calls per submission, for airtable, twitter (including media uploads) and the scoring service
+    - the worker's peak RSS and CPU time
+
+        python bench/bench_load.py [--rate 0.5] [--duration 60] [--render-delay-ms 2000] [--gameplay-kb 512] ...
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse, urlunparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import lz_string
+from sample_puzzles import SAMPLE_PUZZLE_DEFINITION, SAMPLE_EXPRESSIONS
+
+# The hosts the bot's libraries call, and which fake service stands in for each
+FAKE_HOSTS = {
+    "api.airtable.com": "airtable",
+    "api.twitter.com": "twitter",
+    "upload.twitter.com": "upload",
+}
+BOT_TWITTER_USER_IDS = ["900000000000000001", "900000000000000002"]
+
+
+def redirect_to_fakes(ports):
+    """ Sends every request for a real service's host to the fake service standing in for it, over plain HTTP.  Paths
+        are left alone, so e.g. rate limit budgets are still tracked under the real endpoint names. """
+    send = HTTPAdapter.send
+
+    def redirected_send(adapter, request, **kwargs):
+        url = urlparse(request.url)
+        service = FAKE_HOSTS.get(url.hostname, None)
+        if service is not None:
+            request.url = urlunparse(url._replace(scheme="http", netloc="127.0.0.1:%d" % ports[service]))
+        return send(adapter, request, **kwargs)
+
+    HTTPAdapter.send = redirected_send
+
+
+def start_fake_services(args, puzzle_url):
+    seed = {
+        "Puzzles": [{"id": "puzzle_1", "puzzleURL": puzzle_url}],
+        "Config": [{"config_name": "twitter_puzzle_1", "value": "1500000000000000001"}] +
+                  [{"config_name": "user_bearer_token_client_%d" % i, "value": "bearer_%d" % i}
+                   for i in range(len(BOT_TWITTER_USER_IDS))] +
+                  [{"config_name": "user_refresh_token_client_%d" % i, "value": "refresh_%d" % i}
+                   for i in range(len(BOT_TWITTER_USER_IDS))],
+    }
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "fake_services.py"),
+         "--render-delay-ms", str(args.render_delay_ms), "--gameplay-kb", str(args.gameplay_kb),
+         "--airtable-latency-ms", str(args.airtable_latency_ms), "--seed", json.dumps(seed)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    ports = json.loads(process.stdout.readline())
+    return process, ports
+
+
+def configure_environment(args, ports, work_dir):
+    credentials = {
+        "v20_tokens": [{"client_id": "client_%d" % i, "client_secret": "secret_%d" % i, "twitter_user_id": user_id}
+                       for i, user_id in enumerate(BOT_TWITTER_USER_IDS)],
+        "v11_tokens": [{"consumer_key": "key_%d" % i, "consumer_secret": "secret_%d" % i,
+                        "access_token": "token_%d" % i, "access_token_secret": "token_secret_%d" % i}
+                       for i in range(len(BOT_TWITTER_USER_IDS))],
+    }
+    os.environ.update({
+        "GRAPHITE": "127.0.0.1",
+        "PROC_TYPE": "worker",
+        "SINERIDER_SCORING_SERVICE": "http://127.0.0.1:%d/" % ports["scoring"],
+        "LEADERBOARD_URI": "https://sinerider.com/leaderboard",
+        "AIRTABLE_API_KEY": "fake_airtable_key",
+        "AIRTABLE_BASE_ID": "appFakeBase",
+        "TWITTER_CREDENTIALS_JSON": json.dumps(credentials),
+        "REDIRECT_URI": "http://127.0.0.1/",
+        "WORK_QUEUE_BACKEND": args.work_queue_backend,
+        "WORK_QUEUE_SQLITE_PATH": os.path.join(work_dir, "bench_load_work_queue.db"),
+        "CHALLENGER_DIGEST_WINDOW_SECONDS": str(args.challenger_digest_window),
+        "CHALLENGER_DIGEST_POLL_SECONDS": "1",
+        # Only the worker runs, so it gets the whole airtable budget
+        "AIRTABLE_PROCESS_COUNT": "1",
+    })
+    if "redis" in ports:
+        os.environ["REDIS_URL"] = "redis://127.0.0.1:%d/0" % ports["redis"]
+    else:
+        # Without redis there's nowhere to keep challenger digests
+        os.environ.pop("REDIS_URL", None)
+        print("fakeredis isn't installed, replying to each new challenger rather than in digests")
+
+
+def post_submissions(ports, rate, duration, duplicate_fraction):
+    """ Posts submission tweets at a steady rate, some of them repeating an earlier expression
+    :return: The number of submissions posted
+    """
+    session = requests.Session()
+    expressions = []
+    count = 0
+    start = time.time()
+    while time.time() - start < duration:
+        if len(expressions) > 0 and random.random() < duplicate_fraction:
+            expression = random.choice(expressions)
+        else:
+            expression = "%s+%d" % (random.choice(SAMPLE_EXPRESSIONS), random.randint(0, 10 ** 9))
+            expressions.append(expression)
+        text = ("My solution for the #sinerider puzzle of the day #puzzle_1 took 3.2 seconds with %d characters %s "
+                "Try solving it yourself: https://sinerider.com/?abc" % (len(expression), expression))
+        session.post("http://127.0.0.1:%d/_submit" % ports["twitter"],
+                     json={"author_id": str(1000 + count), "author_name": "player_%d" % count, "text": text})
+        count += 1
+        time.sleep(max(0, start + count / rate - time.time()))
+    return count
+
+
+def get_stats(ports):
+    return {service: requests.get("http://127.0.0.1:%d/_stats" % port).json() for service, port in ports.items()
+            if service != "redis"}
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=0.5, help="Submissions per second")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to post submissions for")
+    parser.add_argument("--drain-timeout", type=float, default=300,
+                        help="Seconds to wait for the remaining replies once we've stopped posting")
+    parser.add_argument("--duplicate-fraction", type=float, default=0.1,
+                        help="Fraction of submissions that repeat an earlier expression")
+    parser.add_argument("--render-delay-ms", type=float, default=2000)
+    parser.add_argument("--gameplay-kb", type=int, default=512)
+    parser.add_argument("--airtable-latency-ms", type=float, default=100)
+    parser.add_argument("--work-queue-backend", default="airtable", choices=["airtable", "sqlite"])
+    parser.add_argument("--challenger-digest-window", type=float, default=10,
+                        help="Seconds each puzzle's new challenger digest collects entries for")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's output")
+    args = parser.parse_args()
+
+    puzzle_url = "https://sinerider.com/?" + lz_string.compress_to_base64(json.dumps(SAMPLE_PUZZLE_DEFINITION))
+    fakes, ports = start_fake_services(args, puzzle_url)
+    work_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        configure_environment(args, ports, work_dir)
+        redirect_to_fakes(ports)
+
+        bot_output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+        with bot_output:
+            import worker
+            worker.start_worker(daemon=True)
+
+            cpu_start = time.process_time()
+            submitted = post_submissions(ports, args.rate, args.duration, args.duplicate_fraction)
+            deadline = time.time() + args.drain_timeout
+            while True:
+                stats = get_stats(ports)
+                if stats["twitter"]["replied"] >= submitted or time.time() > deadline:
+                    break
+                time.sleep(1)
+            cpu_seconds = time.process_time() - cpu_start
+    finally:
+        fakes.kill()
+        for suffix in ["", "-wal", "-shm"]:
+            path = os.path.join(work_dir, "bench_load_work_queue.db" + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    latencies = stats["twitter"]["latencies"]
+    twitter_calls = stats["twitter"]["total_requests"] + stats["upload"]["total_requests"]
+    print()
+    print("submissions: %d posted at %.2f/s, %d replied to" % (submitted, args.rate, stats["twitter"]["replied"]))
+    print("tweet to reply latency: p50 %.2fs, p95 %.2fs, p99 %.2fs, max %.2fs" % (
+        percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+        max(latencies) if len(latencies) > 0 else float("nan")))
+    print("API calls per submission: airtable %.2f, twitter %.2f, scoring %.2f (airtable rate limited %d times)" % (
+        stats["airtable"]["total_requests"] / submitted, twitter_calls / submitted,
+        stats["scoring"]["total_requests"] / submitted, stats["airtable"]["rate_limited"]))
+    for service in ["airtable", "twitter", "upload"]:
+        for endpoint, count in sorted(stats[service]["requests"].items()):
+            print("    %-9s %-40s %d" % (service, endpoint, count))
+    print("worker: peak RSS %.1f MB, CPU %.2fs" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                                                   cpu_seconds))
+
+
+if __name__ == "__main__":
+    main()
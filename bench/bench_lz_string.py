@@ -0,0 +1,129 @@
+""" Checks that lz_string produces exactly what the lzstring package does, for puzzle URLs built from the sample
+    puzzle and expressions plus a corpus of random strings (including truncated and corrupted data), then times both
+    codecs encoding and decoding the puzzle URLs:
+
+        python bench/bench_lz_string.py [iterations]
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import lzstring
+import lz_string
+from sample_puzzles import SAMPLE_PUZZLE_DEFINITION, SAMPLE_EXPRESSIONS
+
+RANDOM_ALPHABET = "abcxyz0123456789{}[]\":,. \\^-+\x00\x7féü€∑\ud800"
+
+
+def puzzle_definitions():
+    """ Returns the puzzle definitions (as JSON) that scoring compresses: the sample puzzle with each sample
+        expression filled in """
+    definitions = [json.dumps(SAMPLE_PUZZLE_DEFINITION)]
+    for expression in SAMPLE_EXPRESSIONS:
+        puzzle_data = dict(SAMPLE_PUZZLE_DEFINITION)
+        puzzle_data["expressionOverride"] = expression
+        definitions.append(json.dumps(puzzle_data))
+    return definitions
+
+
+def random_strings(count):
+    rng = random.Random(17)
+    strings = ["", "a", "aa", "ab", "€"]
+    for _ in range(count):
+        alphabet = RANDOM_ALPHABET[:rng.randint(1, len(RANDOM_ALPHABET))]
+        length = rng.choice([1, 3, 10, 100, 1000])
+        strings.append("".join(rng.choice(alphabet) for _ in range(rng.randint(0, length))))
+    return strings
+
+
+def outcome(decompress, compressed):
+    """ Returns what decompressing gave, or that it failed (the two codecs raise different exception types) """
+    try:
+        return decompress(compressed)
+    except Exception:
+        return "<error>"
+
+
+def check(definitions):
+    lztranscoder = lzstring.LZString()
+    rng = random.Random(17)
+    failures = 0
+    checked = 0
+    for uncompressed in definitions + random_strings(2000):
+        expected = lztranscoder.compressToBase64(uncompressed)
+        compressed = lz_string.compress_to_base64(uncompressed)
+        checked += 1
+        if compressed != expected:
+            failures += 1
+            print("MISMATCH compressing %r: %r vs %r" % (uncompressed[:40], compressed, expected))
+            continue
+
+        cut = rng.randint(0, len(compressed))
+        corrupted = [
+            compressed,
+            compressed[:cut],
+            compressed[:cut] + "!" + compressed[cut:],
+            compressed[:cut] + rng.choice(lzstring.keyStrBase64) + compressed[cut + 1:],
+        ]
+        for data in corrupted:
+            checked += 1
+            expected = outcome(lztranscoder.decompressFromBase64, data)
+            decompressed = outcome(lz_string.decompress_from_base64, data)
+            if decompressed != expected:
+                failures += 1
+                print("MISMATCH decompressing %r: %r vs %r" % (data[:40], decompressed, expected))
+
+    for edge_case in [None, ""]:
+        checked += 2
+        if lz_string.compress_to_base64(edge_case) != lztranscoder.compressToBase64(edge_case):
+            failures += 1
+            print("MISMATCH compressing %r" % edge_case)
+        if lz_string.decompress_from_base64(edge_case) != lztranscoder.decompressFromBase64(edge_case):
+            failures += 1
+            print("MISMATCH decompressing %r" % edge_case)
+
+    print("differential: %d/%d cases identical" % (checked - failures, checked))
+    return failures
+
+
+def time_codec(name, compress, decompress, definitions, iterations):
+    compressed = [compress(definition) for definition in definitions]
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for definition in definitions:
+            compress(definition)
+    compress_time = (time.perf_counter() - start) / (iterations * len(definitions))
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for data in compressed:
+            decompress(data)
+    decompress_time = (time.perf_counter() - start) / (iterations * len(compressed))
+
+    print("%s: compress %.1fus, decompress %.1fus per puzzle URL" % (name, compress_time * 1e6, decompress_time * 1e6))
+    return compress_time + decompress_time
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    definitions = puzzle_definitions()
+
+    failures = check(definitions)
+
+    lztranscoder = lzstring.LZString()
+    reference = time_codec("lzstring", lztranscoder.compressToBase64, lztranscoder.decompressFromBase64, definitions,
+                           iterations)
+    ours = time_codec("lz_string", lz_string.compress_to_base64, lz_string.decompress_from_base64, definitions,
+                      iterations)
+    print("speedup: %.1fx" % (reference / ours))
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
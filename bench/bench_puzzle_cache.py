@@ -0,0 +1,66 @@
+""" Scores a batch of submissions against one puzzle with the puzzle cache cold and warm, and reports how long
+    loading the puzzle took per submission.  The Puzzles table is stood in for by a stub with a simulated latency,
+    so this runs offline:
+
+        python bench/bench_puzzle_cache.py [batch size] [simulated airtable latency in ms]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("GRAPHITE", "127.0.0.1")
+
+import lz_string
+from puzzles import PuzzleCache
+from sample_puzzles import SAMPLE_PUZZLE_DEFINITION
+
+
+class StubPersistence:
+    def __init__(self, puzzle_url, latency_seconds):
+        self.puzzle_url = puzzle_url
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+
+    def get_config(self, key, default, cached=True):
+        return default
+
+    def get_puzzle_data(self, puzzle_id):
+        self.requests += 1
+        time.sleep(self.latency_seconds)
+        return {"id": "rec" + puzzle_id, "fields": {"id": puzzle_id, "puzzleURL": self.puzzle_url}}
+
+
+def run_batch(puzzle_cache, batch_size):
+    start = time.perf_counter()
+    for i in range(batch_size):
+        puzzle = puzzle_cache.get("puzzle_1")
+        lz_string.compress_to_base64(json.dumps(puzzle.with_expression("sin(x)+%d" % i)))
+    return time.perf_counter() - start
+
+
+def main():
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency_seconds = (float(sys.argv[2]) if len(sys.argv) > 2 else 150) / 1000
+
+    puzzle_url = "https://sinerider.com/?" + lz_string.compress_to_base64(json.dumps(SAMPLE_PUZZLE_DEFINITION))
+
+    # Cold - nothing is ever cached, which is what every submission used to pay
+    persistence = StubPersistence(puzzle_url, latency_seconds)
+    cold_cache = PuzzleCache(persistence, max_size=0)
+    cold = run_batch(cold_cache, batch_size)
+    print("cold: %d submissions in %.3fs (%.2fms each, %d puzzle queries)" % (
+        batch_size, cold, cold * 1000 / batch_size, persistence.requests))
+
+    # Warm - only the first submission loads the puzzle
+    persistence = StubPersistence(puzzle_url, latency_seconds)
+    warm_cache = PuzzleCache(persistence)
+    warm = run_batch(warm_cache, batch_size)
+    print("warm: %d submissions in %.3fs (%.2fms each, %d puzzle queries, %d hits / %d misses)" % (
+        batch_size, warm, warm * 1000 / batch_size, persistence.requests, warm_cache.cache.hits,
+        warm_cache.cache.misses))
+
+
+if __name__ == "__main__":
+    main()
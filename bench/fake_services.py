@@ -0,0 +1,554 @@
+""" Local stand-ins for the services the bot talks to, for bench_load.py:
+
+    - airtable: the REST API that pyairtable.Table uses (list with filterByFormula / fields / paging, get, create,
+      update and delete, single and batched), with airtable's rate limit of 5 requests per second per base
+    - twitter: the v2 recent search and create tweet endpoints, and the OAuth2 token refresh endpoint
+    - upload: twitter's v1.1 chunked media upload endpoint (INIT / APPEND / FINALIZE)
+    - scoring: the scoring service, with a configurable render delay
+    - media: the gameplay videos that the scoring service links to, of a configurable size
+    - redis: an in-memory redis server, if fakeredis is installed
+
+    Each service listens on its own port on 127.0.0.1 and counts the requests made to it (GET /_stats).  Submission
+    tweets are posted with POST /_submit on the twitter service, which also records how long each one took to be
+    replied to.  Runs as its own process, so that it doesn't count towards the bot's memory use:
+
+        python bench/fake_services.py [--render-delay-ms N] [--gameplay-kb N] [--airtable-latency-ms N] ...
+
+    and prints one line of JSON with the port of each service once they're all listening.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import string
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import lz_string
+
+AIRTABLE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """ Base request handler: routes requests to the service's handle() and counts them """
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def do_GET(self):
+        self.__dispatch("GET")
+
+    def do_POST(self):
+        self.__dispatch("POST")
+
+    def do_PATCH(self):
+        self.__dispatch("PATCH")
+
+    def do_PUT(self):
+        self.__dispatch("PUT")
+
+    def do_DELETE(self):
+        self.__dispatch("DELETE")
+
+    def __dispatch(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", "0") or "0")
+        body = self.rfile.read(length) if length > 0 else b""
+        if url.path == "/_stats":
+            self.send_json(200, self.service.stats())
+            return
+
+        if not url.path.startswith("/_"):
+            self.service.count(method, url.path)
+        try:
+            self.service.handle(self, method, url.path, parse_qs(url.query), body)
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeService:
+    def __init__(self, name):
+        self.name = name
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, method, path):
+        # Note - record ids, media ids etc. are collapsed so that requests are counted per endpoint
+        endpoint = "%s %s" % (method, re.sub(r"/(rec[A-Za-z0-9]{14}|[0-9]{6,})(?=/|$)", "/:id", path))
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def stats(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "total_requests": sum(self.requests.values())}
+
+    def handle(self, handler, method, path, query, body):
+        raise NotImplementedError()
+
+    def serve(self):
+        handler = type("%sHandler" % self.name.capitalize(), (FakeServiceHandler,), {"service": self})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.server_address[1]
+
+
+class FakeAirtable(FakeService):
+    def __init__(self, latency_seconds=0, requests_per_second=5, penalty_seconds=30):
+        """ Airtable's REST API, for every table in every base, kept in memory
+        :param latency_seconds: (optional) How long each request takes
+        :param requests_per_second: (optional) The rate limit, after which requests get a 429
+        :param penalty_seconds: (optional) How long every request gets a 429 for after going over the rate limit
+        """
+        super().__init__("airtable")
+        self.latency_seconds = latency_seconds
+        self.requests_per_second = requests_per_second
+        self.penalty_seconds = penalty_seconds
+        self.tables = {}
+        self.rate_limited = 0
+        self.__tokens = requests_per_second
+        self.__refilled_at = time.monotonic()
+        self.__blocked_until = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats["rate_limited"] = self.rate_limited
+        return stats
+
+    def seed(self, table_name, fields):
+        with self.lock:
+            self.__create(table_name, fields)
+
+    def handle(self, handler, method, path, query, body):
+        time.sleep(self.latency_seconds)
+        if not self.__allow():
+            handler.send_json(429, {"errors": [{"error": "RATE_LIMIT_REACHED"}]})
+            return
+
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if len(parts) < 3 or parts[0] != "v0":
+            handler.send_json(404, {"error": "NOT_FOUND"})
+            return
+        table_name = parts[2]
+        record_id = parts[3] if len(parts) > 3 else None
+        payload = json.loads(body) if len(body) > 0 else {}
+
+        with self.lock:
+            table = self.tables.setdefault(table_name, {})
+            if method == "GET" and record_id is None:
+                handler.send_json(200, self.__list(table, query))
+            elif record_id is not None and record_id not in table:
+                handler.send_json(404, {"error": "NOT_FOUND"})
+            elif method == "GET":
+                handler.send_json(200, self.__output(table[record_id]))
+            elif method == "POST" and "records" in payload:
+                handler.send_json(200, {"records": [self.__output(self.__create(table_name, record["fields"]))
+                                                    for record in payload["records"]]})
+            elif method == "POST":
+                handler.send_json(200, self.__output(self.__create(table_name, payload["fields"])))
+            elif method in ("PATCH", "PUT") and record_id is None:
+                handler.send_json(200, {"records": [self.__output(self.__update(table, record["id"], record["fields"]))
+                                                    for record in payload["records"]]})
+            elif method in ("PATCH", "PUT"):
+                handler.send_json(200, self.__output(self.__update(table, record_id, payload["fields"])))
+            elif method == "DELETE":
+                record_ids = [record_id] if record_id is not None else query.get("records[]", [])
+                deleted = [{"id": record_id, "deleted": table.pop(record_id, None) is not None}
+                           for record_id in record_ids]
+                handler.send_json(200, deleted[0] if record_id is not None else {"records": deleted})
+            else:
+                handler.send_json(404, {"error": "NOT_FOUND"})
+
+    def __allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.__tokens = min(self.requests_per_second,
+                                self.__tokens + (now - self.__refilled_at) * self.requests_per_second)
+            self.__refilled_at = now
+            if now < self.__blocked_until or self.__tokens < 1:
+                if now >= self.__blocked_until:
+                    self.__blocked_until = now + self.penalty_seconds
+                self.rate_limited += 1
+                return False
+            self.__tokens -= 1
+            return True
+
+    def __create(self, table_name, fields):
+        record_id = "rec" + "".join(random.choice(string.ascii_letters + string.digits) for _ in range(14))
+        now = datetime.now(timezone.utc)
+        record = {"id": record_id, "createdTime": now.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (now.microsecond // 1000),
+                  "fields": dict(fields)}
+        self.tables.setdefault(table_name, {})[record_id] = record
+        return record
+
+    def __update(self, table, record_id, fields):
+        table[record_id]["fields"].update(fields)
+        return table[record_id]
+
+    def __list(self, table, query):
+        formula = query.get("filterByFormula", [None])[0]
+        records = list(table.values())
+        if formula:
+            expression = AirtableFormula(formula)
+            records = [record for record in records if expression.matches(record)]
+        max_records = int(query.get("maxRecords", ["0"])[0])
+        if max_records > 0:
+            records = records[:max_records]
+
+        page_size = int(query.get("pageSize", ["100"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        fields = query.get("fields[]", None)
+        page = {"records": [self.__output(record, fields) for record in records[offset:offset + page_size]]}
+        if offset + page_size < len(records):
+            page["offset"] = str(offset + page_size)
+        return page
+
+    @staticmethod
+    def __output(record, fields=None):
+        # Note - like airtable, unchecked checkboxes and empty values are left out
+        output_fields = {name: value for name, value in record["fields"].items()
+                         if value not in (None, False, "", []) and (fields is None or name in fields)}
+        return {"id": record["id"], "createdTime": record["createdTime"], "fields": output_fields}
+
+
+class AirtableFormula:
+    """ Evaluates the subset of airtable's formula language that the bot uses: AND / OR / NOT / IF, comparisons,
+        {field} references, string and number literals, and IS_AFTER(CREATED_TIME(), DATETIME_PARSE(...)) """
+    TOKEN = re.compile(r"\s*(?:(?P<field>\{[^}]*\})|(?P<string>'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\")|"
+                       r"(?P<number>-?\d+(?:\.\d+)?)|(?P<name>[A-Z_]+)|(?P<op><=|>=|!=|[=<>(),&]))")
+
+    def __init__(self, formula):
+        self.tokens = []
+        position = 0
+        formula = formula.strip()
+        while position < len(formula):
+            match = self.TOKEN.match(formula, position)
+            if match is None:
+                raise ValueError("Can't parse formula at: %s" % formula[position:])
+            kind = match.lastgroup
+            text = match.group(kind)
+            if kind == "string":
+                text = re.sub(r"\\(.)", r"\1", text[1:-1])
+            elif kind == "number":
+                text = float(text)
+            self.tokens.append((kind, text))
+            position = match.end()
+
+    def matches(self, record):
+        self.record = record
+        self.position = 0
+        return self.__truthy(self.__comparison())
+
+    def __peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def __take(self):
+        token = self.__peek()
+        self.position += 1
+        return token
+
+    def __comparison(self):
+        left = self.__concatenation()
+        kind, text = self.__peek()
+        if kind == "op" and text in ("=", "!=", "<", ">", "<=", ">="):
+            self.__take()
+            right = self.__concatenation()
+            left, right = self.__coerce(left), self.__coerce(right)
+            if isinstance(left, float) != isinstance(right, float):
+                left, right = str(left), str(right)
+            return {"=": left == right, "!=": left != right, "<": left < right, ">": left > right,
+                    "<=": left <= right, ">=": left >= right}[text]
+        return left
+
+    def __concatenation(self):
+        value = self.__primary()
+        while self.__peek() == ("op", "&"):
+            self.__take()
+            value = "%s%s" % (value, self.__primary())
+        return value
+
+    def __primary(self):
+        kind, text = self.__take()
+        if kind == "field":
+            return self.record["fields"].get(text[1:-1], None)
+        if kind in ("string", "number"):
+            return text
+        if kind == "op" and text == "(":
+            value = self.__comparison()
+            self.__take()
+            return value
+        if kind == "name":
+            self.__take()
+            args = []
+            while self.__peek() != ("op", ")"):
+                args.append(self.__comparison())
+                if self.__peek() == ("op", ","):
+                    self.__take()
+            self.__take()
+            return self.__call(text, args)
+        raise ValueError("Unexpected token %r" % text)
+
+    def __call(self, name, args):
+        if name == "AND":
+            return all(self.__truthy(arg) for arg in args)
+        if name == "OR":
+            return any(self.__truthy(arg) for arg in args)
+        if name == "NOT":
+            return not self.__truthy(args[0])
+        if name == "IF":
+            return args[1] if self.__truthy(args[0]) else (args[2] if len(args) > 2 else None)
+        if name == "TRUE":
+            return True
+        if name == "FALSE":
+            return False
+        if name == "CREATED_TIME":
+            return datetime.strptime(self.record["createdTime"], AIRTABLE_TIME_FORMAT)
+        if name == "DATETIME_PARSE":
+            return datetime.strptime(args[0], AIRTABLE_TIME_FORMAT)
+        if name == "IS_AFTER":
+            return args[0] > args[1]
+        raise ValueError("Unsupported formula function %s" % name)
+
+    @staticmethod
+    def __coerce(value):
+        if value is None or isinstance(value, bool):
+            return float(bool(value))
+        if isinstance(value, int):
+            return float(value)
+        return value
+
+    @staticmethod
+    def __truthy(value):
+        return value not in (None, False, 0, "")
+
+
+class FakeTwitter(FakeService):
+    def __init__(self):
+        """ Twitter's v2 API: recent search over the tweets posted with POST /_submit, creating tweets, and refreshing
+            OAuth2 tokens """
+        super().__init__("twitter")
+        self.tweets = []
+        self.tweet_ids = itertools.count(1600000000000000000)
+        self.submitted_at = {}
+        self.replied_at = {}
+        self.replies = 0
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats["submitted"] = len(self.submitted_at)
+            stats["replied"] = len(self.replied_at)
+            stats["replies"] = self.replies
+            stats["latencies"] = [self.replied_at[tweet_id] - self.submitted_at[tweet_id]
+                                  for tweet_id in self.replied_at]
+        return stats
+
+    def handle(self, handler, method, path, query, body):
+        headers = {"x-rate-limit-remaining": "100000", "x-rate-limit-reset": str(int(time.time()) + 900)}
+        if method == "POST" and path == "/_submit":
+            handler.send_json(200, {"id": self.__submit(json.loads(body))})
+        elif method == "GET" and path == "/2/tweets/search/recent":
+            handler.send_json(200, self.__search(query), headers)
+        elif method == "POST" and path == "/2/tweets":
+            handler.send_json(201, {"data": self.__create_tweet(json.loads(body))}, headers)
+        elif method == "POST" and path == "/2/oauth2/token":
+            handler.send_json(200, {"token_type": "bearer", "expires_in": 7200, "access_token": self.__token(),
+                                    "refresh_token": self.__token(),
+                                    "scope": "tweet.read users.read tweet.write offline.access"})
+        else:
+            handler.send_json(404, {"title": "Not Found Error"})
+
+    def __submit(self, submission):
+        with self.lock:
+            tweet_id = str(next(self.tweet_ids))
+            self.tweets.append({"id": tweet_id, "author_id": submission["author_id"],
+                                "author_name": submission["author_name"], "text": submission["text"]})
+            self.submitted_at[tweet_id] = time.time()
+        return tweet_id
+
+    def __search(self, query):
+        since_id = int(query.get("since_id", ["0"])[0])
+        max_results = int(query.get("max_results", ["10"])[0])
+        offset = int(query.get("next_token", ["0"])[0])
+        with self.lock:
+            matching = [tweet for tweet in reversed(self.tweets) if int(tweet["id"]) > since_id]
+        page = matching[offset:offset + max_results]
+        if len(page) == 0:
+            return {"meta": {"result_count": 0}}
+
+        response = {
+            "data": [{"id": tweet["id"], "author_id": tweet["author_id"], "text": tweet["text"],
+                      "created_at": "2023-01-01T00:00:00.000Z", "edit_history_tweet_ids": [tweet["id"]]}
+                     for tweet in page],
+            "includes": {"users": [{"id": tweet["author_id"], "name": tweet["author_name"],
+                                    "username": tweet["author_name"]} for tweet in page]},
+            "meta": {"newest_id": page[0]["id"], "oldest_id": page[-1]["id"], "result_count": len(page)},
+        }
+        if offset + max_results < len(matching):
+            response["meta"]["next_token"] = str(offset + max_results)
+        return response
+
+    def __create_tweet(self, tweet):
+        with self.lock:
+            tweet_id = str(next(self.tweet_ids))
+            self.replies += 1
+            in_reply_to = tweet.get("reply", {}).get("in_reply_to_tweet_id", None)
+            if in_reply_to in self.submitted_at and in_reply_to not in self.replied_at:
+                self.replied_at[in_reply_to] = time.time()
+        return {"id": tweet_id, "text": tweet["text"], "edit_history_tweet_ids": [tweet_id]}
+
+    @staticmethod
+    def __token():
+        return "".join(random.choice(string.ascii_letters) for _ in range(40))
+
+
+class FakeUpload(FakeService):
+    def __init__(self):
+        """ Twitter's v1.1 chunked media upload endpoint """
+        super().__init__("upload")
+        self.media_ids = itertools.count(1500000000000000000)
+        self.uploaded_bytes = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats["uploaded_bytes"] = self.uploaded_bytes
+        return stats
+
+    def handle(self, handler, method, path, query, body):
+        if method != "POST" or path != "/1.1/media/upload.json":
+            handler.send_json(404, {"errors": [{"code": 34}]})
+            return
+
+        content_type = handler.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            # APPEND
+            with self.lock:
+                self.uploaded_bytes += len(body)
+            handler.send_response(204)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        form = parse_qs(body.decode("utf-8"))
+        command = form["command"][0]
+        if command == "INIT":
+            media_id = next(self.media_ids)
+        else:
+            media_id = int(form["media_id"][0])
+        handler.send_json(200, {"media_id": media_id, "media_id_string": str(media_id), "expires_after_secs": 86400})
+
+
+class FakeScoring(FakeService):
+    def __init__(self, media_port, render_delay_seconds=2):
+        """ The scoring service, which "renders" each submission by waiting a while
+        :param media_port: The port of the FakeMedia service that gameplay videos are linked to
+        :param render_delay_seconds: (optional) How long each render takes
+        """
+        super().__init__("scoring")
+        self.media_port = media_port
+        self.render_delay_seconds = render_delay_seconds
+        self.renders = itertools.count()
+
+    def handle(self, handler, method, path, query, body):
+        level_url = json.loads(body)["level"]
+        puzzle_data = json.loads(lz_string.decompress_from_base64(level_url.partition("?")[2]))
+        expression = puzzle_data["expressionOverride"]
+        time.sleep(self.render_delay_seconds)
+        handler.send_json(200, {"level": puzzle_data["name"], "expression": expression,
+                                "charCount": len(expression), "time": round(random.uniform(1, 25), 3),
+                                "gameplay": "http://127.0.0.1:%d/gameplay/%d.mp4" % (self.media_port,
+                                                                                   next(self.renders))})
+
+
+class FakeMedia(FakeService):
+    CHUNK = bytes(64 * 1024)
+
+    def __init__(self, size_bytes):
+        """ Gameplay videos, all of the same size
+        :param size_bytes: The size of each video
+        """
+        super().__init__("media")
+        self.size_bytes = size_bytes
+
+    def handle(self, handler, method, path, query, body):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "video/mp4")
+        handler.send_header("Content-Length", str(self.size_bytes))
+        handler.end_headers()
+        remaining = self.size_bytes
+        while remaining > 0:
+            chunk = self.CHUNK[:min(remaining, len(self.CHUNK))]
+            handler.wfile.write(chunk)
+            remaining -= len(chunk)
+
+
+def serve_fake_redis():
+    """ Starts an in-memory redis server, if fakeredis is installed
+    :return: Its port, or None
+    """
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        return None
+
+    server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--render-delay-ms", type=float, default=2000)
+    parser.add_argument("--gameplay-kb", type=int, default=512)
+    parser.add_argument("--airtable-latency-ms", type=float, default=100)
+    parser.add_argument("--airtable-penalty-seconds", type=float, default=30)
+    parser.add_argument("--seed", help="JSON of {table name: [fields, ...]} to create before starting")
+    args = parser.parse_args()
+
+    airtable = FakeAirtable(args.airtable_latency_ms / 1000, penalty_seconds=args.airtable_penalty_seconds)
+    for table_name, rows in json.loads(args.seed or "{}").items():
+        for fields in rows:
+            airtable.seed(table_name, fields)
+    media = FakeMedia(args.gameplay_kb * 1024)
+    media_port = media.serve()
+    ports = {
+        "airtable": airtable.serve(),
+        "twitter": FakeTwitter().serve(),
+        "upload": FakeUpload().serve(),
+        "scoring": FakeScoring(media_port, args.render_delay_ms / 1000).serve(),
+        "media": media_port,
+    }
+    redis_port = serve_fake_redis()
+    if redis_port is not None:
+        ports["redis"] = redis_port
+    print(json.dumps(ports))
+    sys.stdout.flush()
+
+    # Run until our parent goes away
+    sys.stdin.read()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+""" Puzzle definitions shaped like the ones the SineRider puzzle publisher encodes into puzzle URLs, for use in the
+    benchmarks in this directory. """
+
+SAMPLE_PUZZLE_DEFINITION = {
+    "id": "puzzle_1",
+    "name": "Puzzle of the day #1",
+    "nick": "puzzle_1",
+    "drawOrder": 0,
+    "x": 0,
+    "y": 0,
+    "world": "Sinusoid",
+    "colors": {
+        "sky": "#ddccc6",
+        "bottom": "#b0a6ae",
+    },
+    "camera": {
+        "x": 0,
+        "y": 0,
+        "fov": 10,
+    },
+    "defaultExpression": "0",
+    "sky": {
+        "asset": "images.benchmark_sky",
+    },
+    "sledders": [
+        {
+            "type": "sledder",
+            "x": -3,
+            "asset": "images.ada_sledding",
+            "size": 2,
+        },
+    ],
+    "goals": [
+        {"type": "fixed", "x": 5, "y": 2, "order": "A"},
+        {"type": "fixed", "x": 8, "y": -1, "order": "B"},
+        {"type": "dynamic", "x": 12, "y": 4, "order": "C"},
+    ],
+    "sprites": [
+        {"asset": "images.tree_1", "x": -6, "y": 0, "size": 3, "sloped": True},
+        {"asset": "images.rock_1", "x": 10, "y": 0, "size": 1, "sloped": True},
+    ],
+}
+
+SAMPLE_EXPRESSIONS = [
+    "\\sin\\left(x\\right)",
+    ".001x^2\\cdot .001x^4-2\\ +\\ -.05x^2\\ +\\ \\left(.5\\log \\left(x\\right)+5\\right)+\\sin \\left(17t\\right)",
+    "x^{2}-3x+\\frac{1}{2}",
+    "\\cos\\left(2x\\right)\\cdot \\left(x-t\\right)",
+    "-\\left|x-4\\right|+3",
+]